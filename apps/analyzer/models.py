@@ -1,6 +1,8 @@
 import datetime
+import threading
+import redis
 import mongoengine as mongo
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 from django.db import models
 from django.contrib.auth.models import User
 from django.template.loader import render_to_string
@@ -85,7 +87,46 @@ class MPopularityQuery(mongo.Document):
         logging.debug(" -> ~BB~FM~SBSent email for popularity query: %s" % self)
         
 
-class MClassifierTitle(mongo.Document):
+class CountedClassifier:
+    """ Keeps the feed's RClassifierCount in step as a classifier is trained, retrained,
+        moved to another feed and removed. """
+    
+    def counted_fields(self):
+        return ['feed_id', 'score', dict(RClassifierCount.facets())[self.__class__]]
+    
+    def stored(self):
+        """ The classifier as last saved, if anything it is counted by has changed since. """
+        counted_fields = self.counted_fields()
+        if not any(field in self._get_changed_fields() for field in counted_fields):
+            return self
+        return self.__class__.objects(pk=self.pk).only(*set(counted_fields)).first()
+    
+    def save(self, *args, **kwargs):
+        created = not self.pk
+        previous = None if created else self.stored()
+        
+        super(CountedClassifier, self).save(*args, **kwargs)
+        
+        if created:
+            RClassifierCount.count(self, self.score)
+        elif previous is not None and previous is not self:
+            if any(getattr(previous, field) != getattr(self, field) for field in self.counted_fields()):
+                RClassifierCount.count(previous, previous.score, delta=-1)
+                RClassifierCount.count(self, self.score)
+        
+        return self
+    
+    def delete(self, *args, **kwargs):
+        if self.pk:
+            # Unsaved changes, like switch_feed's new feed_id, were never counted
+            previous = self.stored()
+            if previous is not None:
+                RClassifierCount.count(previous, previous.score, delta=-1)
+        
+        super(CountedClassifier, self).delete(*args, **kwargs)
+
+
+class MClassifierTitle(CountedClassifier, mongo.Document):
     user_id = mongo.IntField()
     feed_id = mongo.IntField()
     social_user_id = mongo.IntField()
@@ -104,7 +145,7 @@ class MClassifierTitle(mongo.Document):
         return "%s - %s/%s: (%s) %s" % (user, self.feed_id, self.social_user_id, self.score, self.title[:30])
         
             
-class MClassifierAuthor(mongo.Document):
+class MClassifierAuthor(CountedClassifier, mongo.Document):
     user_id = mongo.IntField(unique_with=('feed_id', 'social_user_id', 'author'))
     feed_id = mongo.IntField()
     social_user_id = mongo.IntField()
@@ -122,7 +163,7 @@ class MClassifierAuthor(mongo.Document):
         user = User.objects.get(pk=self.user_id)
         return "%s - %s/%s: (%s) %s" % (user, self.feed_id, self.social_user_id, self.score, self.author[:30])
 
-class MClassifierTag(mongo.Document):
+class MClassifierTag(CountedClassifier, mongo.Document):
     user_id = mongo.IntField(unique_with=('feed_id', 'social_user_id', 'tag'))
     feed_id = mongo.IntField()
     social_user_id = mongo.IntField()
@@ -141,7 +182,7 @@ class MClassifierTag(mongo.Document):
         return "%s - %s/%s: (%s) %s" % (user, self.feed_id, self.social_user_id, self.score, self.tag[:30])
     
 
-class MClassifierFeed(mongo.Document):
+class MClassifierFeed(CountedClassifier, mongo.Document):
     user_id = mongo.IntField(unique_with=('feed_id', 'social_user_id'))
     feed_id = mongo.IntField()
     social_user_id = mongo.IntField()
@@ -161,7 +202,102 @@ class MClassifierFeed(mongo.Document):
         else:
             feed = User.objects.get(pk=self.social_user_id)
         return "%s - %s/%s: (%s) %s" % (user, self.feed_id, self.social_user_id, self.score, feed)
-    
+
+
+class RClassifierCount:
+    """
+    How many users like and dislike each title, author, tag and the feed itself, kept in
+    a redis hash per feed as classifiers are saved and deleted. Fields are
+    <facet>:<pos|neg>:<value>, and the built field marks a hash that was backfilled from
+    the classifiers themselves.
+    """
+
+    @classmethod
+    def facets(cls):
+        return [(MClassifierTitle, 'title'),
+                (MClassifierAuthor, 'author'),
+                (MClassifierTag, 'tag'),
+                (MClassifierFeed, 'feed_id')]
+
+    @classmethod
+    def key(cls, feed_id):
+        return "fCC:%s" % feed_id
+
+    @classmethod
+    def count(cls, classifier, score, delta=1):
+        if not classifier.feed_id or not score:
+            return
+        facet = dict(cls.facets())[classifier.__class__]
+        value = getattr(classifier, facet)
+        if value is None:
+            return
+        field = "%s:%s:%s" % (facet, 'pos' if score > 0 else 'neg', value)
+        try:
+            r = redis.Redis(connection_pool=settings.REDIS_STATISTICS_POOL)
+            r.hincrby(cls.key(classifier.feed_id), field, abs(score) * delta)
+        except redis.ConnectionError:
+            logging.debug(" ***> ~FRRedis is unavailable for classifier counts.")
+
+    @classmethod
+    def build(cls, feed_ids):
+        """ Backfills the counts of many feeds with one aggregation per facet. """
+        feed_ids = [int(feed_id) for feed_id in feed_ids]
+        counts = dict((feed_id, {'built': 1}) for feed_id in feed_ids)
+        for classifier_cls, facet in cls.facets():
+            stats = classifier_cls._get_collection().aggregate([{
+                "$match": {"feed_id": {"$in": feed_ids}},
+            }, {
+                "$group": {
+                    "_id": {"feed_id": "$feed_id", "value": "$%s" % facet},
+                    "pos": {"$sum": {"$cond": [{"$gt": ["$score", 0]}, "$score", 0]}},
+                    "neg": {"$sum": {"$cond": [{"$lt": ["$score", 0]}, {"$abs": "$score"}, 0]}},
+                },
+            }])
+            for stat in stats:
+                if stat['_id'].get('value') is None: continue
+                feed_counts = counts[stat['_id']['feed_id']]
+                for opinion in ('pos', 'neg'):
+                    if stat[opinion]:
+                        feed_counts["%s:%s:%s" % (facet, opinion, stat['_id']['value'])] = int(stat[opinion])
+
+        r = redis.Redis(connection_pool=settings.REDIS_STATISTICS_POOL)
+        p = r.pipeline()
+        for feed_id, feed_counts in counts.items():
+            p.delete(cls.key(feed_id))
+            p.hset(cls.key(feed_id), mapping=feed_counts)
+        p.execute()
+
+        return counts
+
+    @classmethod
+    def scores(cls, feed_id):
+        """
+        Returns {facet: [{facet: value, 'pos': #, 'neg': #}, ...]} for the facets that have
+        any, most disliked first, with the feed's own scores under 'feed'.
+        """
+        r = redis.Redis(connection_pool=settings.REDIS_STATISTICS_POOL)
+        counts = r.hgetall(cls.key(feed_id))
+        if not counts.get('built'):
+            counts = cls.build([feed_id])[int(feed_id)]
+
+        facet_values = defaultdict(dict)
+        for field, count in counts.items():
+            if field == 'built': continue
+            facet, opinion, value = field.split(':', 2)
+            if facet == 'feed_id':
+                value = int(value)
+            values = facet_values[facet].setdefault(value, {facet: value, 'pos': 0, 'neg': 0})
+            values[opinion] = int(count)
+
+        scores = {}
+        for _, facet in cls.facets():
+            values = [facet_values[facet][value] for value in sorted(facet_values[facet])]
+            values = [v for v in values if v['pos'] + v['neg'] >= 1]
+            if values:
+                scores['feed' if facet == 'feed_id' else facet] = sorted(values, key=lambda v: v['neg'] - v['pos'])
+
+        return scores
+
 
 def compute_story_score(story, classifier_titles, classifier_authors, classifier_tags, classifier_feeds):
     intelligence = {
@@ -238,6 +374,272 @@ def apply_classifier_feeds(classifiers, feed, social_user_ids=None):
             return classifier.score
     return 0
     
+class ClassifierMatcher:
+    """
+    A user's classifiers compiled for scoring many stories. Gives the same scores as the
+    apply_classifier_* functions, but looks up authors and tags in dicts, matches titles
+    with an Aho-Corasick automaton and feeds with a dict, instead of scanning every
+    classifier for every story.
+    
+    Within a feed, the classifiers that match a story are resolved the way the linear scans
+    resolve them: the first positive classifier wins, otherwise the last matching one.
+    """
+    
+    CACHE_SIZE = 512
+    MIN_AUTOMATON_TITLES = 16
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+    
+    def __init__(self, classifier_feeds=None, classifier_authors=None,
+                 classifier_titles=None, classifier_tags=None):
+        self.classifier_feeds   = classifier_feeds or []
+        self.classifier_authors = classifier_authors or []
+        self.classifier_titles  = classifier_titles or []
+        self.classifier_tags    = classifier_tags or []
+        
+        self.feed_scores = {}
+        self.social_scores = {}
+        for index, classifier in enumerate(self.classifier_feeds):
+            self.feed_scores.setdefault(classifier.feed_id, (index, classifier.score))
+            if not classifier.feed_id:
+                self.social_scores.setdefault(classifier.social_user_id, (index, classifier.score))
+        
+        self.authors = self._compile_lookup(self.classifier_authors, 'author')
+        self.tags = self._compile_lookup(self.classifier_tags, 'tag')
+        self.titles = {}
+        for feed_id, classifiers in self._by_feed(self.classifier_titles).items():
+            patterns = [(classifier.title.lower(), index, classifier.score)
+                        for index, classifier in classifiers]
+            if len(patterns) >= self.MIN_AUTOMATON_TITLES:
+                self.titles[feed_id] = TitleAutomaton(patterns)
+            else:
+                self.titles[feed_id] = patterns
+    
+    def __len__(self):
+        return (len(self.classifier_feeds) + len(self.classifier_authors) +
+                len(self.classifier_titles) + len(self.classifier_tags))
+    
+    @classmethod
+    def for_user(cls, user_id, feed_ids):
+        """
+        Loads and compiles a user's feed classifiers, reusing the compiled matcher until
+        the user's classifier version changes.
+        """
+        feed_ids = tuple(sorted(set(int(feed_id) for feed_id in feed_ids)))
+        cache_key = (int(user_id), feed_ids, cls.classifier_version(user_id))
+        with cls._cache_lock:
+            matcher = cls._cache.get(cache_key)
+            if matcher is not None:
+                cls._cache.move_to_end(cache_key)
+                return matcher
+        
+        params = dict(user_id=user_id, feed_id__in=list(feed_ids))
+        matcher = cls(classifier_feeds=list(MClassifierFeed.objects(social_user_id=0, **params)),
+                      classifier_authors=list(MClassifierAuthor.objects(**params)),
+                      classifier_titles=list(MClassifierTitle.objects(**params)),
+                      classifier_tags=list(MClassifierTag.objects(**params)))
+        
+        with cls._cache_lock:
+            cls._cache[cache_key] = matcher
+            while len(cls._cache) > cls.CACHE_SIZE:
+                cls._cache.popitem(last=False)
+        
+        return matcher
+    
+    @staticmethod
+    def classifier_version(user_id):
+        r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        return int(r.get('CV:%s' % user_id) or 0)
+    
+    @staticmethod
+    def bump_classifier_version(user_id):
+        r = redis.Redis(connection_pool=settings.REDIS_POOL)
+        r.incr('CV:%s' % user_id)
+    
+    @staticmethod
+    def _by_feed(classifiers):
+        feed_classifiers = defaultdict(list)
+        for index, classifier in enumerate(classifiers):
+            feed_classifiers[classifier.feed_id].append((index, classifier))
+        return feed_classifiers
+    
+    @classmethod
+    def _compile_lookup(cls, classifiers, field):
+        lookup = {}
+        for feed_id, feed_classifiers in cls._by_feed(classifiers).items():
+            matches = defaultdict(list)
+            for index, classifier in feed_classifiers:
+                matches[getattr(classifier, field)].append((index, classifier.score))
+            lookup[feed_id] = dict((value, _resolve_matches(entries))
+                                   for value, entries in matches.items())
+        return lookup
+    
+    def score_feed(self, feed, social_user_ids=None):
+        if not feed and not social_user_ids: return 0
+        feed_id = None
+        if feed:
+            feed_id = feed if isinstance(feed, int) else feed.pk
+        
+        if social_user_ids and not isinstance(social_user_ids, list):
+            social_user_ids = [social_user_ids]
+        
+        best = self.feed_scores.get(feed_id)
+        for social_user_id in social_user_ids or []:
+            social = self.social_scores.get(social_user_id)
+            if social and (not best or social[0] < best[0]):
+                best = social
+        return best[1] if best else 0
+    
+    def score_author(self, story):
+        authors = self.authors.get(story['story_feed_id'])
+        if not authors or not story.get('story_authors'):
+            return 0
+        return _score_matches(authors.get(story.get('story_authors')))
+    
+    def score_tags(self, story):
+        tags = self.tags.get(story['story_feed_id'])
+        if not tags or not story['story_tags']:
+            return 0
+        story_tags = story['story_tags']
+        if isinstance(story_tags, str):
+            # Substring matching, as `tag in story_tags` does for a string
+            matches = [tags[tag] for tag in tags if tag in story_tags]
+        else:
+            matches = [tags[tag] for tag in set(story_tags) if tag in tags]
+        return _score_matches(_merge_matches(matches))
+    
+    def score_title(self, story):
+        titles = self.titles.get(story['story_feed_id'])
+        if titles is None:
+            return 0
+        story_title = story['story_title'].lower()
+        if isinstance(titles, TitleAutomaton):
+            return _score_matches(titles.search(story_title))
+        score = 0
+        for title, _, title_score in titles:
+            if title in story_title:
+                score = title_score
+                if score > 0: return score
+        return score
+    
+    def intelligence(self, story, feed=None, social_user_ids=None):
+        if feed is None:
+            feed = story['story_feed_id']
+        return {
+            'feed': self.score_feed(feed, social_user_ids),
+            'author': self.score_author(story),
+            'tags': self.score_tags(story),
+            'title': self.score_title(story),
+        }
+    
+    def score(self, story):
+        intelligence = self.intelligence(story)
+        score = 0
+        score_max = max(intelligence['title'],
+                        intelligence['author'],
+                        intelligence['tags'])
+        score_min = min(intelligence['title'],
+                        intelligence['author'],
+                        intelligence['tags'])
+        if score_max > 0:
+            score = score_max
+        elif score_min < 0:
+            score = score_min
+        
+        if score == 0:
+            score = intelligence['feed']
+        
+        return score
+
+
+class TitleAutomaton:
+    """
+    Aho-Corasick automaton over lowercased title classifiers, so a story title is matched
+    against every classifier in a single pass. Each node keeps only the summary of the
+    classifiers ending there (see _resolve_matches), which is all scoring needs.
+    """
+    
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        outputs = [[]]
+        for pattern, index, score in patterns:
+            node = 0
+            for char in pattern:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][char] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    outputs.append([])
+                node = next_node
+            outputs[node].append((index, score))
+        
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self.goto[node].items():
+                queue.append(next_node)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_node] = self.goto[fail].get(char, 0)
+                outputs[next_node] = outputs[next_node] + outputs[self.fail[next_node]]
+        
+        # An empty title matches every story, as `'' in title` does.
+        self.always = _resolve_matches(outputs[0]) if outputs[0] else None
+        self.outputs = [_resolve_matches(output) if output else None for output in outputs]
+    
+    def search(self, text):
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        matches = [self.always] if self.always else []
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if outputs[node]:
+                matches.append(outputs[node])
+        return _merge_matches(matches)
+
+
+def _resolve_matches(entries):
+    """
+    Summarizes (index, score) classifier matches as the first positive match and the last
+    match, both as (index, score) or None.
+    """
+    positive = None
+    last = None
+    for index, score in entries:
+        if score > 0 and (positive is None or index < positive[0]):
+            positive = (index, score)
+        if last is None or index > last[0]:
+            last = (index, score)
+    return positive, last
+
+def _merge_matches(summaries):
+    positive = None
+    last = None
+    for summary_positive, summary_last in summaries:
+        if summary_positive and (positive is None or summary_positive[0] < positive[0]):
+            positive = summary_positive
+        if summary_last and (last is None or summary_last[0] > last[0]):
+            last = summary_last
+    return positive, last
+
+def _score_matches(summary):
+    if not summary:
+        return 0
+    positive, last = summary
+    if positive:
+        return positive[1]
+    if last:
+        return last[1]
+    return 0
+    
 def get_classifiers_for_user(user, feed_id=None, social_user_id=None, classifier_feeds=None, classifier_authors=None, 
                              classifier_titles=None, classifier_tags=None):
     params = dict(user_id=user.pk)
@@ -8,6 +8,10 @@ from itertools import groupby
 from apps.analyzer.tokenizer import Tokenizer
 from vendor.reverend.thomas import Bayes
 from apps.analyzer.phrase_filter import PhraseFilter
+from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
+from apps.analyzer.models import ClassifierMatcher, TitleAutomaton, compute_story_score
+from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds
+from apps.analyzer.models import apply_classifier_authors, apply_classifier_tags
 
 
 class QuadgramCollocationFinder(nltk.collocations.AbstractCollocationFinder):
@@ -196,4 +200,45 @@ class ClassifierTest(TestCase):
         guess = classifier.guess('Nothing doing: 393 Pacific St.')
         self.assertTrue('bad' not in guess)
         self.assertTrue('good' not in guess)
-        
\ No newline at end of file
+        
+
+
+class ClassifierMatcherTest(TestCase):
+    
+    def test_matches_linear_scoring(self):
+        words = ['atlantic', 'pacific', 'st', 'co-op', 'of the day', 'watch', 'c', '']
+        classifier_titles = [MClassifierTitle(feed_id=feed_id, title=title.upper() if i % 5 == 0 else title,
+                                              score=1 if i % 3 else -1)
+                             for i, (feed_id, title) in enumerate((f, w) for f in (1, 2) for w in words * 3)]
+        classifier_authors = [MClassifierAuthor(feed_id=1, author='Sam', score=-1),
+                              MClassifierAuthor(feed_id=1, author='Jo', score=1),
+                              MClassifierAuthor(feed_id=2, author='Sam', score=1)]
+        classifier_tags = [MClassifierTag(feed_id=1, tag='brooklyn', score=-1),
+                           MClassifierTag(feed_id=1, tag='housing', score=1),
+                           MClassifierTag(feed_id=2, tag='housing', score=-1)]
+        classifier_feeds = [MClassifierFeed(feed_id=2, social_user_id=0, score=-1),
+                            MClassifierFeed(feed_id=0, social_user_id=5, score=1)]
+        matcher = ClassifierMatcher(classifier_feeds=classifier_feeds,
+                                    classifier_authors=classifier_authors,
+                                    classifier_titles=classifier_titles,
+                                    classifier_tags=classifier_tags)
+        self.assertTrue(isinstance(matcher.titles[1], TitleAutomaton))
+        
+        titles = ['Co-op of the Day: 413 Atlantic', 'Development Watch: Yatta', 'Streetlevel: 393 Pacific St.', 'Extra']
+        for feed_id in (1, 2, 3):
+            for title in titles:
+                for author in ('Sam', 'Jo', ''):
+                    for tags in ([], ['brooklyn'], ['housing', 'brooklyn']):
+                        story = dict(story_feed_id=feed_id, story_title=title, story_authors=author, story_tags=tags)
+                        self.assertEqual(matcher.intelligence(story), {
+                            'feed': apply_classifier_feeds(classifier_feeds, feed_id),
+                            'author': apply_classifier_authors(classifier_authors, story),
+                            'tags': apply_classifier_tags(classifier_tags, story),
+                            'title': apply_classifier_titles(classifier_titles, story),
+                        })
+                        self.assertEqual(matcher.score(story),
+                                         compute_story_score(story, classifier_titles, classifier_authors,
+                                                             classifier_tags, classifier_feeds))
+        
+        self.assertEqual(matcher.score_feed(None, social_user_ids=5), 1)
+        self.assertEqual(matcher.score_feed(2, social_user_ids=[5]), -1)
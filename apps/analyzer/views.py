@@ -9,6 +9,7 @@ from apps.rss_feeds.models import Feed
 from apps.reader.models import UserSubscription
 from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
 from apps.analyzer.models import get_classifiers_for_user, MPopularityQuery
+from apps.analyzer.models import ClassifierMatcher
 from apps.analyzer.forms import PopularityQueryForm
 from apps.social.models import MSocialSubscription
 from utils import json_functions as json
@@ -104,6 +105,7 @@ def save_classifier(request):
     _save_classifier(MClassifierTag, 'tag')
     _save_classifier(MClassifierTitle, 'title')
     _save_classifier(MClassifierFeed, 'feed')
+    ClassifierMatcher.bump_classifier_version(request.user.pk)
 
     r = redis.Redis(connection_pool=settings.REDIS_PUBSUB_POOL)
     r.publish(request.user.username, 'feed:%s' % feed_id)
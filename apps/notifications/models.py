@@ -5,6 +5,7 @@ import redis
 import re
 import mongoengine as mongo
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.template.loader import render_to_string
@@ -13,7 +14,7 @@ from django.core.mail import EmailMultiAlternatives
 from apps.rss_feeds.models import MStory, Feed
 from apps.reader.models import UserSubscription
 from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
-from apps.analyzer.models import compute_story_score
+from apps.analyzer.models import ClassifierMatcher
 from utils.view_functions import is_true
 from utils.story_functions import truncate_chars
 from utils import log as logging
@@ -95,6 +96,26 @@ class MUserFeedNotification(mongo.Document):
     def feed_has_users(cls, feed_id):
         return cls.users_for_feed(feed_id).count()
     
+    @classmethod
+    def feed_notification_count(cls, feed_id):
+        """feed_has_users(), cached for scheduling the feed's fetches. Cleared whenever a
+        notification of the feed is saved or deleted."""
+        cache_key = "NFc:%s" % feed_id
+        count = cache.get(cache_key)
+        if count is None:
+            count = cls.feed_has_users(feed_id)
+            cache.set(cache_key, count, 60*60*24)
+        return count
+    
+    def save(self, *args, **kwargs):
+        saved = super(MUserFeedNotification, self).save(*args, **kwargs)
+        cache.delete("NFc:%s" % self.feed_id)
+        return saved
+    
+    def delete(self, *args, **kwargs):
+        super(MUserFeedNotification, self).delete(*args, **kwargs)
+        cache.delete("NFc:%s" % self.feed_id)
+    
     @classmethod
     def users_for_feed(cls, feed_id):
         notifications = cls.objects.filter(feed_id=feed_id)
@@ -169,15 +190,10 @@ class MUserFeedNotification(mongo.Document):
         return total_sent_count, len(notifications)
         
     def classifiers(self, usersub):
-        classifiers = {}
         if usersub.is_trained:
-            classifiers['feeds']   = list(MClassifierFeed.objects(user_id=self.user_id, feed_id=self.feed_id,
-                                                                 social_user_id=0))
-            classifiers['authors'] = list(MClassifierAuthor.objects(user_id=self.user_id, feed_id=self.feed_id))
-            classifiers['titles']  = list(MClassifierTitle.objects(user_id=self.user_id, feed_id=self.feed_id))
-            classifiers['tags']    = list(MClassifierTag.objects(user_id=self.user_id, feed_id=self.feed_id))
+            return ClassifierMatcher.for_user(self.user_id, [self.feed_id])
             
-        return classifiers
+        return ClassifierMatcher()
     
     def title_and_body(self, story, usersub, notification_title_only=False):
         def replace_with_newlines(element):
@@ -347,10 +363,7 @@ class MUserFeedNotification(mongo.Document):
         return youtube_id
         
     def story_score(self, story, classifiers):
-        score = compute_story_score(story, classifier_titles=classifiers.get('titles', []), 
-                                    classifier_authors=classifiers.get('authors', []), 
-                                    classifier_tags=classifiers.get('tags', []),
-                                    classifier_feeds=classifiers.get('feeds', []))
+        score = classifiers.score(story)
         
         return score
                 
@@ -3,6 +3,7 @@ import time
 import re
 import redis
 import pymongo
+from collections import defaultdict
 from operator import itemgetter
 from pprint import pprint
 from utils import log as logging
@@ -10,6 +11,7 @@ from utils import json_functions as json
 from django.db import models, IntegrityError
 from django.db.models import Q
 from django.db.models import Count
+from django.db.models.query import QuerySet
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
@@ -17,12 +19,14 @@ from django.template.defaultfilters import slugify
 from mongoengine.queryset import OperationError
 from mongoengine.queryset import NotUniqueError
 from apps.reader.managers import UserSubscriptionManager
-from apps.rss_feeds.models import Feed, MStory, DuplicateFeed
+from apps.rss_feeds.models import Feed, MStory, DuplicateFeed, RFeedReaders
 from apps.rss_feeds.tasks import NewFeeds
 from apps.analyzer.models import MClassifierFeed, MClassifierAuthor, MClassifierTag, MClassifierTitle
-from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds, apply_classifier_authors, apply_classifier_tags
+from apps.analyzer.models import ClassifierMatcher
 from apps.analyzer.tfidf import tfidf
-from utils.feed_functions import add_object_to_folder, chunks
+from utils.feed_functions import add_object_to_folder, chunks, check_deadline
+from utils.redis_scripts import rank_river_stories
+from utils.read_stories import read_stories_backend
 
 def unread_cutoff_default():
     return datetime.datetime.utcnow() - datetime.timedelta(days=settings.DAYS_OF_UNREAD)
@@ -112,33 +116,24 @@ class UserSubscription(models.Model):
                      include_timestamps=False, group_by_feed=True, cutoff_date=None,
                      across_all_feeds=True):
         r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        read_stories = read_stories_backend()
         pipeline = r.pipeline()
         story_hashes = {} if group_by_feed else []
         
-        if not feed_ids and not across_all_feeds:
+        feed_ids, read_dates = cls.story_hash_read_dates(user_id, feed_ids=feed_ids, usersubs=usersubs,
+                                                         read_filter=read_filter, cutoff_date=cutoff_date,
+                                                         across_all_feeds=across_all_feeds)
+        if not feed_ids:
             return story_hashes
         
-        if not usersubs:
-            usersubs = cls.subs_for_feeds(user_id, feed_ids=feed_ids, read_filter=read_filter)
-            feed_ids = [sub.feed_id for sub in usersubs]
-            if not feed_ids:
-                return story_hashes
-        
         current_time = int(time.time() + 60*60*24)
-        if not cutoff_date:
-            cutoff_date = datetime.datetime.now() - datetime.timedelta(days=settings.DAYS_OF_STORY_HASHES)
         feed_counter = 0
 
-        read_dates = dict()
-        for us in usersubs:
-            read_dates[us.feed_id] = int(max(us.mark_read_date, cutoff_date).strftime('%s'))
-
         for feed_id_group in chunks(feed_ids, 20):
             pipeline = r.pipeline()
             for feed_id in feed_id_group:
                 stories_key               = 'F:%s' % feed_id
                 sorted_stories_key        = 'zF:%s' % feed_id
-                read_stories_key          = 'RS:%s:%s' % (user_id, feed_id)
                 unread_stories_key        = 'U:%s:%s' % (user_id, feed_id)
                 unread_ranked_stories_key = 'zU:%s:%s' % (user_id, feed_id)
                 expire_unread_stories_key = False
@@ -147,7 +142,7 @@ class UserSubscription(models.Model):
                 if read_filter == 'unread':
                     # +1 for the intersection b/w zF and F, which carries an implicit score of 1.
                     min_score = read_dates[feed_id] + 1
-                    pipeline.sdiffstore(unread_stories_key, stories_key, read_stories_key)
+                    read_stories.store_unread_story_hashes(pipeline, user_id, feed_id, unread_stories_key)
                     expire_unread_stories_key = True
                 else:
                     min_score = 0
@@ -178,15 +173,72 @@ class UserSubscription(models.Model):
         
         return story_hashes
         
+    @classmethod
+    def story_hash_read_dates(cls, user_id, feed_ids=None, usersubs=None, read_filter="unread",
+                              cutoff_date=None, across_all_feeds=True):
+        if not feed_ids and not across_all_feeds:
+            return [], {}
+        
+        if not usersubs:
+            usersubs = cls.subs_for_feeds(user_id, feed_ids=feed_ids, read_filter=read_filter)
+            feed_ids = [sub.feed_id for sub in usersubs]
+            if not feed_ids:
+                return [], {}
+        
+        if not cutoff_date:
+            cutoff_date = datetime.datetime.now() - datetime.timedelta(days=settings.DAYS_OF_STORY_HASHES)
+
+        read_dates = dict()
+        for us in usersubs:
+            read_dates[us.feed_id] = int(max(us.mark_read_date, cutoff_date).strftime('%s'))
+        
+        return feed_ids, read_dates
+    
+    @classmethod
+    def rank_story_hashes(cls, user_id, ranked_key, feed_ids=None, usersubs=None, read_filter="unread",
+                          cutoff_date=None, across_all_feeds=True, expire=60*60):
+        """
+        Ranks the same stories as `story_hashes(include_timestamps=True)` into the sorted set
+        `ranked_key` on the temp story hash server. The ranking is assembled by a script on the
+        story hash server, then moved over with DUMP/RESTORE, instead of reading every hash back
+        and ZADDing it. Returns the number of stories ranked.
+        """
+        renc = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL_ENCODED)
+        rt = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_TEMP_POOL)
+        
+        feed_ids, read_dates = cls.story_hash_read_dates(user_id, feed_ids=feed_ids, usersubs=usersubs,
+                                                         read_filter=read_filter, cutoff_date=cutoff_date,
+                                                         across_all_feeds=across_all_feeds)
+        if not feed_ids:
+            return 0
+        
+        current_time = int(time.time() + 60*60*24)
+        if read_filter == 'unread':
+            # +1 for the intersection b/w zF and F, which carries an implicit score of 1.
+            feed_min_scores = [(feed_id, read_dates[feed_id] + 1) for feed_id in feed_ids]
+        else:
+            feed_min_scores = [(feed_id, 0) for feed_id in feed_ids]
+        
+        ranked, dump = rank_river_stories(renc, ranked_key, user_id, feed_min_scores,
+                                          max_score=current_time, unread_only=read_filter == 'unread',
+                                          dump=True, read_stories=read_stories_backend())
+        if dump:
+            pipeline = rt.pipeline()
+            pipeline.delete(ranked_key)
+            pipeline.restore(ranked_key, expire*1000, dump)
+            pipeline.execute()
+        
+        return ranked
+        
     def get_stories(self, offset=0, limit=6, order='newest', read_filter='all', withscores=False,
-                    hashes_only=False, cutoff_date=None, default_cutoff_date=None):
+                    hashes_only=False, cutoff_date=None, default_cutoff_date=None, headline=False):
         r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
         renc = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL_ENCODED)
         rt = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_TEMP_POOL)
+        read_stories = read_stories_backend()
         ignore_user_stories = False
         
         stories_key         = 'F:%s' % (self.feed_id)
-        read_stories_key    = 'RS:%s:%s' % (self.user_id, self.feed_id)
         unread_stories_key  = 'U:%s:%s' % (self.user_id, self.feed_id)
 
         unread_ranked_stories_key  = 'z%sU:%s:%s' % ('h' if hashes_only else '', 
@@ -196,11 +248,11 @@ class UserSubscription(models.Model):
             if not r.exists(stories_key):
                 # print " ---> No stories on feed: %s" % self
                 return []
-            elif read_filter == 'all' or not r.exists(read_stories_key):
+            elif read_filter == 'all' or not read_stories.has_read_stories(r, self.user_id, self.feed_id):
                 ignore_user_stories = True
                 unread_stories_key = stories_key
             else:
-                r.sdiffstore(unread_stories_key, stories_key, read_stories_key)
+                read_stories.store_unread_story_hashes(r, self.user_id, self.feed_id, unread_stories_key)
             sorted_stories_key          = 'zF:%s' % (self.feed_id)
             r.zinterstore(unread_ranked_stories_key, [sorted_stories_key, unread_stories_key])
             if not ignore_user_stories:
@@ -256,8 +308,9 @@ class UserSubscription(models.Model):
             return story_ids
         elif story_ids:
             story_date_order = "%sstory_date" % ('' if order == 'oldest' else '-')
-            mstories = MStory.objects(story_hash__in=story_ids).order_by(story_date_order)
-            stories = Feed.format_stories(mstories)
+            excluded_fields = MStory.HEADLINE_EXCLUDED_FIELDS if headline else MStory.UNFORMATTED_FIELDS
+            mstories = MStory.objects(story_hash__in=story_ids).exclude(*excluded_fields).order_by(story_date_order)
+            stories = Feed.format_stories(mstories, headline=headline)
             return stories
         else:
             return []
@@ -299,34 +352,23 @@ class UserSubscription(models.Model):
             rt.delete(ranked_stories_keys)
             rt.delete(unread_ranked_stories_keys)
 
-        story_hashes = cls.story_hashes(user_id, feed_ids=feed_ids, 
-                                        read_filter=read_filter, order=order, 
-                                        include_timestamps=True,
-                                        group_by_feed=False,
-                                        usersubs=usersubs,
-                                        cutoff_date=cutoff_date,
-                                        across_all_feeds=across_all_feeds)
-        if not story_hashes:
+        ranked_count = cls.rank_story_hashes(user_id, ranked_stories_keys, feed_ids=feed_ids, 
+                                             read_filter=read_filter, 
+                                             usersubs=usersubs,
+                                             cutoff_date=cutoff_date,
+                                             across_all_feeds=across_all_feeds)
+        if not ranked_count:
             return [], []
         
-        pipeline = rt.pipeline()
-        for story_hash_group in chunks(story_hashes, 100):
-            pipeline.zadd(ranked_stories_keys, dict(story_hash_group))
-        pipeline.execute()
         story_hashes = range_func(ranked_stories_keys, offset, limit)
 
         if read_filter == "unread":
             unread_feed_story_hashes = story_hashes
             rt.zunionstore(unread_ranked_stories_keys, [ranked_stories_keys])
         else:
-            unread_story_hashes = cls.story_hashes(user_id, feed_ids=feed_ids, 
-                                                   read_filter="unread", order=order, 
-                                                   include_timestamps=True,
-                                                   group_by_feed=False,
-                                                   cutoff_date=cutoff_date)
-            if unread_story_hashes:
-                for unread_story_hash_group in chunks(unread_story_hashes, 100):
-                    rt.zadd(unread_ranked_stories_keys, dict(unread_story_hash_group))
+            cls.rank_story_hashes(user_id, unread_ranked_stories_keys, feed_ids=feed_ids, 
+                                  read_filter="unread", 
+                                  cutoff_date=cutoff_date)
             unread_feed_story_hashes = range_func(unread_ranked_stories_keys, offset, limit)
         
         rt.expire(ranked_stories_keys, 60*60)
@@ -555,19 +597,18 @@ class UserSubscription(models.Model):
                             continue
                     if classifier_count:
                         print(" Moved %s classifiers for %s" % (classifier_count, user.username))
+                if classifier_count:
+                    ClassifierMatcher.bump_classifier_version(user_id)
     
     def trim_read_stories(self, r=None):
         if not r:
             r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
         
-        read_stories_key = "RS:%s:%s" % (self.user_id, self.feed_id)
-        stale_story_hashes = r.sdiff(read_stories_key, "F:%s" % self.feed_id)
-        if not stale_story_hashes:
+        trimmed = read_stories_backend().trim(r, self.feed_id, [self.user_id])
+        if not trimmed:
             return
         
-        logging.user(self.user, "~FBTrimming ~FR%s~FB read stories (~SB%s~SN)..." % (len(stale_story_hashes), self.feed_id))
-        r.srem(read_stories_key, *stale_story_hashes)
-        r.srem("RS:%s" % self.feed_id, *stale_story_hashes)
+        logging.user(self.user, "~FBTrimmed ~FR%s~FB read stories (~SB%s~SN)..." % (trimmed, self.feed_id))
     
     @classmethod
     def trim_user_read_stories(self, user_id):
@@ -679,26 +720,25 @@ class UserSubscription(models.Model):
         
         if not request:
             request = self.user
-    
-        if not self.needs_unread_recalc:
-            self.needs_unread_recalc = True
-            self.save(update_fields=['needs_unread_recalc'])
-    
+        
         if len(story_hashes) > 1:
             logging.user(request, "~FYRead %s stories in feed: %s" % (len(story_hashes), self.feed))
         else:
             logging.user(request, "~FYRead story (%s) in feed: %s" % (story_hashes, self.feed))
             RUserStory.aggregate_mark_read(self.feed_id)
         
-        for story_hash in set(story_hashes):            
-            # logging.user(request, "~FYRead story: %s" % (story_hash))
-            RUserStory.mark_read(self.user_id, self.feed_id, story_hash, aggregated=aggregated)
-            r.publish(self.user.username, 'story:read:%s' % story_hash)
-
+        story_hashes = [MStory.ensure_story_hash(story_hash, story_feed_id=self.feed_id)
+                        for story_hash in RUserStory.unique_story_hashes(story_hashes)]
+        RUserStory.bulk_mark_read(self.user_id, {self.feed_id: story_hashes}, aggregated=aggregated)
+        RUserStory.publish_read(r, self.user.username, story_hashes)
         r.publish(self.user.username, 'feed:%s' % self.feed_id)
         
         self.last_read_date = datetime.datetime.now()
-        self.save(update_fields=['last_read_date'])
+        update_fields = ['last_read_date']
+        if not self.needs_unread_recalc:
+            self.needs_unread_recalc = True
+            update_fields.append('needs_unread_recalc')
+        self.save(update_fields=update_fields)
         
         return data
     
@@ -776,56 +816,19 @@ class UserSubscription(models.Model):
                     stories_db = MStory.objects(story_hash__in=unread_story_hashes)[:25]
                     stories = Feed.format_stories(stories_db, self.feed_id)
                     
-            unread_stories = []
-            for story in stories:
-                if story['story_date'] < date_delta:
-                    continue
-                if story['story_hash'] in unread_story_hashes:
-                    unread_stories.append(story)
-                    if story['story_date'] < oldest_unread_story_date:
-                        oldest_unread_story_date = story['story_date']
-
             # if not silent:
             #     logging.info(' ---> [%s]    Format stories: %s' % (self.user, datetime.datetime.now() - now))
         
-            classifier_feeds   = list(MClassifierFeed.objects(user_id=self.user_id, feed_id=self.feed_id, social_user_id=0))
-            classifier_authors = list(MClassifierAuthor.objects(user_id=self.user_id, feed_id=self.feed_id))
-            classifier_titles  = list(MClassifierTitle.objects(user_id=self.user_id, feed_id=self.feed_id))
-            classifier_tags    = list(MClassifierTag.objects(user_id=self.user_id, feed_id=self.feed_id))
+            classifier_matcher = ClassifierMatcher.for_user(self.user_id, [self.feed_id])
             
-            if (not len(classifier_feeds) and 
-                not len(classifier_authors) and 
-                not len(classifier_titles) and 
-                not len(classifier_tags)):
+            if not len(classifier_matcher):
                 self.is_trained = False
             
             # if not silent:
             #     logging.info(' ---> [%s]    Classifiers: %s (%s)' % (self.user, datetime.datetime.now() - now, classifier_feeds.count() + classifier_authors.count() + classifier_tags.count() + classifier_titles.count()))
             
-            scores = {
-                'feed': apply_classifier_feeds(classifier_feeds, self.feed),
-            }
-        
-            for story in unread_stories:
-                scores.update({
-                    'author' : apply_classifier_authors(classifier_authors, story),
-                    'tags'   : apply_classifier_tags(classifier_tags, story),
-                    'title'  : apply_classifier_titles(classifier_titles, story),
-                })
-            
-                max_score = max(scores['author'], scores['tags'], scores['title'])
-                min_score = min(scores['author'], scores['tags'], scores['title'])
-                if max_score > 0:
-                    feed_scores['positive'] += 1
-                elif min_score < 0:
-                    feed_scores['negative'] += 1
-                else:
-                    if scores['feed'] > 0:
-                        feed_scores['positive'] += 1
-                    elif scores['feed'] < 0:
-                        feed_scores['negative'] += 1
-                    else:
-                        feed_scores['neutral'] += 1
+            feed_scores, oldest_unread_story_date = self.score_unread_stories(
+                self.feed, stories, unread_story_hashes, date_delta, now, classifier_matcher)
         else:
             # print " ---> Cutoff date: %s" % date_delta
             unread_story_hashes = self.story_hashes(user_id=self.user_id, feed_ids=[self.feed_id],
@@ -870,6 +873,164 @@ class UserSubscription(models.Model):
         
         return self
     
+    @staticmethod
+    def score_unread_stories(feed, stories, unread_story_hashes, date_delta, now, classifier_matcher):
+        feed_scores = dict(negative=0, neutral=0, positive=0)
+        oldest_unread_story_date = now
+        
+        unread_stories = []
+        for story in stories:
+            if story['story_date'] < date_delta:
+                continue
+            if story['story_hash'] in unread_story_hashes:
+                unread_stories.append(story)
+                if story['story_date'] < oldest_unread_story_date:
+                    oldest_unread_story_date = story['story_date']
+
+        scores = {
+            'feed': classifier_matcher.score_feed(feed),
+        }
+    
+        for story in unread_stories:
+            scores.update({
+                'author' : classifier_matcher.score_author(story),
+                'tags'   : classifier_matcher.score_tags(story),
+                'title'  : classifier_matcher.score_title(story),
+            })
+        
+            max_score = max(scores['author'], scores['tags'], scores['title'])
+            min_score = min(scores['author'], scores['tags'], scores['title'])
+            if max_score > 0:
+                feed_scores['positive'] += 1
+            elif min_score < 0:
+                feed_scores['negative'] += 1
+            else:
+                if scores['feed'] > 0:
+                    feed_scores['positive'] += 1
+                elif scores['feed'] < 0:
+                    feed_scores['negative'] += 1
+                else:
+                    feed_scores['neutral'] += 1
+        
+        return feed_scores, oldest_unread_story_date
+    
+    @classmethod
+    def calculate_feed_scores_for_subscribers(cls, feed, user_subs, stories=None, silent=True):
+        """
+        Recalculates unread counts for many subscribers of a single feed at once. Gives the
+        same counts as calling `calculate_feed_scores()` on each subscription, but reads
+        every subscriber's unread stories with one pipelined SDIFF each, fetches all of
+        their classifiers with four queries, and writes the counts back with a bulk update.
+        """
+        now = datetime.datetime.now()
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        if isinstance(user_subs, QuerySet):
+            user_subs = user_subs.select_related('user', 'user__profile')
+        
+        subs = []
+        for sub in user_subs:
+            unread_cutoff = sub.user.profile.unread_cutoff
+            if sub.user.profile.last_seen_on < unread_cutoff:
+                continue
+            # Two weeks in age. If mark_read_date is older, mark old stories as read.
+            if unread_cutoff >= sub.mark_read_date:
+                sub.mark_read_date = unread_cutoff
+            subs.append(sub)
+        if not subs:
+            return []
+        
+        # Matches story_hashes(): unread stories are in F: but not read, and are ranked
+        # by their zF: score, plus the implicit 1 from ZINTERSTORE.
+        current_time = int(time.time() + 60*60*24)
+        story_scores = dict(r.zrangebyscore('zF:%s' % feed.pk, '-inf', current_time - 1, withscores=True))
+        unread_story_hashes = {}
+        read_stories = read_stories_backend()
+        for subs_group in chunks(subs, 500):
+            check_deadline()
+            pipeline = r.pipeline()
+            for sub in subs_group:
+                read_stories.unread_story_hashes(pipeline, sub.user_id, feed.pk)
+            for sub, unread_hashes in zip(subs_group, pipeline.execute()):
+                read_date = int(sub.mark_read_date.strftime('%s'))
+                unread_story_hashes[sub.pk] = sorted(((story_hash, story_scores[story_hash] + 1)
+                                                      for story_hash in unread_hashes
+                                                      if story_scores.get(story_hash, -1) >= read_date),
+                                                     reverse=True, key=lambda h: (h[1], h[0]))
+        
+        trained_subs = [sub for sub in subs if sub.is_trained]
+        classifiers = defaultdict(lambda: defaultdict(list))
+        if trained_subs:
+            if not stories:
+                stories = cache.get('S:v3:%s' % feed.pk)
+            if not stories:
+                trained_story_hashes = set(story_hash for sub in trained_subs
+                                           for story_hash, _ in unread_story_hashes[sub.pk])
+                stories = Feed.format_stories(MStory.objects(story_hash__in=list(trained_story_hashes)),
+                                              feed.pk)
+            
+            user_ids = [sub.user_id for sub in trained_subs]
+            for classifier_type, classifier_cls, params in [
+                ('feeds', MClassifierFeed, dict(social_user_id=0)),
+                ('authors', MClassifierAuthor, {}),
+                ('titles', MClassifierTitle, {}),
+                ('tags', MClassifierTag, {})]:
+                for classifier in classifier_cls.objects(user_id__in=user_ids, feed_id=feed.pk, **params):
+                    classifiers[classifier.user_id][classifier_type].append(classifier)
+        
+        for sub in subs:
+            check_deadline()
+            sub_unread_hashes = unread_story_hashes[sub.pk]
+            if sub.is_trained:
+                sub_classifiers = classifiers[sub.user_id]
+                if not any(sub_classifiers.values()):
+                    sub.is_trained = False
+                date_delta = sub.mark_read_date
+                classifier_matcher = ClassifierMatcher(classifier_feeds=sub_classifiers['feeds'],
+                                                       classifier_authors=sub_classifiers['authors'],
+                                                       classifier_titles=sub_classifiers['titles'],
+                                                       classifier_tags=sub_classifiers['tags'])
+                feed_scores, oldest_unread_story_date = cls.score_unread_stories(
+                    feed, stories or [], set(h for h, _ in sub_unread_hashes), date_delta, now,
+                    classifier_matcher)
+            else:
+                feed_scores = dict(negative=0, neutral=len(sub_unread_hashes), positive=0)
+                oldest_unread_story_date = now
+                if sub_unread_hashes:
+                    oldest_unread_story_date = datetime.datetime.fromtimestamp(sub_unread_hashes[-1][1])
+            
+            sub.unread_count_positive = feed_scores['positive']
+            sub.unread_count_neutral = feed_scores['neutral']
+            sub.unread_count_negative = feed_scores['negative']
+            sub.unread_count_updated = datetime.datetime.now()
+            sub.oldest_unread_story_date = oldest_unread_story_date
+            sub.needs_unread_recalc = False
+        
+        cls.objects.bulk_update(subs, ['unread_count_positive', 'unread_count_neutral',
+                                       'unread_count_negative', 'unread_count_updated',
+                                       'oldest_unread_story_date', 'needs_unread_recalc',
+                                       'is_trained'], batch_size=500)
+        
+        for sub in subs:
+            if (sub.unread_count_positive == 0 and 
+                sub.unread_count_neutral == 0):
+                sub.mark_feed_read()
+        
+        cls.trim_read_stories_for_subscribers(feed, subs, r=r)
+        
+        if not silent or settings.DEBUG:
+            logging.debug('   ---> [%-30s] ~FBUnread counts for ~SB%s~SN subscribers (~SB%s~SN trained) in ~SB%.4s~SN sec' % (
+                          feed.log_title[:30], len(subs), len(trained_subs),
+                          (datetime.datetime.now() - now).total_seconds()))
+        
+        return subs
+    
+    @classmethod
+    def trim_read_stories_for_subscribers(cls, feed, subs, r=None):
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        
+        read_stories_backend().trim(r, feed.pk, [sub.user_id for sub in subs], forget_stale=True)
+    
     @staticmethod
     def score_story(scores):
         max_score = max(scores['author'], scores['tags'], scores['title'])
@@ -915,6 +1076,7 @@ class UserSubscription(models.Model):
         switch_feed_for_classifier(MClassifierAuthor)
         switch_feed_for_classifier(MClassifierFeed)
         switch_feed_for_classifier(MClassifierTag)
+        ClassifierMatcher.bump_classifier_version(self.user_id)
 
         # Switch to original feed for the user subscription
         self.feed = new_feed
@@ -1051,38 +1213,58 @@ class RUserStory:
         ps = redis.Redis(connection_pool=settings.REDIS_PUBSUB_POOL)
         if not username:
             username = User.objects.get(pk=user_id).username
-        # if not r2:
-        #     r2 = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL2)
-        
-        p = r.pipeline()
-        # p2 = r2.pipeline()
-        feed_ids = set()
-        friend_ids = set()
         
         if not isinstance(story_hashes, list):
             story_hashes = [story_hashes]
         
-        single_story = len(story_hashes) == 1
-        
-        for story_hash in story_hashes:
+        feed_story_hashes = defaultdict(list)
+        for story_hash in cls.unique_story_hashes(story_hashes):
             feed_id, _ = MStory.split_story_hash(story_hash)
-            feed_ids.add(feed_id)
-            
-            if single_story:
-                cls.aggregate_mark_read(feed_id)
-            
-            # Find other social feeds with this story to update their counts
-            friend_key = "F:%s:F" % (user_id)
-            share_key = "S:%s" % (story_hash)
-            friends_with_shares = [int(f) for f in s.sinter(share_key, friend_key)]
-            friend_ids.update(friends_with_shares)
-            cls.mark_read(user_id, feed_id, story_hash, social_user_ids=friends_with_shares, r=p, username=username, ps=ps)
+            if not feed_id: continue
+            feed_story_hashes[feed_id].append(story_hash)
+        story_hashes = [story_hash for feed_hashes in feed_story_hashes.values()
+                        for story_hash in feed_hashes]
         
-        p.execute()
-        # p2.execute()
+        if len(story_hashes) == 1:
+            cls.aggregate_mark_read(list(feed_story_hashes.keys())[0])
+        
+        # Find other social feeds with these stories to update their counts
+        social_story_hashes = cls.social_story_hashes(user_id, story_hashes, s=s)
+        cls.bulk_mark_read(user_id, feed_story_hashes, social_story_hashes, r=r)
+        cls.publish_read(ps, username, story_hashes)
         
-        return list(feed_ids), list(friend_ids)
+        return list(feed_story_hashes.keys()), list(social_story_hashes.keys())
 
+    @staticmethod
+    def unique_story_hashes(story_hashes):
+        seen = set()
+        return [h for h in story_hashes if not (h in seen or seen.add(h))]
+
+    @staticmethod
+    def social_story_hashes(user_id, story_hashes, s=None):
+        """ Returns {social_user_id: [story_hash, ...]} for the friends of the user who shared
+        any of the stories, with one pipelined SINTER per story. """
+        if not s:
+            s = redis.Redis(connection_pool=settings.REDIS_POOL)
+        
+        friend_key = "F:%s:F" % (user_id)
+        social_story_hashes = defaultdict(list)
+        for story_hashes_group in chunks(story_hashes, 500):
+            pipeline = s.pipeline()
+            for story_hash in story_hashes_group:
+                pipeline.sinter("S:%s" % story_hash, friend_key)
+            for story_hash, friends_with_shares in zip(story_hashes_group, pipeline.execute()):
+                for social_user_id in friends_with_shares:
+                    social_story_hashes[int(social_user_id)].append(story_hash)
+        
+        return social_story_hashes
+    
+    @staticmethod
+    def publish_read(ps, username, story_hashes):
+        """ One message for all of the stories, which the reader splits on commas. """
+        if not story_hashes: return
+        ps.publish(username, 'story:read:%s' % ','.join(story_hashes))
+    
     @classmethod
     def mark_story_hash_unread(cls, user, story_hash, r=None, s=None, ps=None):
         if not r:
@@ -1117,46 +1299,72 @@ class RUserStory:
         week_of_year = datetime.datetime.now().strftime('%Y-%U')
         feed_read_key = "fR:%s:%s" % (feed_id, week_of_year)
         
-        r.incr(feed_read_key)
-        r.expire(feed_read_key, 2*settings.DAYS_OF_STORY_HASHES*24*60*60)
+        pipeline = r.pipeline()
+        pipeline.incr(feed_read_key)
+        pipeline.expire(feed_read_key, 2*settings.DAYS_OF_STORY_HASHES*24*60*60)
+        pipeline.execute()
         
     @classmethod
     def mark_read(cls, user_id, story_feed_id, story_hash, social_user_ids=None, 
                   aggregated=False, r=None, username=None, ps=None):
+        story_hash = MStory.ensure_story_hash(story_hash, story_feed_id=story_feed_id)
+
+        if not story_hash: return
+        
+        social_story_hashes = dict((social_user_id, [story_hash])
+                                   for social_user_id in social_user_ids or [])
+        cls.bulk_mark_read(user_id, {story_feed_id: [story_hash]}, social_story_hashes,
+                           aggregated=aggregated, r=r)
+        
+        if ps and username:
+            ps.publish(username, 'story:read:%s' % story_hash)
+    
+    @classmethod
+    def bulk_mark_read(cls, user_id, feed_story_hashes, social_story_hashes=None,
+                       aggregated=False, r=None):
+        """ Marks {feed_id: [story_hash, ...]} read for the user, and the stories shared by
+        {social_user_id: [story_hash, ...]} read in those social feeds, in one pipeline.
+        
+        Passing a pipeline as `r` queues the commands on it for the caller to execute.
+        """
         if not r:
             r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
         # if not r2:
         #     r2 = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL2)
         
-        story_hash = MStory.ensure_story_hash(story_hash, story_feed_id=story_feed_id)
-
-        if not story_hash: return
+        story_hashes = [story_hash for feed_hashes in feed_story_hashes.values()
+                        for story_hash in feed_hashes]
+        if not story_hashes: return
         
-        def redis_commands(key):
-            r.sadd(key, story_hash)
-            # r2.sadd(key, story_hash)
-            r.expire(key, settings.DAYS_OF_STORY_HASHES*24*60*60)
+        is_pipeline = isinstance(r, redis.client.Pipeline)
+        p = r if is_pipeline else r.pipeline()
+        
+        def redis_commands(key, story_hashes):
+            p.sadd(key, *story_hashes)
+            # r2.sadd(key, *story_hashes)
+            p.expire(key, settings.DAYS_OF_STORY_HASHES*24*60*60)
             # r2.expire(key, settings.DAYS_OF_STORY_HASHES*24*60*60)
 
         all_read_stories_key = 'RS:%s' % (user_id)
-        redis_commands(all_read_stories_key)
+        redis_commands(all_read_stories_key, story_hashes)
         
-        read_story_key = 'RS:%s:%s' % (user_id, story_feed_id)
-        redis_commands(read_story_key)
+        read_stories = read_stories_backend()
+        for feed_id, feed_hashes in feed_story_hashes.items():
+            read_stories.mark_read(p, user_id, feed_id, feed_hashes)
+            RFeedReaders.mark_read(p, user_id, feed_id, feed_hashes)
         
-        if ps and username:
-            ps.publish(username, 'story:read:%s' % story_hash)
-            
-        if social_user_ids:
-            for social_user_id in social_user_ids:
-                social_read_story_key = 'RS:%s:B:%s' % (user_id, social_user_id)
-                redis_commands(social_read_story_key)
+        for social_user_id, social_hashes in (social_story_hashes or {}).items():
+            social_read_story_key = 'RS:%s:B:%s' % (user_id, social_user_id)
+            redis_commands(social_read_story_key, social_hashes)
         
         if not aggregated:
             key = 'lRS:%s' % user_id
-            r.lpush(key, story_hash)
-            r.ltrim(key, 0, 1000)
-            r.expire(key, settings.DAYS_OF_STORY_HASHES*24*60*60)
+            p.lpush(key, *story_hashes)
+            p.ltrim(key, 0, 1000)
+            p.expire(key, settings.DAYS_OF_STORY_HASHES*24*60*60)
+        
+        if not is_pipeline:
+            p.execute()
     
     @staticmethod
     def story_can_be_marked_read_by_user(story, user):
@@ -1192,8 +1400,7 @@ class RUserStory:
         all_read_stories_key = 'RS:%s' % (user_id)
         redis_commands(all_read_stories_key)
         
-        read_story_key = 'RS:%s:%s' % (user_id, story_feed_id)
-        redis_commands(read_story_key)
+        read_stories_backend().mark_unread(r, user_id, story_feed_id, [story_hash])
         
         read_stories_list_key = 'lRS:%s' % user_id
         r.lrem(read_stories_list_key, 1, story_hash)
@@ -1210,7 +1417,7 @@ class RUserStory:
     def get_stories(user_id, feed_id, r=None):
         if not r:
             r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
-        story_hashes = r.smembers("RS:%s:%s" % (user_id, feed_id))
+        story_hashes = read_stories_backend().read_story_hashes(r, user_id, feed_id)
         return story_hashes
     
     @staticmethod
@@ -1235,15 +1442,12 @@ class RUserStory:
         p = r.pipeline()
         # p2 = r2.pipeline()
         story_hashes = cls.get_stories(user_id, old_feed_id, r=r)
+        new_story_hashes = []
         
         for story_hash in story_hashes:
             _, hash_story = MStory.split_story_hash(story_hash)
             new_story_hash = "%s:%s" % (new_feed_id, hash_story)
-            read_feed_key = "RS:%s:%s" % (user_id, new_feed_id)
-            p.sadd(read_feed_key, new_story_hash)
-            # p2.sadd(read_feed_key, new_story_hash)
-            p.expire(read_feed_key, settings.DAYS_OF_STORY_HASHES*24*60*60)
-            # p2.expire(read_feed_key, settings.DAYS_OF_STORY_HASHES*24*60*60)
+            new_story_hashes.append(new_story_hash)
 
             read_user_key = "RS:%s" % (user_id)
             p.sadd(read_user_key, new_story_hash)
@@ -1251,6 +1455,7 @@ class RUserStory:
             p.expire(read_user_key, settings.DAYS_OF_STORY_HASHES*24*60*60)
             # p2.expire(read_user_key, settings.DAYS_OF_STORY_HASHES*24*60*60)
         
+        read_stories_backend().mark_read(p, user_id, new_feed_id, new_story_hashes)
         p.execute()
         # p2.execute()
         
@@ -1266,14 +1471,11 @@ class RUserStory:
         
         usersubs = UserSubscription.objects.filter(feed_id=feed.pk, last_read_date__gte=feed.unread_cutoff)
         logging.info(" ---> ~SB%s usersubs~SN to switch read story hashes..." % len(usersubs))
+        read_stories = read_stories_backend()
         for sub in usersubs:
-            rs_key = "RS:%s:%s" % (sub.user.pk, feed.pk)
-            read = r.sismember(rs_key, old_hash)
+            read = read_stories.is_read(r, sub.user.pk, feed.pk, old_hash)
             if read:
-                p.sadd(rs_key, new_hash)
-                # p2.sadd(rs_key, new_hash)
-                p.expire(rs_key, settings.DAYS_OF_STORY_HASHES*24*60*60)
-                # p2.expire(rs_key, settings.DAYS_OF_STORY_HASHES*24*60*60)
+                read_stories.mark_read(p, sub.user.pk, feed.pk, [new_hash])
                 
                 read_user_key = "RS:%s" % sub.user.pk
                 p.sadd(read_user_key, new_hash)
@@ -1,4 +1,18 @@
+import time
+import datetime
+import redis
+try:
+    import fakeredis
+    # fakeredis runs Lua scripts with lupa
+    import lupa
+except ImportError:
+    fakeredis = None
 from utils import json_functions as json
+from utils.read_stories import ReadStorySets, ReadStoryBitmaps, read_stories_backend
+from apps.reader.models import UserSubscription, RUserStory
+from apps.rss_feeds.models import Feed, MStory
+from apps.analyzer.models import MClassifierTitle, MClassifierAuthor
+from apps.profile.models import Profile
 from django.test.client import Client
 from django.test import TestCase
 from django.urls import reverse
@@ -147,3 +161,161 @@ class Test_Reader(TestCase):
         compact_folders = usf.folders
 
         self.assertNotEquals(dupe_folders, compact_folders)
+
+    def test_read_stories_backends(self):
+        r = redis.Redis(host=settings.REDIS_STORY['host'], port=6379, db=10, decode_responses=True)
+        r.flushdb()
+        story_hashes = ['99:%06x' % i for i in range(40)]
+        r.sadd('F:99', *story_hashes)
+        r.zadd('zF:99', dict((story_hash, 1000 + i) for i, story_hash in enumerate(story_hashes)))
+
+        for backend in (ReadStorySets, ReadStoryBitmaps):
+            backend.mark_read(r, 1, 99, story_hashes[5:25])
+            backend.mark_unread(r, 1, 99, story_hashes[10:12])
+        for backend in (ReadStorySets, ReadStoryBitmaps):
+            read = set(story_hashes[5:10] + story_hashes[12:25])
+            self.assertEqual(set(backend.read_story_hashes(r, 1, 99)), read)
+            self.assertEqual(set(backend.unread_story_hashes(r, 1, 99)), set(story_hashes) - read)
+            self.assertEqual(backend.read_story_count(r, 1, 99), len(read))
+            self.assertTrue(backend.is_read(r, 1, 99, story_hashes[20]))
+            self.assertFalse(backend.is_read(r, 1, 99, story_hashes[30]))
+
+        r.srem('F:99', *story_hashes[:15])
+        r.zrem('zF:99', *story_hashes[:15])
+        for backend in (ReadStorySets, ReadStoryBitmaps):
+            backend.trim(r, 99, [1], forget_stale=True)
+            self.assertEqual(set(backend.read_story_hashes(r, 1, 99)), set(story_hashes[15:25]))
+            self.assertEqual(backend.read_story_count(r, 1, 99), 10)
+
+        # A bitmap's ordinals live as long as it does, and a bitmap without them is dropped
+        r.expire('FO:99', 5)
+        ReadStoryBitmaps.mark_unread(r, 1, 99, story_hashes[15:16])
+        self.assertTrue(r.ttl('FO:99') > 5)
+        r.delete('FO:99')
+        ReadStoryBitmaps.mark_read(r, 1, 99, story_hashes[30:31])
+        self.assertEqual(ReadStoryBitmaps.read_story_hashes(r, 1, 99), story_hashes[30:31])
+        self.assertFalse(ReadStoryBitmaps.is_read(r, 1, 99, story_hashes[20]))
+        r.flushdb()
+
+    def test_rank_story_hashes(self):
+        # The river script against fakeredis, a test only dependency
+        if not fakeredis:
+            self.skipTest("fakeredis and lupa aren't installed")
+        server = fakeredis.FakeServer()
+        pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=server,
+                                    decode_responses=True)
+        encoded_pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=server)
+        r = redis.Redis(connection_pool=pool)
+        now = int(time.time())
+        feed_ids = [97, 98, 99]
+        for feed_id in feed_ids:
+            story_hashes = ['%s:%06x' % (feed_id, i) for i in range(30)]
+            # A few stories are only in zF:, and the oldest are before the mark read date
+            r.sadd('F:%s' % feed_id, *story_hashes[:25])
+            r.zadd('zF:%s' % feed_id, dict((story_hash, now - 3600 * 3 * i - 60 * feed_id)
+                                           for i, story_hash in enumerate(story_hashes)))
+        mark_read_date = datetime.datetime.now() - datetime.timedelta(hours=50)
+        usersubs = [UserSubscription(user_id=1, feed_id=feed_id, mark_read_date=mark_read_date)
+                    for feed_id in feed_ids]
+
+        for backend_name, backend in (('sets', ReadStorySets), ('bitmaps', ReadStoryBitmaps)):
+            for feed_id in feed_ids:
+                backend.mark_read(r, 1, feed_id, ['%s:%06x' % (feed_id, i) for i in range(2, 8)])
+            for read_filter in ('unread', 'all'):
+                with self.settings(REDIS_STORY_HASH_POOL=pool, REDIS_STORY_HASH_POOL_ENCODED=encoded_pool,
+                                   REDIS_STORY_HASH_TEMP_POOL=pool, READ_STORIES_BACKEND=backend_name):
+                    story_hashes = UserSubscription.story_hashes(1, feed_ids=feed_ids, usersubs=usersubs,
+                                                                 read_filter=read_filter, include_timestamps=True,
+                                                                 group_by_feed=False)
+                    ranked = UserSubscription.rank_story_hashes(1, 'zU:1:river', feed_ids=feed_ids,
+                                                                usersubs=usersubs, read_filter=read_filter)
+                story_hashes.sort(key=lambda story: story[1], reverse=True)
+                self.assertTrue(story_hashes)
+                self.assertEqual(ranked, len(story_hashes))
+                self.assertEqual(r.zrevrange('zU:1:river', 0, -1, withscores=True), story_hashes)
+
+    def test_calculate_feed_scores_for_subscribers(self):
+        pool = redis.ConnectionPool(host=settings.REDIS_STORY['host'], port=6379, db=10, decode_responses=True)
+        r = redis.Redis(connection_pool=pool)
+        r.flushdb()
+        with self.settings(REDIS_STORY_HASH_POOL=pool):
+            now = datetime.datetime.now().replace(microsecond=0)
+            feed = Feed.objects.get(pk=1)
+            Profile.objects.filter(user_id__in=[3, 4]).update(last_seen_on=now)
+            UserSubscription.objects.filter(user_id=3, feed=feed).update(
+                mark_read_date=now - datetime.timedelta(hours=126))
+            UserSubscription.objects.create(user_id=4, feed=feed, mark_read_date=now - datetime.timedelta(hours=78),
+                                            is_trained=True)
+            MClassifierTitle(user_id=4, feed_id=1, title='pacific', score=1).save()
+            MClassifierAuthor(user_id=4, feed_id=1, social_user_id=0, author='Sam', score=-1).save()
+
+            stories = [MStory(story_feed_id=1, story_guid='guid:%s' % i,
+                              story_title='Pacific story %s' % i if i % 3 == 0 else 'Story %s' % i,
+                              story_author_name='Sam' if i % 4 == 0 else 'Alex',
+                              story_permalink='http://example.com/%s' % i,
+                              story_date=now - datetime.timedelta(hours=12 * i)).save()
+                       for i in range(12)]
+            read_stories_backend().mark_read(r, 3, 1, [story.story_hash for story in stories[1:5]])
+            read_stories_backend().mark_read(r, 4, 1, [story.story_hash for story in stories[:3]])
+
+            def unread_counts():
+                return [(sub.unread_count_positive, sub.unread_count_neutral, sub.unread_count_negative,
+                         sub.oldest_unread_story_date, sub.is_trained)
+                        for sub in UserSubscription.objects.filter(feed=feed).order_by('user_id')]
+
+            # Each subscription on its own, then all of them in one batch
+            for sub in UserSubscription.objects.filter(feed=feed):
+                sub.calculate_feed_scores(silent=True)
+            counts = unread_counts()
+            self.assertEqual([count[:3] for count in counts], [(0, 7, 0), (2, 1, 1)])
+
+            UserSubscription.objects.filter(feed=feed).update(unread_count_positive=0, unread_count_neutral=0,
+                                                              unread_count_negative=0, needs_unread_recalc=True,
+                                                              oldest_unread_story_date=now)
+            UserSubscription.calculate_feed_scores_for_subscribers(feed, UserSubscription.objects.filter(feed=feed))
+            self.assertEqual(unread_counts(), counts)
+            r.flushdb()
+
+    def test_bulk_mark_read(self):
+        pool = redis.ConnectionPool(host=settings.REDIS_STORY['host'], port=6379, db=10, decode_responses=True)
+        r = redis.Redis(connection_pool=pool)
+        raw = redis.Redis(host=settings.REDIS_STORY['host'], port=6379, db=10)
+        feed_story_hashes = {98: ['98:%06x' % i for i in range(3)], 99: ['99:%06x' % i for i in range(5)]}
+        social_story_hashes = {7: ['99:000001', '99:000003'], 8: ['98:000002']}
+
+        def stored():
+            values = {}
+            for key in r.keys('*'):
+                key_type = r.type(key)
+                if key_type == 'set':
+                    value = r.smembers(key)
+                elif key_type == 'list':
+                    value = r.lrange(key, 0, -1)
+                elif key_type == 'hash':
+                    value = r.hgetall(key)
+                elif key.startswith(('fRU:', 'fRR:')):
+                    value = r.pfcount(key)
+                else:
+                    value = raw.get(key)
+                values[key] = (value, r.ttl(key) > 0)
+            return values
+
+        for backend in ('sets', 'bitmaps'):
+            with self.settings(REDIS_STORY_HASH_POOL=pool, READ_STORIES_BACKEND=backend):
+                r.flushdb()
+                for feed_id, story_hashes in feed_story_hashes.items():
+                    for story_hash in story_hashes:
+                        RUserStory.mark_read(1, feed_id, story_hash, social_user_ids=[
+                            social_user_id for social_user_id, social_hashes in social_story_hashes.items()
+                            if story_hash in social_hashes])
+                marked_one_at_a_time = stored()
+                r.flushdb()
+                RUserStory.bulk_mark_read(1, feed_story_hashes, social_story_hashes)
+                self.assertEqual(stored(), marked_one_at_a_time)
+                story_hashes = feed_story_hashes[98] + feed_story_hashes[99]
+                self.assertEqual(r.smembers('RS:1'), set(story_hashes))
+                self.assertEqual(r.lrange('lRS:1', 0, -1), story_hashes[::-1])
+                self.assertEqual(r.smembers('RS:1:B:7'), set(social_story_hashes[7]))
+                self.assertEqual(set(read_stories_backend().read_story_hashes(r, 1, 99)),
+                                 set(feed_story_hashes[99]))
+        r.flushdb()
@@ -29,8 +29,7 @@ from mongoengine.queryset import OperationError
 from mongoengine.queryset import NotUniqueError
 from apps.recommendations.models import RecommendedFeed
 from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
-from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds
-from apps.analyzer.models import apply_classifier_authors, apply_classifier_tags
+from apps.analyzer.models import ClassifierMatcher
 from apps.analyzer.models import get_classifiers_for_user, sort_classifiers_by_feed
 from apps.profile.models import Profile, MCustomStyling, MDashboardRiver
 from apps.reader.models import UserSubscription, UserSubscriptionFolders, RUserStory, Feature
@@ -680,9 +679,10 @@ def load_single_feed(request, feed_id):
         stories = Feed.format_stories(mstories) 
     elif usersub and (read_filter == 'unread' or order == 'oldest'):
         stories = usersub.get_stories(order=order, read_filter=read_filter, offset=offset, limit=limit,
-                                      default_cutoff_date=user.profile.unread_cutoff)
+                                      default_cutoff_date=user.profile.unread_cutoff,
+                                      headline=not include_story_content)
     else:
-        stories = feed.get_stories(offset, limit)
+        stories = feed.get_stories(offset, limit, headline=not include_story_content)
     
     checkpoint1 = time.time()
     
@@ -696,20 +696,14 @@ def load_single_feed(request, feed_id):
     # Get intelligence classifier for user
     
     if usersub and usersub.is_trained:
-        classifier_feeds   = list(MClassifierFeed.objects(user_id=user.pk, feed_id=feed_id, social_user_id=0))
-        classifier_authors = list(MClassifierAuthor.objects(user_id=user.pk, feed_id=feed_id))
-        classifier_titles  = list(MClassifierTitle.objects(user_id=user.pk, feed_id=feed_id))
-        classifier_tags    = list(MClassifierTag.objects(user_id=user.pk, feed_id=feed_id))
+        classifier_matcher = ClassifierMatcher.for_user(user.pk, [feed_id])
     else:
-        classifier_feeds = []
-        classifier_authors = []
-        classifier_titles = []
-        classifier_tags = []
+        classifier_matcher = ClassifierMatcher()
     classifiers = get_classifiers_for_user(user, feed_id=feed_id, 
-                                           classifier_feeds=classifier_feeds, 
-                                           classifier_authors=classifier_authors, 
-                                           classifier_titles=classifier_titles,
-                                           classifier_tags=classifier_tags)
+                                           classifier_feeds=classifier_matcher.classifier_feeds, 
+                                           classifier_authors=classifier_matcher.classifier_authors, 
+                                           classifier_titles=classifier_matcher.classifier_titles,
+                                           classifier_tags=classifier_matcher.classifier_tags)
     checkpoint3 = time.time()
     
     unread_story_hashes = []
@@ -742,7 +736,7 @@ def load_single_feed(request, feed_id):
     
     for story in stories:
         if not include_story_content:
-            del story['story_content']
+            story.pop('story_content', None)
         story_date = localtime_for_timezone(story['story_date'], user.profile.timezone)
         nowtz = localtime_for_timezone(now, user.profile.timezone)
         story['short_parsed_date'] = format_story_link_date__short(story_date, nowtz)
@@ -773,12 +767,7 @@ def load_single_feed(request, feed_id):
                 story['shared_comments'] = strip_tags(shared_stories[story['story_hash']]['comments'])
         else:
             story['read_status'] = 1
-        story['intelligence'] = {
-            'feed': apply_classifier_feeds(classifier_feeds, feed),
-            'author': apply_classifier_authors(classifier_authors, story),
-            'tags': apply_classifier_tags(classifier_tags, story),
-            'title': apply_classifier_titles(classifier_titles, story),
-        }
+        story['intelligence'] = classifier_matcher.intelligence(story, feed=feed)
         story['score'] = UserSubscription.score_story(story['intelligence'])
         
     # Intelligence
@@ -1183,33 +1172,18 @@ def folder_rss_feed(request, user_id, secret_token, unread_filter, folder_slug):
     trained_feed_ids = [sub.feed_id for sub in usersubs if sub.is_trained]
     found_trained_feed_ids = list(set(trained_feed_ids) & set(found_feed_ids))    
     if found_trained_feed_ids:
-        classifier_feeds = list(MClassifierFeed.objects(user_id=user.pk,
-                                                        feed_id__in=found_trained_feed_ids,
-                                                        social_user_id=0))
-        classifier_authors = list(MClassifierAuthor.objects(user_id=user.pk, 
-                                                            feed_id__in=found_trained_feed_ids))
-        classifier_titles = list(MClassifierTitle.objects(user_id=user.pk, 
-                                                          feed_id__in=found_trained_feed_ids))
-        classifier_tags = list(MClassifierTag.objects(user_id=user.pk, 
-                                                      feed_id__in=found_trained_feed_ids))
+        # Compiled for every trained feed in the river, so later pages reuse it
+        classifier_matcher = ClassifierMatcher.for_user(user.pk, trained_feed_ids)
     else:
-        classifier_feeds = []
-        classifier_authors = []
-        classifier_titles = []
-        classifier_tags = []
+        classifier_matcher = ClassifierMatcher()
     
     sort_classifiers_by_feed(user=user, feed_ids=found_feed_ids,
-                             classifier_feeds=classifier_feeds,
-                             classifier_authors=classifier_authors,
-                             classifier_titles=classifier_titles,
-                             classifier_tags=classifier_tags)
+                             classifier_feeds=classifier_matcher.classifier_feeds,
+                             classifier_authors=classifier_matcher.classifier_authors,
+                             classifier_titles=classifier_matcher.classifier_titles,
+                             classifier_tags=classifier_matcher.classifier_tags)
     for story in stories:
-        story['intelligence'] = {
-            'feed':   apply_classifier_feeds(classifier_feeds, story['story_feed_id']),
-            'author': apply_classifier_authors(classifier_authors, story),
-            'tags':   apply_classifier_tags(classifier_tags, story),
-            'title':  apply_classifier_titles(classifier_titles, story),
-        }
+        story['intelligence'] = classifier_matcher.intelligence(story)
         story['score'] = UserSubscription.score_story(story['intelligence'])
         if unread_filter == 'focus' and story['score'] >= 1:
             filtered_stories.append(story)
@@ -1385,12 +1359,14 @@ def load_river_stories__redis(request):
     query             = get_post.get('query', '').strip()
     include_hidden    = is_true(get_post.get('include_hidden', False))
     include_feeds     = is_true(get_post.get('include_feeds', False))
+    include_story_content = is_true(get_post.get('include_story_content', True))
     on_dashboard      = is_true(get_post.get('dashboard', False)) or is_true(get_post.get('on_dashboard', False))
     infrequent        = is_true(get_post.get('infrequent', False))
     if infrequent:
         infrequent = get_post.get('infrequent')
     now               = localtime_for_timezone(datetime.datetime.now(), user.profile.timezone)
     usersubs          = []
+    excluded_fields   = MStory.HEADLINE_EXCLUDED_FIELDS if not include_story_content else MStory.UNFORMATTED_FIELDS
     code              = 1
     user_search       = None
     offset            = (page-1) * limit
@@ -1402,8 +1378,8 @@ def load_river_stories__redis(request):
     if story_hashes:
         unread_feed_story_hashes = None
         read_filter = 'all'
-        mstories = MStory.objects(story_hash__in=story_hashes).order_by(story_date_order)
-        stories = Feed.format_stories(mstories)
+        mstories = MStory.objects(story_hash__in=story_hashes).exclude(*excluded_fields).order_by(story_date_order)
+        stories = Feed.format_stories(mstories, headline=not include_story_content)
     elif query:
         if user.profile.is_premium:
             user_search = MUserSearch.get_user(user.pk)
@@ -1413,7 +1389,8 @@ def load_river_stories__redis(request):
             feed_ids = [sub.feed_id for sub in usersubs]
             if infrequent:
                 feed_ids = Feed.low_volume_feeds(feed_ids, stories_per_month=infrequent)
-            stories = Feed.find_feed_stories(feed_ids, query, order=order, offset=offset, limit=limit)
+            stories = Feed.find_feed_stories(feed_ids, query, order=order, offset=offset, limit=limit,
+                                             user_id=user.pk)
             mstories = stories
             unread_feed_story_hashes = UserSubscription.story_hashes(user.pk, feed_ids=feed_ids, 
                                                                      read_filter="unread", order=order, 
@@ -1454,8 +1431,8 @@ def load_river_stories__redis(request):
             story_hashes = []
             unread_feed_story_hashes = []
 
-        mstories = MStory.objects(story_hash__in=story_hashes).order_by(story_date_order)
-        stories = Feed.format_stories(mstories)
+        mstories = MStory.objects(story_hash__in=story_hashes).exclude(*excluded_fields).order_by(story_date_order)
+        stories = Feed.format_stories(mstories, headline=not include_story_content)
     
     found_feed_ids = list(set([story['story_feed_id'] for story in stories]))
     stories, user_profiles = MSharedStory.stories_with_comments_and_profiles(stories, user.pk)
@@ -1486,29 +1463,21 @@ def load_river_stories__redis(request):
     
     # Intelligence classifiers for all feeds involved
     if found_trained_feed_ids:
-        classifier_feeds = list(MClassifierFeed.objects(user_id=user.pk,
-                                                        feed_id__in=found_trained_feed_ids,
-                                                        social_user_id=0))
-        classifier_authors = list(MClassifierAuthor.objects(user_id=user.pk, 
-                                                            feed_id__in=found_trained_feed_ids))
-        classifier_titles = list(MClassifierTitle.objects(user_id=user.pk, 
-                                                          feed_id__in=found_trained_feed_ids))
-        classifier_tags = list(MClassifierTag.objects(user_id=user.pk, 
-                                                      feed_id__in=found_trained_feed_ids))
+        # Compiled for every trained feed in the river, so later pages reuse it
+        classifier_matcher = ClassifierMatcher.for_user(user.pk, trained_feed_ids)
     else:
-        classifier_feeds = []
-        classifier_authors = []
-        classifier_titles = []
-        classifier_tags = []
+        classifier_matcher = ClassifierMatcher()
     classifiers = sort_classifiers_by_feed(user=user, feed_ids=found_feed_ids,
-                                           classifier_feeds=classifier_feeds,
-                                           classifier_authors=classifier_authors,
-                                           classifier_titles=classifier_titles,
-                                           classifier_tags=classifier_tags)
+                                           classifier_feeds=classifier_matcher.classifier_feeds,
+                                           classifier_authors=classifier_matcher.classifier_authors,
+                                           classifier_titles=classifier_matcher.classifier_titles,
+                                           classifier_tags=classifier_matcher.classifier_tags)
     
     # Just need to format stories
     nowtz = localtime_for_timezone(now, user.profile.timezone)
     for story in stories:
+        if not include_story_content:
+            story.pop('story_content', None)
         if read_filter == 'starred':
             story['read_status'] = 1
         else:
@@ -1529,12 +1498,7 @@ def load_river_stories__redis(request):
             story['user_tags'] = starred_stories[story['story_hash']]['user_tags']
             story['user_notes'] = starred_stories[story['story_hash']]['user_notes']
             story['highlights'] = starred_stories[story['story_hash']]['highlights']
-        story['intelligence'] = {
-            'feed':   apply_classifier_feeds(classifier_feeds, story['story_feed_id']),
-            'author': apply_classifier_authors(classifier_authors, story),
-            'tags':   apply_classifier_tags(classifier_tags, story),
-            'title':  apply_classifier_titles(classifier_titles, story),
-        }
+        story['intelligence'] = classifier_matcher.intelligence(story)
         story['score'] = UserSubscription.score_story(story['intelligence'])
     
     if include_feeds:
@@ -1766,17 +1730,15 @@ def mark_story_hashes_as_read(request):
             r.publish(request.user.username, 'social:%s' % socialsub.subscription_user_id)
 
     # Also count on original subscription
-    for feed_id in feed_ids:
-        usersubs = UserSubscription.objects.filter(user=request.user.pk, feed=feed_id)
-        if usersubs:
-            usersub = usersubs[0]
-            usersub.last_read_date = datetime.datetime.now()
-            if not usersub.needs_unread_recalc:
-                usersub.needs_unread_recalc = True
-                usersub.save(update_fields=['needs_unread_recalc', 'last_read_date'])
-            else:
-                usersub.save(update_fields=['last_read_date'])
-            r.publish(request.user.username, 'feed:%s' % feed_id)
+    usersubs = UserSubscription.objects.filter(user=request.user.pk, feed__in=feed_ids)
+    for usersub in usersubs:
+        usersub.last_read_date = datetime.datetime.now()
+        if not usersub.needs_unread_recalc:
+            usersub.needs_unread_recalc = True
+            usersub.save(update_fields=['needs_unread_recalc', 'last_read_date'])
+        else:
+            usersub.save(update_fields=['last_read_date'])
+        r.publish(request.user.username, 'feed:%s' % usersub.feed_id)
     
     hash_count = len(story_hashes)
     logging.user(request, "~FYRead %s %s: %s %s" % (
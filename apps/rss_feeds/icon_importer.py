@@ -3,9 +3,6 @@ import urllib.error
 import urllib.parse
 import lxml.html
 import numpy
-import scipy
-import scipy.misc
-import scipy.cluster
 import struct
 import operator
 import gzip
@@ -20,7 +17,7 @@ from io import BytesIO
 from django.conf import settings
 from django.http import HttpResponse
 from django.contrib.sites.models import Site
-from apps.rss_feeds.models import MFeedPage, MFeedIcon
+from apps.rss_feeds.models import Feed, MFeedPage, MFeedIcon
 from utils.facebook_fetcher import FacebookFetcher
 from utils import log as logging
 from utils.feed_functions import timelimit, TimeoutError
@@ -354,53 +351,79 @@ class IconImporter(object):
         return image
 
     def determine_dominant_color_in_image(self, image):
-        NUM_CLUSTERS = 5
-
-        # Convert image into array of values for each point.
-        if image.mode == '1':
-            image.convert('L')
-        ar = numpy.array(image)
-        # ar = scipy.misc.fromimage(image)
-        shape = ar.shape
-
-        # Reshape array of values to merge color bands. [[R], [G], [B], [A]] => [R, G, B, A]
-        if len(shape) > 2:
-            ar = ar.reshape(scipy.product(shape[:2]), shape[2])
-            
-        # Get NUM_CLUSTERS worth of centroids.
-        ar = ar.astype(numpy.float)
-        codes, _ = scipy.cluster.vq.kmeans(ar, NUM_CLUSTERS)
+        color = self.dominant_color(image)
+        color = self.feed.adjust_color(color, 21)
+
+        return color
 
-        # Pare centroids, removing blacks and whites and shades of really dark and really light.
-        original_codes = codes
+    @classmethod
+    def dominant_color(cls, image):
+        # Count pixels into a fixed palette of 8 shades per channel, weighted by alpha so
+        # transparent pixels don't count, and take the busiest bucket's average color.
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        pixels = numpy.asarray(image, dtype=numpy.uint8).reshape(-1, 4)
+        if not len(pixels):
+            raise ValueError("Empty image")
+        rgb = pixels[:, :3]
+        weights = pixels[:, 3].astype(numpy.float64)
+        if not weights.any():
+            weights = numpy.ones(len(pixels))
+        shades = (rgb >> 5).astype(numpy.intp)
+        buckets = (shades[:, 0] << 6) | (shades[:, 1] << 3) | shades[:, 2]
+        counts = numpy.bincount(buckets, weights=weights, minlength=512)
+        sums = numpy.stack([numpy.bincount(buckets, weights=weights * rgb[:, c], minlength=512)
+                            for c in range(3)], axis=1)
+        found = numpy.flatnonzero(counts)
+        counts = counts[found]
+        colors = sums[found] / counts[:, None]
+        shades = numpy.stack([found >> 6, (found >> 3) & 7, found & 7], axis=1)
+
+        # Pare buckets, removing blacks and whites and shades of really dark and really light.
         for low, hi in [(60, 200), (35, 230), (10, 250)]:
-            codes = scipy.array([code for code in codes
-                                 if not ((code[0] < low and code[1] < low and code[2] < low) or
-                                         (code[0] > hi and code[1] > hi and code[2] > hi))])
-            if not len(codes):
-                codes = original_codes
-            else:
+            usable = ~((colors < low).all(axis=1) | (colors > hi).all(axis=1))
+            if usable.any():
+                counts = counts[usable]
+                colors = colors[usable]
+                shades = shades[usable]
                 break
 
-        # Assign codes (vector quantization). Each vector is compared to the centroids
-        # and assigned the nearest one.
-        vecs, _ = scipy.cluster.vq.vq(ar, codes)
-
-        # Count occurences of each clustered vector.
-        counts, bins = scipy.histogram(vecs, len(codes))
-
-        # Show colors for each code in its hex value.
-        # colors = [''.join(chr(c) for c in code).encode('hex') for code in codes]
-        # total = scipy.sum(counts)
-        # print dict(zip(colors, [count/float(total) for count in counts]))
-
-        # Find the most frequent color, based on the counts.
-        index_max = scipy.argmax(counts)
-        peak = codes.astype(int)[index_max]
-        color = "{:02x}{:02x}{:02x}".format(peak[0], peak[1], peak[2])
-        color = self.feed.adjust_color(color[:6], 21)
-
-        return color
+        # Blend in the buckets next to the busiest one, so a gradient isn't split in two.
+        near = (numpy.abs(shades - shades[counts.argmax()]) <= 1).all(axis=1)
+        peak = (numpy.dot(counts[near], colors[near]) / counts[near].sum()).astype(int)
+        return "{:02x}{:02x}{:02x}".format(peak[0], peak[1], peak[2])
+
+    @classmethod
+    def recolor_feed_icons(cls, feed_ids, verbose=False):
+        """ Measures the stored icons of many feeds again, without fetching them. Returns
+            how many colors changed. """
+        feeds = Feed.objects.in_bulk(feed_ids)
+        feed_icons = MFeedIcon.objects(feed_id__in=feed_ids, not_found__ne=True).only('feed_id', 'color', 'data')
+        changed_feeds = []
+        for feed_icon in feed_icons:
+            feed = feeds.get(feed_icon.feed_id)
+            if not feed or not feed_icon.data:
+                continue
+            try:
+                image = Image.open(BytesIO(base64.b64decode(feed_icon.data)))
+                color = feed.adjust_color(cls.dominant_color(image), 21)
+            except (IOError, IndexError, ValueError, MemoryError, Image.DecompressionBombError):
+                if verbose:
+                    logging.debug("   ---> [%-30s] ~SN~FRFailed to measure icon" % feed.log_title[:30])
+                continue
+            if feed_icon.color != color:
+                MFeedIcon.objects(feed_id=feed_icon.feed_id).update_one(set__color=color)
+            if feed.favicon_color != color:
+                if verbose:
+                    logging.debug("   ---> [%-30s] ~SN~FBIcon color: %s -> %s" % (
+                                  feed.log_title[:30], feed.favicon_color, color))
+                feed.favicon_color = color
+                changed_feeds.append(feed)
+
+        if changed_feeds:
+            Feed.objects.bulk_update(changed_feeds, ['favicon_color'], batch_size=1000)
+
+        return len(changed_feeds)
 
     def string_from_image(self, image):
         output = BytesIO()
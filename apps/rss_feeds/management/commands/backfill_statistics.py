@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.models import Feed, RStoryHistogram
+from apps.analyzer.models import RClassifierCount
+from utils.feed_functions import chunks
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument("-f", "--feed", dest="feed", default=None)
+        parser.add_argument("-o", "--offset", dest="offset", type=int, default=0, help="Resume from this feed id.")
+        parser.add_argument("-b", "--batch-size", dest="batch_size", type=int, default=100, help="Feeds per aggregation.")
+
+    def handle(self, *args, **options):
+        if options['feed']:
+            feed_ids = [int(options['feed'])]
+        else:
+            feed_ids = list(Feed.objects.filter(pk__gte=options['offset'])
+                                        .order_by('pk')
+                                        .values_list('pk', flat=True))
+
+        # Story histograms and classifier counts, rebuilt from scratch
+        for i, feed_id_group in enumerate(chunks(feed_ids, options['batch_size'])):
+            RStoryHistogram.build(feed_id_group)
+            RClassifierCount.build(feed_id_group)
+            print(" ---> %s / %s feeds, resume from offset %s" % (
+                  min((i+1) * options['batch_size'], len(feed_ids)), len(feed_ids), feed_id_group[-1] + 1))
@@ -1,14 +1,19 @@
+import time
 from django.core.management.base import BaseCommand
 from apps.rss_feeds.models import Feed
+from utils.feed_functions import chunks
 
 class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("-f", "--feed", dest="feed", default=None)
         parser.add_argument("-t", "--title", dest="title", default=None)
+        parser.add_argument("-o", "--offset", dest="offset", type=int, default=0, help="Resume from this feed id.")
+        parser.add_argument("-a", "--active", dest="active", action="store_true", help="Only active feeds.")
+        parser.add_argument("-b", "--batch-size", dest="batch_size", type=int, default=2000, help="Feeds per pass.")
         parser.add_argument("-V", "--verbose", dest="verbose", action="store_true")
         parser.add_argument("-D", "--delete", dest="delete", action="store_true")
-  
+
     def handle(self, *args, **options):
         if options['title']:
             feeds = Feed.objects.filter(feed_title__icontains=options['title'])
@@ -16,14 +21,21 @@ class Command(BaseCommand):
             feeds = Feed.objects.filter(pk=options['feed'])
         else:
             feeds = Feed.objects.all()
-            
-        feeds_count = feeds.count()
-        
-        for i in range(0, feeds_count, 100):
-            feeds = Feed.objects.all()[i:i+100]
-            for feed in feeds.iterator():
-                feed.count_subscribers(verbose=options['verbose'])
-        
+        if options['active']:
+            feeds = feeds.filter(active=True)
+        if options['offset']:
+            feeds = feeds.filter(pk__gte=options['offset'])
+
+        feed_ids = list(feeds.order_by('pk').values_list('pk', flat=True))
+        start = time.time()
+        changed = 0
+        for i, feed_id_group in enumerate(chunks(feed_ids, options['batch_size'])):
+            changed += Feed.bulk_count_subscribers(feed_id_group, verbose=options['verbose'])
+            counted = min((i+1) * options['batch_size'], len(feed_ids))
+            elapsed = time.time() - start
+            print(" ---> %s / %s feeds counted, %s changed (%.0f feeds/s), resume from feed %s" % (
+                  counted, len(feed_ids), changed, counted / max(elapsed, 0.001), feed_id_group[-1] + 1))
+
         if options['delete']:
             print("# Deleting old feeds...")
             old_feeds = Feed.objects.filter(num_subscribers=0)
@@ -31,4 +43,4 @@ class Command(BaseCommand):
                 feed.count_subscribers(verbose=True)
                 if feed.num_subscribers == 0:
                     print((' ---> Deleting: [%s] %s' % (feed.pk, feed)))
-                    feed.delete()
\ No newline at end of file
+                    feed.delete()
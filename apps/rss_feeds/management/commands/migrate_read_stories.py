@@ -0,0 +1,27 @@
+import redis
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from utils.read_stories import READ_STORIES_BACKENDS, copy_read_stories
+
+
+class Command(BaseCommand):
+    help = ("Copies read stories between the 'sets' and 'bitmaps' backends. Run it, switch "
+            "READ_STORIES_BACKEND, run it again to copy what was read meanwhile, then run "
+            "it with --delete to remove the old keys.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("-t", "--to", dest="to", default="bitmaps",
+            choices=list(READ_STORIES_BACKENDS.keys()), help="Backend to copy read stories into.")
+        parser.add_argument("-D", "--delete", dest="delete", action="store_true",
+            help="Delete read stories from the other backend once copied.")
+
+    def handle(self, *args, **options):
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        target = READ_STORIES_BACKENDS[options['to']]
+        source = [backend for name, backend in READ_STORIES_BACKENDS.items()
+                  if name != options['to']][0]
+
+        print(" ---> Copying read stories from %s to %s..." % (source.__name__, target.__name__))
+        copied = copy_read_stories(r, source, target, delete=options['delete'])
+        print(" ---> Copied read stories of %s user feeds%s" % (
+              copied, ", deleted the originals" if options['delete'] else ""))
@@ -0,0 +1,30 @@
+import time
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.models import Feed
+from apps.rss_feeds.icon_importer import IconImporter
+from utils.feed_functions import chunks
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument("-f", "--feed", dest="feed", default=None)
+        parser.add_argument("-o", "--offset", dest="offset", type=int, default=0, help="Resume from this feed id.")
+        parser.add_argument("-b", "--batch-size", dest="batch_size", type=int, default=1000, help="Icons per pass.")
+        parser.add_argument("-V", "--verbose", dest="verbose", action="store_true")
+
+    def handle(self, *args, **options):
+        if options['feed']:
+            feed_ids = [int(options['feed'])]
+        else:
+            feed_ids = list(Feed.objects.filter(pk__gte=options['offset'], favicon_not_found=False)
+                                        .order_by('pk')
+                                        .values_list('pk', flat=True))
+
+        start = time.time()
+        changed = 0
+        for i, feed_id_group in enumerate(chunks(feed_ids, options['batch_size'])):
+            changed += IconImporter.recolor_feed_icons(feed_id_group, verbose=options['verbose'])
+            measured = min((i+1) * options['batch_size'], len(feed_ids))
+            elapsed = time.time() - start
+            print(" ---> %s / %s icons measured, %s recolored (%.0f icons/s), resume from feed %s" % (
+                  measured, len(feed_ids), changed, measured / max(elapsed, 0.001), feed_id_group[-1] + 1))
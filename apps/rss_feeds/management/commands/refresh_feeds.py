@@ -28,6 +28,10 @@ class Command(BaseCommand):
             dest='skip', default=0, help='Skip stories per month < #.')
         parser.add_argument('-w', '--workerthreads', type=int, default=4,
             help='Worker threads that will fetch feeds in parallel.')
+        parser.add_argument('-c', '--concurrency', type=int, dest='fetch_concurrency', default=10,
+            help='Feeds each worker downloads concurrently. Use 1 to fetch serially.')
+        parser.add_argument('-H', '--host_concurrency', type=int, dest='fetch_concurrency_per_host', default=2,
+            help='Concurrent downloads allowed against a single host.')
 
     def handle(self, *args, **options):
         if options['daemonize']:
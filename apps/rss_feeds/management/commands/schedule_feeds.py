@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from apps.rss_feeds.models import Feed
+from apps.rss_feeds.scheduler import schedule_feeds
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument("-f", "--feed", dest="feed", default=None)
+        parser.add_argument("-b", "--batch_size", dest="batch_size", type=int, default=1000,
+            help="Feeds loaded and scheduled together.")
+        parser.add_argument("-s", "--skip_scheduling", dest="skip_scheduling", action="store_true",
+            help="Only move feeds that should be fetched sooner than they are scheduled.")
+        parser.add_argument("-V", "--verbose", dest="verbose", action="store_true")
+
+    def handle(self, *args, **options):
+        settings.LOG_TO_STREAM = True
+        if options['feed']:
+            feeds = Feed.objects.filter(pk=options['feed'])
+        else:
+            feeds = Feed.objects.filter(active=True)
+
+        scheduled = schedule_feeds(feeds, batch_size=options['batch_size'],
+                                   skip_scheduling=options['skip_scheduling'],
+                                   verbose=options['verbose'])
+        print(" ---> Scheduled %s feeds" % scheduled)
@@ -6,8 +6,18 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("-f", "--feed", dest="feed", default=None),
+        parser.add_argument("-a", "--all", dest="all", action="store_true", help="Trim every feed.")
+        parser.add_argument("-o", "--offset", dest="offset", type=int, default=0, help="Resume from this feed id.")
+        parser.add_argument("-w", "--workers", dest="workers", type=int, default=4, help="Feeds trimmed at once.")
+        parser.add_argument("-r", "--rate", dest="rate", type=int, default=100, help="Feeds started per second.")
+        parser.add_argument("-D", "--dryrun", dest="dryrun", action="store_true")
 
     def handle(self, *args, **options):
+        if options['all']:
+            Feed.trim_old_stories(start=options['offset'], workers=options['workers'],
+                                  feeds_per_second=options['rate'], dryrun=options['dryrun'])
+            return
+
         if not options['feed']:
             feeds = Feed.objects.filter(
                 fetched_once=True, 
@@ -15,7 +25,7 @@ class Command(BaseCommand):
                 premium_subscribers=0
             )
         else:
-            feeds = Feed.objects.filter(feed_id=options['feed'])
+            feeds = Feed.objects.filter(pk=options['feed'])
 
         for f in queryset_iterator(feeds):
             f.trim_feed(verbose=True)
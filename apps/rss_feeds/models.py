@@ -13,6 +13,7 @@ import base64
 import pymongo
 import html
 import urllib.parse
+import concurrent.futures
 from collections import defaultdict
 from operator import itemgetter
 from bson.objectid import ObjectId
@@ -21,6 +22,7 @@ from bs4 import BeautifulSoup
 from django.db import models
 from django.db import IntegrityError
 from django.conf import settings
+from django.core.cache import cache
 from django.db.models.query import QuerySet
 from django.db.utils import DatabaseError
 from django.urls import reverse
@@ -34,7 +36,8 @@ from mongoengine.errors import ValidationError
 from vendor.timezones.utilities import localtime_for_timezone
 from apps.rss_feeds.tasks import UpdateFeeds, PushFeeds, ScheduleCountTagsForUser
 from apps.rss_feeds.text_importer import TextImporter
-from apps.search.models import SearchStory, SearchFeed
+from apps.rss_feeds.scheduler import fetch_intervals
+from apps.search.models import SearchStory, SearchFeed, SearchStoryIndexer
 from apps.statistics.rstats import RStats
 from utils import json_functions as json
 from utils import feedfinder_forman
@@ -43,12 +46,16 @@ from utils import urlnorm
 from utils import log as logging
 from utils.fields import AutoOneToOneField
 from utils.feed_functions import levenshtein_distance
-from utils.feed_functions import timelimit, TimeoutError
+from utils.feed_functions import timelimit, TimeoutError, check_deadline
 from utils.feed_functions import relative_timesince
 from utils.feed_functions import seconds_timesince
+from utils.feed_functions import chunks
 from utils.story_functions import strip_tags, htmldiff, strip_comments, strip_comments__lxml
+from utils.story_functions import extract_image_sources
 from utils.story_functions import prep_for_search
+from utils.story_functions import ExistingStoryIndex
 from utils.story_functions import create_imageproxy_signed_url
+from utils.story_cache import FormattedStoryCache
 
 ENTRY_NEW, ENTRY_UPDATED, ENTRY_SAME, ENTRY_ERR = list(range(4))
 
@@ -308,13 +315,10 @@ class Feed(models.Model):
     
     def index_stories_for_search(self):
         if self.search_indexed: return
-            
-        stories = MStory.objects(story_feed_id=self.pk)
-        for story in stories:
-            story.index_story_for_search()
-
+        
+        # Marks the feed as search indexed once its stories are searchable
+        SearchStoryIndexer(workers=1).index_feeds([self.pk])
         self.search_indexed = True
-        self.save()
     
     def sync_redis(self):
         return MStory.sync_feed_redis(self.pk)
@@ -607,7 +611,7 @@ class Feed(models.Model):
         if force or (has_new_stories and count_extra):
             self.save_popular_authors()
             self.save_popular_tags()
-            self.save_feed_story_history_statistics()        
+            self.save_feed_story_history_statistics()
     
     def calculate_last_story_date(self):
         last_story_date = None
@@ -810,8 +814,6 @@ class Feed(models.Model):
             from apps.profile.models import Profile
             Profile.count_feed_subscribers(feed_id=self.pk)
         SUBSCRIBER_EXPIRE_DATE = datetime.datetime.now() - datetime.timedelta(days=settings.SUBSCRIBER_EXPIRE)
-        subscriber_expire = int(SUBSCRIBER_EXPIRE_DATE.strftime('%s'))
-        now = int(datetime.datetime.now().strftime('%s'))
         r = redis.Redis(connection_pool=settings.REDIS_FEED_SUB_POOL)
         total = 0
         active = 0
@@ -825,24 +827,8 @@ class Feed(models.Model):
 
         if self.counts_converted_to_redis:
             # For each branched feed, count different subscribers
-            for feed_id in feed_ids:
-                pipeline = r.pipeline()
-                
-                # now+1 ensures `-1` flag will be corrected for later with - 1
-                total_key = "s:%s" % feed_id
-                premium_key = "sp:%s" % feed_id
-                pipeline.zcard(total_key)
-                pipeline.zcount(total_key, subscriber_expire, now+1)
-                pipeline.zcard(premium_key)
-                pipeline.zcount(premium_key, subscriber_expire, now+1)
-
-                results = pipeline.execute()
-            
-                # -1 due to counts_converted_to_redis using key=-1 for last_recount date
-                total += max(0, results[0] - 1)
-                active += max(0, results[1] - 1)
-                premium += max(0, results[2] - 1)
-                active_premium += max(0, results[3] - 1)
+            counts = self.redis_subscriber_counts(feed_ids, r=r)
+            total, active, premium, active_premium = [sum(c) for c in zip(*counts.values())]
                 
             original_num_subscribers = self.num_subscribers
             original_active_subs = self.active_subscribers
@@ -914,6 +900,105 @@ class Feed(models.Model):
                     self.feed_title,
                 ), end=' ')
     
+    @classmethod
+    def redis_subscriber_counts(cls, feed_ids, r=None):
+        """ Returns {feed_id: (total, active, premium, active_premium)} from the s: and sp:
+            subscriber keys of many feeds in a single pipeline. """
+        SUBSCRIBER_EXPIRE_DATE = datetime.datetime.now() - datetime.timedelta(days=settings.SUBSCRIBER_EXPIRE)
+        subscriber_expire = int(SUBSCRIBER_EXPIRE_DATE.strftime('%s'))
+        now = int(datetime.datetime.now().strftime('%s'))
+        if not r:
+            r = redis.Redis(connection_pool=settings.REDIS_FEED_SUB_POOL)
+        
+        feed_ids = list(feed_ids)
+        pipeline = r.pipeline(transaction=False)
+        for feed_id in feed_ids:
+            # now+1 ensures `-1` flag will be corrected for later with - 1
+            total_key = "s:%s" % feed_id
+            premium_key = "sp:%s" % feed_id
+            pipeline.zcard(total_key)
+            pipeline.zcount(total_key, subscriber_expire, now+1)
+            pipeline.zcard(premium_key)
+            pipeline.zcount(premium_key, subscriber_expire, now+1)
+        results = pipeline.execute()
+        
+        # -1 due to counts_converted_to_redis using key=-1 for last_recount date
+        return dict((feed_id, tuple(max(0, count - 1) for count in results[i*4:i*4+4]))
+                    for i, feed_id in enumerate(feed_ids))
+    
+    @classmethod
+    def branched_feed_ids(cls):
+        """ Returns {original feed id: [branched feed ids]}, cached for a few minutes since
+            every feed counted in a pass needs it. """
+        branches = cache.get('feed:branches')
+        if branches is None:
+            branches = defaultdict(list)
+            for feed_id, original_feed_id in cls.objects.filter(branch_from_feed__isnull=False)\
+                                                        .values_list('pk', 'branch_from_feed'):
+                branches[original_feed_id].append(feed_id)
+            branches = dict(branches)
+            cache.set('feed:branches', branches, 60*10)
+        
+        return branches
+    
+    @classmethod
+    def bulk_count_subscribers(cls, feed_ids, verbose=False):
+        """
+        Recounts the subscribers of many feeds at once, reading every feed's and branch's
+        s:/sp: keys in one pipeline and saving the changed counts in one UPDATE. Feeds whose
+        redis counts have expired are recounted one by one with count_subscribers().
+        Returns the number of feeds whose counts changed in the bulk update.
+        """
+        SUBSCRIBER_EXPIRE_DATE = datetime.datetime.now() - datetime.timedelta(days=settings.SUBSCRIBER_EXPIRE)
+        subscriber_expire = int(SUBSCRIBER_EXPIRE_DATE.strftime('%s'))
+        r = redis.Redis(connection_pool=settings.REDIS_FEED_SUB_POOL)
+        branches = cls.branched_feed_ids()
+        fields = ['num_subscribers', 'active_subscribers', 'premium_subscribers', 'active_premium_subscribers']
+        feeds = list(cls.objects.filter(pk__in=feed_ids).only('pk', 'branch_from_feed', *fields))
+        if not feeds:
+            return 0
+        
+        counted_feed_ids = {}
+        for feed in feeds:
+            original_feed_id = feed.branch_from_feed_id or feed.pk
+            counted_feed_ids[feed.pk] = set([original_feed_id] + branches.get(original_feed_id, []))
+        original_feed_ids = list(set(feed.branch_from_feed_id or feed.pk for feed in feeds))
+        
+        pipeline = r.pipeline(transaction=False)
+        for original_feed_id in original_feed_ids:
+            pipeline.zscore("sp:%s" % original_feed_id, -1)
+        last_recounts = dict(zip(original_feed_ids, pipeline.execute()))
+        counts = cls.redis_subscriber_counts(set().union(*counted_feed_ids.values()), r=r)
+        
+        changed_feeds = []
+        recounted = 0
+        for feed in feeds:
+            last_recount = last_recounts[feed.branch_from_feed_id or feed.pk]
+            if not last_recount or last_recount <= subscriber_expire:
+                cls.get_by_id(feed.pk).count_subscribers(verbose=verbose)
+                recounted += 1
+                continue
+            
+            total, active, premium, active_premium = [
+                sum(c) for c in zip(*[counts[feed_id] for feed_id in counted_feed_ids[feed.pk]])]
+            if settings.DOCKERBUILD:
+                # Local installs enjoy 100% active feeds
+                active = total
+            
+            if [total, active, premium, active_premium] != [getattr(feed, field) for field in fields]:
+                feed.num_subscribers = total
+                feed.active_subscribers = active
+                feed.premium_subscribers = premium
+                feed.active_premium_subscribers = active_premium
+                changed_feeds.append(feed)
+        
+        cls.objects.bulk_update(changed_feeds, fields, batch_size=1000)
+        if verbose:
+            logging.debug("   ---> ~SN~FBCounted subscribers of ~SB%s~SN feeds from ~FCredis~FB, "
+                          "~SB%s~SN changed, ~SB%s~SN recounted" % (len(feeds), len(changed_feeds), recounted))
+        
+        return len(changed_feeds)
+    
     def _split_favicon_color(self, color=None):
         if not color:
             color = self.favicon_color
@@ -1016,29 +1101,10 @@ class Feed(models.Model):
         if not current_counts:
             current_counts = []
 
-        # Count stories, aggregate by year and month. Map Reduce!
-        map_f = """
-            function() {
-                var date = (this.story_date.getFullYear()) + "-" + (this.story_date.getMonth()+1);
-                var hour = this.story_date.getUTCHours();
-                var day = this.story_date.getDay();
-                emit(this.story_hash, {'month': date, 'hour': hour, 'day': day});
-            }
-        """
-        reduce_f = """
-            function(key, values) {
-                return values;
-            }
-        """
-        dates = defaultdict(int)
-        hours = defaultdict(int)
-        days = defaultdict(int)
-        results = MStory.objects(story_feed_id=self.pk).map_reduce(map_f, reduce_f, output='inline')
-        for result in results:
-            dates[result.value['month']] += 1
-            hours[int(result.value['hour'])] += 1
-            days[int(result.value['day'])] += 1
-            year = int(re.findall(r"(\d{4})-\d{1,2}", result.value['month'])[0])
+        # Story counts by year and month, kept up to date as stories come and go.
+        dates, hours, days = RStoryHistogram.histogram(self.pk)
+        for month in dates:
+            year = int(re.findall(r"(\d{4})-\d{1,2}", month)[0])
             if year < min_year and year > 2000:
                 min_year = year
         
@@ -1081,50 +1147,9 @@ class Feed(models.Model):
         
         
     def save_classifier_counts(self):
-        from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
-        
-        def calculate_scores(cls, facet):
-            map_f = """
-                function() {
-                    emit(this["%s"], {
-                        pos: this.score>0 ? this.score : 0, 
-                        neg: this.score<0 ? Math.abs(this.score) : 0
-                    });
-                }
-            """ % (facet)
-            reduce_f = """
-                function(key, values) {
-                    var result = {pos: 0, neg: 0};
-                    values.forEach(function(value) {
-                        result.pos += value.pos;
-                        result.neg += value.neg;
-                    });
-                    return result;
-                }
-            """
-            scores = []
-            res = cls.objects(feed_id=self.pk).map_reduce(map_f, reduce_f, output='inline')
-            for r in res:
-                facet_values = dict([(k, int(v)) for k,v in r.value.items()])
-                facet_values[facet] = r.key
-                if facet_values['pos'] + facet_values['neg'] >= 1:
-                    scores.append(facet_values)
-            scores = sorted(scores, key=lambda v: v['neg'] - v['pos'])
-
-            return scores
-        
-        scores = {}
-        for cls, facet in [(MClassifierTitle, 'title'), 
-                           (MClassifierAuthor, 'author'), 
-                           (MClassifierTag, 'tag'), 
-                           (MClassifierFeed, 'feed_id')]:
-            scores[facet] = calculate_scores(cls, facet)
-            if facet == 'feed_id' and scores[facet]:
-                scores['feed'] = scores[facet]
-                del scores['feed_id']
-            elif not scores[facet]:
-                del scores[facet]
-                
+        from apps.analyzer.models import RClassifierCount
+
+        scores = RClassifierCount.scores(self.pk)
         if scores:
             self.data.feed_classifier_counts = json.encode(scores)
             self.data.save()
@@ -1262,12 +1287,14 @@ class Feed(models.Model):
         ret_values = dict(new=0, updated=0, same=0, error=0)
         error_count = self.error_count
         new_story_hashes = [s.get('story_hash') for s in stories]
+        new_stories = []
         
         if settings.DEBUG or verbose:
             logging.debug("   ---> [%-30s] ~FBChecking ~SB%s~SN new/updated against ~SB%s~SN stories" % (
                           self.log_title[:30],
                           len(stories),
                           len(list(existing_stories.keys()))))
+        existing_stories = ExistingStoryIndex(existing_stories, new_story_hashes)
         @timelimit(5)
         def _1(story, story_content, existing_stories, new_story_hashes):
             existing_story, story_has_changed = self._exists_story(story, story_content, 
@@ -1311,16 +1338,7 @@ class Feed(models.Model):
                        story_guid = story.get('guid'),
                        story_tags = story_tags
                 )
-                try:
-                    s.save()
-                    ret_values['new'] += 1
-                    s.publish_to_subscribers()
-                except (IntegrityError, OperationError) as e:
-                    ret_values['error'] += 1
-                    if settings.DEBUG:
-                        logging.info('   ---> [%-30s] ~SN~FRIntegrityError on new story: %s - %s' % (self.feed_title[:30], story.get('guid'), e))
-                if self.search_indexed:
-                    s.index_story_for_search()
+                new_stories.append(s)
             elif existing_story and story_has_changed and not updates_off and ret_values['updated'] < 3:
                 # update story
                 original_content = None
@@ -1398,6 +1416,14 @@ class Feed(models.Model):
                 if verbose:
                     logging.debug("Unchanged story (%s): %s / %s " % (story.get('story_hash'), story.get('guid'), story.get('title')))
         
+        if new_stories:
+            inserted_stories = MStory.bulk_insert(new_stories)
+            ret_values['new'] += len(inserted_stories)
+            ret_values['error'] += len(new_stories) - len(inserted_stories)
+            MStory.publish_stories_to_subscribers(inserted_stories)
+            if self.search_indexed:
+                MStory.bulk_index_for_search(inserted_stories)
+        
         return ret_values
     
     def update_story_with_new_guid(self, existing_story, new_story_guid):
@@ -1469,35 +1495,43 @@ class Feed(models.Model):
             self.save_popular_authors(feed_authors=feed_authors[:-1])
 
     @classmethod
-    def trim_old_stories(cls, start=0, verbose=True, dryrun=False, total=0):
+    def trim_old_stories(cls, start=0, verbose=True, dryrun=False, total=0, workers=4, feeds_per_second=100):
+        """ Trims every feed's stories, `workers` feeds at a time and starting no more than
+            `feeds_per_second` feeds a second. """
         now = datetime.datetime.now()
         month_ago = now - datetime.timedelta(days=settings.DAYS_OF_STORY_HASHES)
-        feed_count = Feed.objects.latest('pk').pk
-
-        for feed_id in range(start, feed_count):
-            if feed_id % 1000 == 0:
-                print("\n\n -------------------------- %s (%s deleted so far) --------------------------\n\n" % (feed_id, total))
-            try:
-                feed = Feed.objects.get(pk=feed_id)
-            except Feed.DoesNotExist:
-                continue
+        last_feed_id = Feed.objects.latest('pk').pk
+        
+        def trim(feed):
             if feed.active_subscribers <= 0 and (not feed.last_story_date or feed.last_story_date < month_ago):
                 months_ago = 6
                 if feed.last_story_date:
                     months_ago = int((now - feed.last_story_date).days / 30.0)
                 cutoff = max(1, 6 - months_ago)
-                if dryrun:
-                    print(" DRYRUN: %s cutoff - %s" % (cutoff, feed))
-                else:
-                    total += MStory.trim_feed(feed=feed, cutoff=cutoff, verbose=verbose)
             else:
-                if dryrun:
-                    print(" DRYRUN: %s/%s cutoff - %s" % (cutoff, feed.story_cutoff, feed))
-                else:
-                    total += feed.trim_feed(verbose=verbose)
-                
+                cutoff = feed.story_cutoff
+            if dryrun:
+                print(" DRYRUN: %s cutoff - %s" % (cutoff, feed))
+                return 0
+            return MStory.trim_feed(feed=feed, cutoff=cutoff, verbose=verbose)
+        
+        started = time.time()
+        deleted = 0
+        next_start = started
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            for feed_id in range(start, last_feed_id + 1, 1000):
+                trims = []
+                for feed in Feed.objects.filter(pk__gte=feed_id, pk__lt=feed_id + 1000).order_by('pk'):
+                    next_start = max(next_start + 1.0 / feeds_per_second, time.time())
+                    time.sleep(max(0, next_start - time.time()))
+                    trims.append(pool.submit(trim, feed))
+                deleted += sum(trim_result.result() for trim_result in trims)
+                elapsed = time.time() - started
+                print("\n\n -------------------------- %s (%s deleted so far, %.1f/sec) --------------------------\n\n" % (
+                      feed_id + 1000, total + deleted, deleted / max(elapsed, 0.001)))
                     
-        print(" ---> Deleted %s stories in total." % total)
+        print(" ---> Deleted %s stories in total." % (total + deleted))
+        return total + deleted
     
     @property
     def story_cutoff(self):
@@ -1562,12 +1596,14 @@ class Feed(models.Model):
         author_stories = MStory.objects.filter(story_feed_id=self.pk, story_author_name__iexact=author)
         logging.debug(" ---> Deleting %s of %s stories in %s by '%s'." % (author_stories.count(), all_stories.count(), self, author))
         author_stories.delete()
+        RStoryHistogram.forget(self.pk)
 
     def purge_tag(self, tag):
         all_stories = MStory.objects.filter(story_feed_id=self.pk)
         tagged_stories = MStory.objects.filter(story_feed_id=self.pk, story_tags__icontains=tag)
         logging.debug(" ---> Deleting %s of %s stories in %s by '%s'." % (tagged_stories.count(), all_stories.count(), self, tag))
         tagged_stories.delete()
+        RStoryHistogram.forget(self.pk)
     
     # @staticmethod
     # def clean_invalid_ids():
@@ -1581,16 +1617,17 @@ class Feed(models.Model):
     #         print "db.stories.remove({\"story_feed_id\": %s, \"_id\": \"%s\"})" % (f, u)
 
         
-    def get_stories(self, offset=0, limit=25, force=False):
-        stories_db = MStory.objects(story_feed_id=self.pk)[offset:offset+limit]
-        stories = self.format_stories(stories_db, self.pk)
+    def get_stories(self, offset=0, limit=25, force=False, headline=False):
+        excluded_fields = MStory.HEADLINE_EXCLUDED_FIELDS if headline else MStory.UNFORMATTED_FIELDS
+        stories_db = MStory.objects(story_feed_id=self.pk).exclude(*excluded_fields)[offset:offset+limit]
+        stories = self.format_stories(stories_db, self.pk, headline=headline)
         
         return stories
     
     @classmethod
-    def find_feed_stories(cls, feed_ids, query, order="newest", offset=0, limit=25):
+    def find_feed_stories(cls, feed_ids, query, order="newest", offset=0, limit=25, user_id=None):
         story_ids = SearchStory.query(feed_ids=feed_ids, query=query, order=order, 
-                                      offset=offset, limit=limit)
+                                      offset=offset, limit=limit, user_id=user_id)
         stories_db = MStory.objects(
             story_hash__in=story_ids
         ).order_by('-story_date' if order == "newest" else 'story_date')
@@ -1606,9 +1643,16 @@ class Feed(models.Model):
         
         # Collect stories, sort by feed
         story_ids = SearchStory.global_query(query, order=order, offset=0, limit=limit)
+        story_feed_ids = set(MStory.split_story_hash(story_hash)[0] for story_hash in story_ids)
+        feeds = dict((feed.pk, feed) for feed in
+                     Feed.objects.filter(pk__in=story_feed_ids).select_related('data'))
+        for feed_id in story_feed_ids - set(feeds):
+            feeds[feed_id] = Feed.get_by_id(feed_id)
+        well_read_scores = cls.well_read_scores(set(feed for feed in feeds.values() if feed))
+        
         for story_hash in story_ids:
             feed_id, story_id = MStory.split_story_hash(story_hash)
-            feed = Feed.get_by_id(feed_id)
+            feed = feeds.get(feed_id)
             if not feed: continue
             if feed.feed_title in seen_feeds:
                 feed_id = feed_title_to_id[feed.feed_title]
@@ -1618,7 +1662,7 @@ class Feed(models.Model):
             if feed_id not in popularity:
                 # feed.update_all_statistics()
                 # classifiers = feed.save_classifier_counts()
-                well_read_score = feed.well_read_score()
+                well_read_score = well_read_scores[feed.pk]
                 popularity[feed_id] = {
                     'feed_title': feed.feed_title,
                     'feed_url': feed.feed_link,
@@ -1646,11 +1690,12 @@ class Feed(models.Model):
                                    reverse=True)
         
         # Extract story authors from feeds
+        stories_db = MStory.objects(story_hash__in=story_ids)
+        stories = dict((story['story_hash'], story) for story in cls.format_stories(stories_db))
         for feed in sorted_popularity:
-            story_ids = feed['story_ids']
-            stories_db = MStory.objects(story_hash__in=story_ids)
-            stories = cls.format_stories(stories_db)
-            for story in stories:
+            feed_stories = [stories[story_hash] for story_hash in feed['story_ids']
+                            if story_hash in stories]
+            for story in feed_stories:
                 story['story_permalink'] = story['story_permalink'][:250]
                 if story['story_authors'] not in feed['authors']:
                     feed['authors'][story['story_authors']] = {
@@ -1700,38 +1745,51 @@ class Feed(models.Model):
             
     def well_read_score(self):
         """Average percentage of stories read vs published across recently active subscribers"""
-        from apps.reader.models import UserSubscription
+        return self.well_read_scores([self])[self.pk]
+    
+    @classmethod
+    def well_read_scores(cls, feeds):
+        """
+        Well read scores of many feeds, from the readers and reads counted in RFeedReaders,
+        in one pipeline and one aggregation over shared stories.
+        """
         from apps.social.models import MSharedStory
-                
-        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
-        p = r.pipeline()
-        
-        shared_stories = MSharedStory.objects(story_feed_id=self.pk).count()
         
-        subscribing_users = UserSubscription.objects.filter(feed_id=self.pk).values('user_id')
-        subscribing_user_ids = [sub['user_id'] for sub in subscribing_users]
-        
-        for user_id in subscribing_user_ids:
-            user_rs = "RS:%s:%s" % (user_id, self.pk)
-            p.scard(user_rs)
+        feeds = list(feeds)
+        if not feeds:
+            return {}
+        feed_ids = [feed.pk for feed in feeds]
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        p = r.pipeline(transaction=False)
         
-        counts = p.execute()
-        counts = [c for c in counts if c > 0]
-        reader_count = len(counts)
+        stats = MSharedStory._get_collection().aggregate([{
+            "$match": {"story_feed_id": {"$in": feed_ids}},
+        }, {
+            "$group": {"_id": "$story_feed_id", "count": {"$sum": 1}},
+        }])
+        shared_stories = dict((stat['_id'], stat['count']) for stat in stats)
         
         now = datetime.datetime.now().strftime('%s')
-        unread_cutoff = self.unread_cutoff.strftime('%s')
-        story_count = len(r.zrangebyscore("zF:%s" % self.pk, max=now, min=unread_cutoff))
-        if reader_count and story_count:
-            average_pct = (sum(counts) / float(reader_count)) / float(story_count)
-        else:
-            average_pct = 0
+        for feed in feeds:
+            RFeedReaders.counts(p, feed.pk)
+            p.zcount("zF:%s" % feed.pk, feed.unread_cutoff.strftime('%s'), now)
+        results = p.execute()
         
-        reach_score = average_pct * reader_count * story_count
+        scores = {}
+        for i, feed in enumerate(feeds):
+            reader_count, read_count, story_count = results[i*3:i*3+3]
+            if reader_count and story_count:
+                average_pct = (read_count / float(reader_count)) / float(story_count)
+            else:
+                average_pct = 0
+            
+            reach_score = average_pct * reader_count * story_count
+            
+            scores[feed.pk] = {'read_pct': average_pct, 'reader_count': reader_count, 
+                               'reach_score': reach_score, 'story_count': story_count,
+                               'share_count': shared_stories.get(feed.pk, 0)}
         
-        return {'read_pct': average_pct, 'reader_count': reader_count, 
-                'reach_score': reach_score, 'story_count': story_count,
-                'share_count': shared_stories}
+        return scores
     
     @classmethod
     def xls_query_popularity(cls, queries, limit):
@@ -1865,21 +1923,78 @@ class Feed(models.Model):
         return stories
         
     @classmethod
-    def format_stories(cls, stories_db, feed_id=None, include_permalinks=False):
+    def format_stories(cls, stories_db, feed_id=None, include_permalinks=False, headline=False):
+        """
+        With `headline`, stories are formatted with a snippet instead of their content, so
+        `stories_db` can skip MStory.HEADLINE_EXCLUDED_FIELDS. Headlines have no
+        has_modifications, which needs the content; clients only read it in the story view.
+        """
+        if headline:
+            return cls.format_headlines(stories_db, feed_id, include_permalinks=include_permalinks)
+        
         stories = []
-
+        stories_db = list(stories_db)
+        for story_db in stories_db:
+            cls.decode_story_content(story_db)
+        cached_contents = FormattedStoryCache.get_many(stories_db)
+        uncached_contents = []
+        
         for story_db in stories_db:
-            story = cls.format_story(story_db, feed_id, include_permalinks=include_permalinks)
+            story_hash = getattr(story_db, 'story_hash', None)
+            content = cached_contents.get(story_hash)
+            if content is None:
+                content = cls.format_story_content(story_db)
+                uncached_contents.append((story_db, content))
+            story = cls.format_story(story_db, feed_id, include_permalinks=include_permalinks,
+                                     content=content)
             stories.append(story)
-            
+        
+        FormattedStoryCache.set_many(uncached_contents)
+        
         return stories
     
     @classmethod
-    def format_story(cls, story_db, feed_id=None, text=False, include_permalinks=False,
-                     show_changes=False):
+    def format_headlines(cls, stories_db, feed_id=None, include_permalinks=False):
+        stories_db = list(stories_db)
+        
+        # Stories saved before snippets were stored need their content once, then keep
+        # the snippet made from it
+        missing_snippets = [story_db.story_hash for story_db in stories_db 
+                            if story_db.story_snippet is None]
+        snippets = {}
+        if missing_snippets:
+            for story_db in MStory.objects(story_hash__in=missing_snippets).only('story_hash', 
+                                                                              'story_content_z', 
+                                                                              'story_latest_content_z'):
+                story_content_z = story_db.story_latest_content_z or story_db.story_content_z
+                story_content = zlib.decompress(story_content_z) if story_content_z else ''
+                snippets[story_db.story_hash] = MStory.snippet_from_content(story_content)
+            for story_hash, snippet in snippets.items():
+                MStory.objects(story_hash=story_hash).update_one(set__story_snippet=snippet)
+        
+        stories = []
+        for story_db in stories_db:
+            snippet = story_db.story_snippet
+            if snippet is None:
+                snippet = snippets.get(story_db.story_hash, '')
+            content = cls.format_story_headline(story_db, snippet)
+            story = cls.format_story(story_db, feed_id, include_permalinks=include_permalinks,
+                                     content=content)
+            stories.append(story)
+        
+        return stories
+    
+    @staticmethod
+    def decode_story_content(story_db):
         if isinstance(story_db.story_content_z, str):
             story_db.story_content_z = base64.b64decode(story_db.story_content_z)
-        
+    
+    @classmethod
+    def format_story_content(cls, story_db, show_changes=False):
+        """
+        The part of format_story() that only depends on the story's content, and is
+        worth caching: decompressing it, deriving a blank title and signing image urls.
+        """
         story_content = ''
         latest_story_content = None
         has_changes = False
@@ -1909,22 +2024,70 @@ class Feed(models.Model):
             if story_title and len(story_title) > 80:
                 story_title = story_title[:80] + '...'
         
+        return {
+            'story_title': story_title,
+            'story_title_blank': blank_story_title,
+            'story_content': story_content,
+            'secure_image_urls': cls.secure_image_urls(story_db.image_urls),
+            'secure_image_thumbnails': cls.secure_image_thumbnails(story_db.image_urls),
+            'has_modifications': has_changes,
+        }
+    
+    @classmethod
+    def format_story_headline(cls, story_db, snippet):
+        story_title = story_db.story_title
+        blank_story_title = False
+        if not story_title:
+            blank_story_title = True
+            story_title = snippet
+            if not story_title and story_db.story_permalink:
+                story_title = story_db.story_permalink
+            if story_title and len(story_title) > 80:
+                story_title = story_title[:80] + '...'
+        
+        return {
+            'story_title': story_title,
+            'story_title_blank': blank_story_title,
+            'story_snippet': snippet,
+            'secure_image_urls': cls.secure_image_urls(story_db.image_urls),
+            'secure_image_thumbnails': cls.secure_image_thumbnails(story_db.image_urls),
+        }
+    
+    @classmethod
+    def format_story(cls, story_db, feed_id=None, text=False, include_permalinks=False,
+                     show_changes=False, content=None):
+        cls.decode_story_content(story_db)
+        
+        if content is None:
+            if show_changes:
+                content = cls.format_story_content(story_db, show_changes=True)
+            else:
+                story_hash = getattr(story_db, 'story_hash', None)
+                content = FormattedStoryCache.get_many([story_db]).get(story_hash)
+                if content is None:
+                    content = cls.format_story_content(story_db)
+                    FormattedStoryCache.set_many([(story_db, content)])
+        
         story                     = {}
         story['story_hash']       = getattr(story_db, 'story_hash', None)
         story['story_tags']       = story_db.story_tags or []
         story['story_date']       = story_db.story_date.replace(tzinfo=None)
         story['story_timestamp']  = story_db.story_date.strftime('%s')
         story['story_authors']    = story_db.story_author_name or ""
-        story['story_title']      = story_title
-        if blank_story_title:
+        story['story_title']      = content['story_title']
+        if content['story_title_blank']:
             story['story_title_blank'] = True
-        story['story_content']    = story_content
+        if 'story_snippet' in content:
+            story['story_snippet']    = content['story_snippet']
+        else:
+            story['story_content']    = content['story_content']
         story['story_permalink']  = story_db.story_permalink
         story['image_urls']       = story_db.image_urls
-        story['secure_image_urls']= cls.secure_image_urls(story_db.image_urls)
-        story['secure_image_thumbnails']= cls.secure_image_thumbnails(story_db.image_urls)
+        story['secure_image_urls']= content['secure_image_urls']
+        story['secure_image_thumbnails']= content['secure_image_thumbnails']
         story['story_feed_id']    = feed_id or story_db.story_feed_id
-        story['has_modifications']= has_changes
+        if 'has_modifications' in content:
+            story['has_modifications']= content['has_modifications']
         story['comment_count']    = story_db.comment_count if hasattr(story_db, 'comment_count') else 0
         story['comment_user_ids'] = story_db.comment_user_ids if hasattr(story_db, 'comment_user_ids') else []
         story['share_count']      = story_db.share_count if hasattr(story_db, 'share_count') else 0
@@ -2015,47 +2178,29 @@ class Feed(models.Model):
         story_in_system = None
         story_has_changed = False
         story_link = self.get_permalink(story)
-        existing_stories_hashes = list(existing_stories.keys())
         story_pub_date = story.get('published')
         # story_published_now = story.get('published_now', False)
         # start_date = story_pub_date - datetime.timedelta(hours=8)
         # end_date = story_pub_date + datetime.timedelta(hours=8)
+        
+        if not isinstance(existing_stories, ExistingStoryIndex):
+            existing_stories = ExistingStoryIndex(existing_stories, new_story_hashes)
+        
+        exact_story = existing_stories.get(story.get('story_hash'))
+        if exact_story:
+            # Story already exists, so no other story can be this one
+            candidate_stories = [exact_story]
+        else:
+            candidate_stories = existing_stories.title_candidates(story.get('title', ""), story_pub_date)
 
-        for existing_story in list(existing_stories.values()):
+        for existing_story in candidate_stories:
+            check_deadline()
             content_ratio = 0
             # existing_story_pub_date = existing_story.story_date
-
-            if isinstance(existing_story.id, str):
-                # Correcting a MongoDB bug
-                existing_story.story_guid = existing_story.id
             
             if story.get('story_hash') == existing_story.story_hash:
                 story_in_system = existing_story
-            elif (story.get('story_hash') in existing_stories_hashes and 
-                story.get('story_hash') != existing_story.story_hash):
-                # Story already exists but is not this one
-                continue
-            elif (existing_story.story_hash in new_story_hashes and
-                  story.get('story_hash') != existing_story.story_hash):
-                  # Story coming up later
-                continue
 
-            if 'story_latest_content_z' in existing_story:
-                existing_story_content = smart_str(zlib.decompress(existing_story.story_latest_content_z))
-            elif 'story_latest_content' in existing_story:
-                existing_story_content = existing_story.story_latest_content
-            elif 'story_content_z' in existing_story:
-                existing_story_content = smart_str(zlib.decompress(existing_story.story_content_z))
-            elif 'story_content' in existing_story:
-                existing_story_content = existing_story.story_content
-            else:
-                existing_story_content = ''
-                
-                  
-            # Title distance + content distance, checking if story changed
-            story_title_difference = abs(levenshtein_distance(story.get('title'),
-                                                              existing_story.story_title))
-            
             title_ratio = difflib.SequenceMatcher(None, story.get('title', ""),
                                                   existing_story.story_title).ratio()
             if title_ratio < .75: continue
@@ -2064,6 +2209,12 @@ class Feed(models.Model):
             # logging.debug('Story pub date: %s %s (%s, %s)' % (existing_story.story_date, story_pub_date, title_ratio, story_timedelta))
             if abs(story_timedelta.days) >= 2: continue
             
+            existing_story_content = existing_stories.content(existing_story)
+            
+            # Title distance + content distance, checking if story changed
+            story_title_difference = abs(levenshtein_distance(story.get('title'),
+                                                              existing_story.story_title))
+            
             seq = difflib.SequenceMatcher(None, story_content, existing_story_content)
             
             similiar_length_min = 1000
@@ -2116,6 +2267,15 @@ class Feed(models.Model):
         #     print 'New/updated story: %s' % (story), 
         return story_in_system, story_has_changed
     
+    @staticmethod
+    def fetch_interval(spd, subs, months_since_last_story, has_push_history, notification_count,
+                       feed_address):
+        """
+        Minutes between fetches, from apps.rss_feeds.scheduler.fetch_intervals() for one feed.
+        """
+        return fetch_intervals([spd], [subs], [months_since_last_story], [has_push_history],
+                               [notification_count], [feed_address])[0].item()
+    
     def get_next_scheduled_update(self, force=False, verbose=True, premium_speed=False):
         if self.min_to_decay and not force and not premium_speed:
             return self.min_to_decay
@@ -2128,83 +2288,16 @@ class Feed(models.Model):
         spd  = self.stories_last_month / 30.0
         subs = (self.active_premium_subscribers + 
                 ((self.active_subscribers - self.active_premium_subscribers) / 10.0))
-        notification_count = MUserFeedNotification.objects.filter(feed_id=self.pk).count()
-        # Calculate sub counts: 
-        #   SELECT COUNT(*) FROM feeds WHERE active_premium_subscribers > 10 AND stories_last_month >= 30;
-        #   SELECT COUNT(*) FROM feeds WHERE active_premium_subscribers > 1 AND active_premium_subscribers < 10 AND stories_last_month >= 30;
-        #   SELECT COUNT(*) FROM feeds WHERE active_premium_subscribers = 1 AND stories_last_month >= 30;
-        # SpD > 1  Subs > 10: t = 6         # 4267   * 1440/6  =      1024080
-        # SpD > 1  Subs > 1:  t = 15        # 18973  * 1440/15 =      1821408
-        # SpD > 1  Subs = 1:  t = 60        # 65503  * 1440/60 =      1572072
-        #   SELECT COUNT(*) FROM feeds WHERE active_premium_subscribers > 1 AND stories_last_month < 30 AND stories_last_month > 0;
-        #   SELECT COUNT(*) FROM feeds WHERE active_premium_subscribers = 1 AND stories_last_month < 30 AND stories_last_month > 0;
-        # SpD < 1  Subs > 1:  t = 60        # 77618  * 1440/60 =      1862832
-        # SpD < 1  Subs = 1:  t = 60 * 12   # 282186 * 1440/(60*12) = 564372
-        #   SELECT COUNT(*) FROM feeds WHERE active_premium_subscribers > 1 AND stories_last_month = 0;
-        #   SELECT COUNT(*) FROM feeds WHERE active_subscribers > 0 AND active_premium_subscribers <= 1 AND stories_last_month = 0;
-        # SpD = 0  Subs > 1:  t = 60 * 3    # 30158  * 1440/(60*3) =  241264
-        # SpD = 0  Subs = 1:  t = 60 * 24   # 514131 * 1440/(60*24) = 514131
-        if spd >= 1:
-            if subs >= 10:
-                total = 6
-            elif subs > 1:
-                total = 15
-            else:
-                total = 45
-        elif spd > 0:
-            if subs > 1:
-                total = 60 - (spd * 60)
-            else:
-                total = 60*6 - (spd * 60*6)
-        elif spd == 0:
-            if subs > 1:
-                total = 60 * 6
-            elif subs == 1:
-                total = 60 * 12
-            else:
-                total = 60 * 24
-            months_since_last_story = seconds_timesince(self.last_story_date) / (60*60*24*30)
-            total *= max(1, months_since_last_story)
-        # updates_per_day_delay = 3 * 60 / max(.25, ((max(0, self.active_subscribers)**.2)
-        #                                             * (self.stories_last_month**0.25)))
-        # if self.active_premium_subscribers > 0:
-        #     updates_per_day_delay /= min(self.active_subscribers+self.active_premium_subscribers, 4)
-        # updates_per_day_delay = int(updates_per_day_delay)
-
-        # Lots of subscribers = lots of updates
-        # 24 hours for 0 subscribers.
-        # 4 hours for 1 subscriber.
-        # .5 hours for 2 subscribers.
-        # .25 hours for 3 subscribers.
-        # 1 min for 10 subscribers.
-        # subscriber_bonus = 6 * 60 / max(.167, max(0, self.active_subscribers)**3)
-        # if self.premium_subscribers > 0:
-        #     subscriber_bonus /= min(self.active_subscribers+self.premium_subscribers, 5)
-        # subscriber_bonus = int(subscriber_bonus)
-
+        notification_count = MUserFeedNotification.feed_notification_count(self.pk)
+        has_push_history = False
         if self.is_push:
-            fetch_history = MFetchHistory.feed(self.pk)
-            if len(fetch_history['push_history']):
-                total = total * 12
+            fetch_history = MFetchHistory.objects(feed_id=self.pk).only('push_history').first()
+            has_push_history = bool(fetch_history and fetch_history.push_history)
+        months_since_last_story = seconds_timesince(self.last_story_date) / (60*60*24*30)
+        
+        total = self.fetch_interval(spd, subs, months_since_last_story, has_push_history,
+                                    notification_count, self.feed_address)
         
-        # Any notifications means a 30 min minumum
-        if notification_count > 0:
-            total = min(total, 30)
-
-        # 4 hour max for premiums, 48 hour max for free
-        if subs >= 1:
-            total = min(total, 60*4*1)
-        else:
-            total = min(total, 60*24*2)
-
-        # Craigslist feeds get 6 hours minimum
-        if 'craigslist' in self.feed_address:
-            total = max(total, 60*6)
-
-        # Twitter feeds get 2 hours minimum
-        if 'twitter' in self.feed_address:
-            total = max(total, 60*2)
-                
         if verbose:
             logging.debug("   ---> [%-30s] Fetched every %s min - Subs: %s/%s/%s Stories/day: %s" % (
                                                 self.log_title[:30], total, 
@@ -2237,10 +2330,12 @@ class Feed(models.Model):
         minutes_to_next_fetch = (delta.seconds + (delta.days * 24 * 3600)) / 60
         if minutes_to_next_fetch > self.min_to_decay or not skip_scheduling:
             self.next_scheduled_update = next_scheduled_update
+            pipeline = r.pipeline(transaction=False)
             if self.active_subscribers >= 1:
-                r.zadd('scheduled_updates', { self.pk: self.next_scheduled_update.strftime('%s') })
-            r.zrem('tasked_feeds', self.pk)
-            r.srem('queued_feeds', self.pk)
+                pipeline.zadd('scheduled_updates', { self.pk: self.next_scheduled_update.strftime('%s') })
+            pipeline.zrem('tasked_feeds', self.pk)
+            pipeline.srem('queued_feeds', self.pk)
+            pipeline.execute()
         
         updated_fields = ['last_update', 'next_scheduled_update']
         if self.min_to_decay != original_min_to_decay:
@@ -2391,12 +2486,41 @@ class MFeedIcon(mongo.Document):
 class MFeedPage(mongo.Document):
     feed_id = mongo.IntField(primary_key=True)
     page_data = mongo.BinaryField()
+    page_hash = mongo.StringField()
     
     meta = {
         'collection': 'feed_pages',
         'allow_inheritance': False,
     }
     
+    # Parts of a page that change on every fetch without the page changing: comments,
+    # scripts and inline ads, nonces and tokens, timestamps, and cache busters in the URLs
+    # of scripts, stylesheets and other assets. Iframes are kept, since a swapped embed is
+    # a real change.
+    VOLATILE_BLOCKS_RE = re.compile(r'<!--.*?-->|<(script|style|noscript)\b[^>]*>.*?</\1\s*>', re.I | re.S)
+    VOLATILE_ATTRS_RE = re.compile(r'\s(?=[nid])(?:nonce|integrity|data-[\w-]*(?:time|date|nonce|token|csrf|stamp)[\w-]*)'
+                                   r'\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s>]+)', re.I)
+    VOLATILE_INPUTS_RE = re.compile(r'<(?:input|meta)\b[^>]*(?:csrf|token|nonce)[^>]*>', re.I)
+    VOLATILE_ASSET_URLS_RE = re.compile(r'(\.(?:js|css|png|jpe?g|gif|svg|webp|ico|woff2?|ttf|eot)\?)([^"\'\s<>]*)', re.I)
+    VOLATILE_PARAMS_RE = re.compile(r'((?:^|&(?:amp;)?)(?:v|ver|version|ts|t|_|cb|cachebust|timestamp|rand)=)[\w.-]*', re.I)
+    VOLATILE_TIMES_RE = re.compile(r'\b(?=\d)(?:\d{4}-\d\d-\d\d[T ]\d\d:\d\d(?::\d\d(?:\.\d+)?)?(?:Z|[+-]\d\d:?\d\d)?'
+                                   r'|\d{1,2}:\d\d(?::\d\d)?\s*(?:[ap]\.?m\.?)?)', re.I)
+
+    @classmethod
+    def hash_page(cls, html):
+        """ A digest of the page with its volatile parts stripped, so a page that only
+            changed its ads or timestamps hashes the same. """
+        html = smart_str(html)
+        html = cls.VOLATILE_BLOCKS_RE.sub('', html)
+        html = cls.VOLATILE_INPUTS_RE.sub('', html)
+        html = cls.VOLATILE_ATTRS_RE.sub('', html)
+        html = cls.VOLATILE_ASSET_URLS_RE.sub(
+            lambda url: url.group(1) + cls.VOLATILE_PARAMS_RE.sub(r'\1', url.group(2)), html)
+        html = cls.VOLATILE_TIMES_RE.sub('', html)
+        html = ' '.join(html.split())
+
+        return hashlib.sha1(html.encode('utf-8')).hexdigest()
+
     def page(self):
         try:
             return zlib.decompress(self.page_data)
@@ -2457,6 +2581,7 @@ class MStory(mongo.Document):
     comment_user_ids         = mongo.ListField(mongo.IntField())
     share_count              = mongo.IntField()
     share_user_ids           = mongo.ListField(mongo.IntField())
+    story_snippet            = mongo.StringField()
 
     meta = {
         'collection': 'stories',
@@ -2472,7 +2597,13 @@ class MStory(mongo.Document):
     
     RE_STORY_HASH = re.compile(r"^(\d{1,10}):(\w{6})$")
     RE_RS_KEY = re.compile(r"^RS:(\d+):(\d+)$")
-
+    
+    SNIPPET_LENGTH = 300
+    # Never read when formatting stories
+    UNFORMATTED_FIELDS = ('story_original_content_z', 'original_text_z', 'original_page_z')
+    # Also skipped when formatting headlines, which use story_snippet instead
+    HEADLINE_EXCLUDED_FIELDS = UNFORMATTED_FIELDS + ('story_content_z', 'story_latest_content_z')
+    
     def __str__(self):
         return f"{self.story_hash}: {self.story_title[:20]} ({len(self.story_content_z)} bytes)"
     
@@ -2497,12 +2628,41 @@ class MStory(mongo.Document):
         return html.unescape(self.story_title)
 
     def save(self, *args, **kwargs):
+        self.prepare_save()
+        created = not self.id
+        previous = None
+        if not created and any(field in self._get_changed_fields() for field in ('story_date', 'story_feed_id')):
+            previous = MStory.objects(id=self.id).only('story_feed_id', 'story_date').first()
+        
+        super(MStory, self).save(*args, **kwargs)
+        
+        self.sync_redis()
+        if created:
+            RStoryHistogram.count_stories([self])
+        elif previous and (previous.story_feed_id, previous.story_date) != (self.story_feed_id, self.story_date):
+            # A story whose date was replaced moves to its new month, hour and day
+            RStoryHistogram.count_stories([previous], delta=-1)
+            RStoryHistogram.count_stories([self])
+        FormattedStoryCache.invalidate(self.story_hash)
+        
+        return self
+    
+    @classmethod
+    def snippet_from_content(cls, story_content):
+        # Long enough for format_story() to derive a blank title from
+        return strip_tags(smart_str(story_content))[:cls.SNIPPET_LENGTH]
+    
+    def prepare_save(self):
         story_title_max = MStory._fields['story_title'].max_length
         story_content_type_max = MStory._fields['story_content_type'].max_length
         self.story_hash = self.feed_guid_hash
         
         self.extract_image_urls()
         
+        snippet_content = self.story_latest_content or self.story_content
+        if snippet_content:
+            self.story_snippet = self.snippet_from_content(snippet_content)
+        
         if self.story_content:
             self.story_content_z = zlib.compress(smart_bytes(self.story_content))
             self.story_content = None
@@ -2516,16 +2676,58 @@ class MStory(mongo.Document):
             self.story_title = self.story_title[:story_title_max]
         if self.story_content_type and len(self.story_content_type) > story_content_type_max:
             self.story_content_type = self.story_content_type[:story_content_type_max]
+    
+    @classmethod
+    def bulk_insert(cls, stories):
+        """ Inserts new stories in a single unordered write, so a duplicate story hash only
+            fails that one story, then adds all of them to redis in one pipeline.
+            Returns the stories that were inserted. """
+        valid_stories = []
+        documents = []
+        for story in stories:
+            story.prepare_save()
+            try:
+                story.validate()
+            except ValidationError as e:
+                logging.debug('   ---> ~SN~FRValidationError on new story: %s - %s' % (story.story_hash, e))
+                continue
+            valid_stories.append(story)
+            documents.append(story.to_mongo())
+        if not documents:
+            return []
         
-        super(MStory, self).save(*args, **kwargs)
+        failed = set()
+        try:
+            cls._get_collection().insert_many(documents, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                failed.add(error['index'])
+                if settings.DEBUG or error.get('code') != 11000:
+                    logging.debug('   ---> ~SN~FRError on new story: %s - %s' % (
+                                  valid_stories[error['index']].story_guid, error.get('errmsg')))
+        
+        inserted_stories = []
+        for i, (story, document) in enumerate(zip(valid_stories, documents)):
+            if i in failed: continue
+            story.id = document['_id']
+            story._created = False
+            story._clear_changed_fields()
+            inserted_stories.append(story)
         
-        self.sync_redis()
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        p = r.pipeline()
+        for story in inserted_stories:
+            story.sync_redis(r=p)
+        p.execute()
+        RStoryHistogram.count_stories(inserted_stories)
         
-        return self
+        return inserted_stories
     
     def delete(self, *args, **kwargs):
         self.remove_from_redis()
         self.remove_from_search_index()
+        if self.id:
+            RStoryHistogram.count_stories([self], delta=-1)
         
         super(MStory, self).delete(*args, **kwargs)
     
@@ -2536,6 +2738,18 @@ class MStory(mongo.Document):
         except redis.ConnectionError:
             logging.debug("   ***> [%-30s] ~BMRedis is unavailable for real-time." % (Feed.get_by_id(self.story_feed_id).title[:30],))
     
+    @classmethod
+    def publish_stories_to_subscribers(cls, stories):
+        if not stories: return
+        try:
+            r = redis.Redis(connection_pool=settings.REDIS_PUBSUB_POOL)
+            p = r.pipeline(transaction=False)
+            for story in stories:
+                p.publish("%s:story" % (story.story_feed_id), '%s,%s' % (story.story_hash, story.story_date.strftime('%s')))
+            p.execute()
+        except redis.ConnectionError:
+            logging.debug("   ***> [%-30s] ~BMRedis is unavailable for real-time." % (Feed.get_by_id(stories[0].story_feed_id).title[:30],))
+    
     @classmethod
     def purge_feed_stories(cls, feed, cutoff, verbose=True):
         stories = cls.objects(story_feed_id=feed.pk)
@@ -2544,38 +2758,49 @@ class MStory(mongo.Document):
             logging.debug(" ***> ~FRToo many stories in %s, not purging..." % (feed))
             return
         stories.delete()
+        RStoryHistogram.forget(feed.pk)
     
     @classmethod
-    def index_all_for_search(cls, offset=0):
+    def index_all_for_search(cls, offset=0, batch_size=500, workers=4):
         if not offset:
             SearchStory.create_elasticsearch_mapping(delete=True)
         
-        last_pk = Feed.objects.latest('pk').pk
-        for f in range(offset, last_pk, 1000):
-            print(" ---> %s / %s (%.2s%%)" % (f, last_pk, float(f)/last_pk*100))
-            feeds = Feed.objects.filter(pk__in=list(range(f, f+1000)), 
-                                        active=True,
-                                        active_subscribers__gte=1)\
-                                .values_list('pk')
-            for f, in feeds:
-                stories = cls.objects.filter(story_feed_id=f)
-                if not len(stories):
-                    continue
-                print(f"Indexing {len(stories)} stories in feed {f}")
-                for story in stories:
-                    story.index_story_for_search()
+        feed_ids = list(Feed.objects.filter(pk__gte=offset,
+                                            active=True,
+                                            active_subscribers__gte=1)
+                                    .order_by('pk')
+                                    .values_list('pk', flat=True))
+        indexer = SearchStoryIndexer(batch_size=batch_size, workers=workers, processes=True,
+                                     feeds_per_group=100)
+        done = [0]
+        
+        def progress(feed_id_group):
+            done[0] += len(feed_id_group)
+            print(" ---> %s / %s feeds (%.2s%%), %s stories, %s failed, resume from offset %s" % (
+                  done[0], len(feed_ids), float(done[0])/len(feed_ids)*100,
+                  indexer.indexed, indexer.failed, feed_id_group[-1] + 1))
+        
+        indexer.index_feeds(feed_ids, progress=progress, force=True)
 
     def index_story_for_search(self):
+        SearchStory.index(**self.search_document())
+    
+    @classmethod
+    def bulk_index_for_search(cls, stories):
+        SearchStory.bulk_index([story.search_document() for story in stories])
+    
+    def search_document(self):
         story_content = self.story_content or ""
         if self.story_content_z:
-            story_content = zlib.decompress(self.story_content_z)
-        SearchStory.index(story_hash=self.story_hash, 
-                          story_title=self.story_title, 
-                          story_content=prep_for_search(story_content), 
-                          story_tags=self.story_tags, 
-                          story_author=self.story_author_name, 
-                          story_feed_id=self.story_feed_id, 
-                          story_date=self.story_date)
+            story_content = smart_str(zlib.decompress(self.story_content_z))
+        
+        return dict(story_hash=self.story_hash, 
+                    story_title=self.story_title, 
+                    story_content=prep_for_search(story_content), 
+                    story_tags=self.story_tags, 
+                    story_author=self.story_author_name, 
+                    story_feed_id=self.story_feed_id, 
+                    story_date=self.story_date)
     
     def remove_from_search_index(self):
         try:
@@ -2585,6 +2810,9 @@ class MStory(mongo.Document):
 
     @classmethod
     def trim_feed(cls, cutoff, feed_id=None, feed=None, verbose=True):
+        """ Deletes a feed's stories beyond its newest `cutoff`, keeping shared stories.
+            The stories go in one delete_many, their F:/zF: hashes in one pipeline and their
+            search documents in one bulk request. Returns the number of stories deleted. """
         extra_stories_count = 0
         cutoff = int(cutoff)
         if not feed_id and not feed:
@@ -2599,9 +2827,10 @@ class MStory(mongo.Document):
             story_feed_id=feed_id
         ).only('story_date').order_by('-story_date')
         
-        if stories.count() > cutoff:
+        story_count = stories.count()
+        if story_count > cutoff:
             logging.debug('   ---> [%-30s] ~FMFound %s stories. Trimming to ~SB%s~SN...' %
-                          (str(feed)[:30], stories.count(), cutoff))
+                          (str(feed)[:30], story_count, cutoff))
             try:
                 story_trim_date = stories[cutoff].story_date
                 if story_trim_date == stories[0].story_date:
@@ -2610,25 +2839,53 @@ class MStory(mongo.Document):
             except IndexError as e:
                 logging.debug(' ***> [%-30s] ~BRError trimming feed: %s' % (str(feed)[:30], e))
                 return extra_stories_count
-                
-            extra_stories = cls.objects(story_feed_id=feed_id, 
-                                        story_date__lte=story_trim_date)
-            extra_stories_count = extra_stories.count()
-            shared_story_count = 0
-            for story in extra_stories:
-                if story.share_count: 
-                    shared_story_count += 1
-                    extra_stories_count -= 1
-                    continue
-                story.delete()
+            
+            extra_stories = list(cls._get_collection().find({
+                'story_feed_id': feed_id,
+                'story_date': {'$lte': story_trim_date},
+            }, projection={'story_hash': True, 'story_date': True, 'share_count': True}))
+            shared_story_count = len([story for story in extra_stories if story.get('share_count')])
+            extra_stories = [story for story in extra_stories if not story.get('share_count')]
+            extra_stories_count = cls.delete_stories(feed_id, extra_stories)
             if verbose:
-                existing_story_count = cls.objects(story_feed_id=feed_id).count()
                 logging.debug("   ---> Deleted %s stories, %s (%s shared) left." % (
                                 extra_stories_count,
-                                existing_story_count,
+                                story_count - extra_stories_count,
                                 shared_story_count))
 
         return extra_stories_count
+    
+    @classmethod
+    def delete_stories(cls, feed_id, stories):
+        """ Deletes raw story documents (with _id, story_hash and story_date) of a feed,
+            along with their redis hashes, search documents and histogram counts. """
+        if not stories:
+            return 0
+        
+        deleted = 0
+        for story_group in chunks(stories, 1000):
+            result = cls._get_collection().delete_many({
+                '_id': {'$in': [story['_id'] for story in story_group]}
+            })
+            deleted += result.deleted_count
+        
+        story_hashes = [story['story_hash'] for story in stories]
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        p = r.pipeline()
+        for story_hash_group in chunks(story_hashes, 1000):
+            p.srem('F:%s' % feed_id, *story_hash_group)
+            p.zrem('zF:%s' % feed_id, *story_hash_group)
+        p.execute()
+        
+        try:
+            SearchStory.bulk_remove(story_hashes)
+        except Exception:
+            pass
+        
+        RStoryHistogram.count_stories([cls(story_feed_id=feed_id, story_date=story['story_date'])
+                                       for story in stories], delta=-1)
+        
+        return deleted
         
     @classmethod
     def find_story(cls, story_feed_id=None, story_id=None, story_hash=None, original_only=False):
@@ -2788,33 +3045,22 @@ class MStory(mongo.Document):
         self.share_user_ids = [s['user_id'] for s in shares]
         self.save()
     
-    def extract_image_urls(self, force=False, text=False):
+    def extract_image_urls(self, force=False, text=False, story_content=None):
         if self.image_urls and not force and not text:
             return self.image_urls
         
-        story_content = None
-        if not text:
-            story_content = self.story_content
-            if not story_content and self.story_content_z:
-                story_content = zlib.decompress(self.story_content_z)
-        elif text:
-            if self.original_text_z:
-                story_content = zlib.decompress(self.original_text_z)
+        if not story_content:
+            if not text:
+                story_content = self.story_content
+                if not story_content and self.story_content_z:
+                    story_content = zlib.decompress(self.story_content_z)
+            elif text:
+                if self.original_text_z:
+                    story_content = zlib.decompress(self.original_text_z)
         if not story_content:
             return
         
-        try:
-            soup = BeautifulSoup(story_content, features="lxml")
-        except UserWarning as e:
-            logging.debug(" ---> ~FBWarning on BS4: ~SB%s" % str(e)[:100])
-            return
-        except ValueError:
-            if not text:
-                return self.extract_image_urls(force=force, text=True)
-            else:
-                return
-
-        images = soup.findAll('img')
+        images = extract_image_sources(story_content)
         if not images:
             if not text:
                 return self.extract_image_urls(force=force, text=True)
@@ -2825,8 +3071,7 @@ class MStory(mongo.Document):
         if not image_urls:
             image_urls = []
             
-        for image in images:
-            image_url = image.get('src')
+        for image_url in images:
             if not image_url:
                 continue
             if image_url and len(image_url) >= 1024:
@@ -2850,26 +3095,23 @@ class MStory(mongo.Document):
                 urls.append(url)
             image_urls = urls
         
-        ordered_image_urls = []
-        for image_url in list(set(image_urls)):
-            if 'feedburner' in image_url:
-                ordered_image_urls.append(image_url)
-            else:
-                ordered_image_urls.insert(0, image_url)
-        image_urls = ordered_image_urls
+        # Deduped in the order the images appear, feedburner's last
+        image_urls = list(dict.fromkeys(u for u in image_urls if u))
+        image_urls = ([u for u in image_urls if 'feedburner' not in u] +
+                      [u for u in image_urls if 'feedburner' in u])
         
         if len(image_urls):
-            self.image_urls = [u for u in image_urls if u]
+            self.image_urls = image_urls
         else:
             return
         
         max_length = MStory.image_urls.field.max_length
-        while len(''.join(self.image_urls)) > max_length:
-            if len(self.image_urls) <= 1:
-                self.image_urls[0] = self.image_urls[0][:max_length-1]
+        length = 0
+        for i, image_url in enumerate(self.image_urls):
+            length += len(image_url)
+            if length > max_length:
+                self.image_urls = self.image_urls[:i] or [image_url[:max_length-1]]
                 break
-            else:
-                self.image_urls.pop()
 
         return self.image_urls
 
@@ -2882,7 +3124,7 @@ class MStory(mongo.Document):
             ti = TextImporter(self, feed=feed, request=request, debug=debug)
             original_doc = ti.fetch(return_document=True)
             original_text = original_doc.get('content') if original_doc else None
-            self.extract_image_urls(force=force, text=True)
+            self.extract_image_urls(force=force, text=True, story_content=original_text)
             self.save()
         else:
             logging.user(request, "~FYFetching ~FGoriginal~FY story text, ~SBfound.")
@@ -2903,6 +3145,136 @@ class MStory(mongo.Document):
         return original_page
 
 
+class RFeedReaders:
+    """
+    Approximately how many users read each feed and how many of its stories they read over
+    the last DAYS_OF_STORY_HASHES days, kept as daily HyperLogLogs of user ids
+    (fRU:<feed_id>:<YYYYMMDD>) and of user:story_hash reads (fRR:<feed_id>:<YYYYMMDD>) as
+    stories are marked read. Marking a story unread doesn't take it back out.
+    """
+
+    @classmethod
+    def days(cls):
+        today = datetime.datetime.utcnow()
+        return [(today - datetime.timedelta(days=days)).strftime('%Y%m%d')
+                for days in range(settings.DAYS_OF_STORY_HASHES)]
+
+    @classmethod
+    def mark_read(cls, p, user_id, feed_id, story_hashes):
+        day = datetime.datetime.utcnow().strftime('%Y%m%d')
+        readers_key = "fRU:%s:%s" % (feed_id, day)
+        reads_key = "fRR:%s:%s" % (feed_id, day)
+        p.pfadd(readers_key, user_id)
+        p.pfadd(reads_key, *["%s:%s" % (user_id, story_hash) for story_hash in story_hashes])
+        p.expire(readers_key, (settings.DAYS_OF_STORY_HASHES+1)*24*60*60)
+        p.expire(reads_key, (settings.DAYS_OF_STORY_HASHES+1)*24*60*60)
+
+    @classmethod
+    def counts(cls, p, feed_id):
+        """ Queues the reader count and the read count of the feed. """
+        days = cls.days()
+        p.pfcount(*["fRU:%s:%s" % (feed_id, day) for day in days])
+        p.pfcount(*["fRR:%s:%s" % (feed_id, day) for day in days])
+
+
+class RStoryHistogram:
+    """
+    Counts of a feed's stories by month, hour and day of the week, kept in a redis hash as
+    stories are inserted and deleted, so statistics don't have to scan every story.
+    Fields are m:<YYYY-M>, h:<UTC hour> and d:<day>, 0 being Sunday. The built field marks
+    a hash that was backfilled from the stories themselves, incremented counts alone may
+    be missing older stories.
+    """
+
+    @classmethod
+    def key(cls, feed_id):
+        return "fSH:%s" % feed_id
+
+    @classmethod
+    def buckets(cls, story_date):
+        return ("m:%s-%s" % (story_date.year, story_date.month),
+                "h:%s" % story_date.hour,
+                "d:%s" % ((story_date.weekday() + 1) % 7))
+
+    @classmethod
+    def count_stories(cls, stories, delta=1):
+        r = redis.Redis(connection_pool=settings.REDIS_STATISTICS_POOL)
+        p = r.pipeline(transaction=False)
+        for story in stories:
+            if not story.story_date: continue
+            for field in cls.buckets(story.story_date):
+                p.hincrby(cls.key(story.story_feed_id), field, delta)
+        try:
+            p.execute()
+        except redis.ConnectionError:
+            logging.debug(" ***> ~FRRedis is unavailable for story histograms.")
+
+    @classmethod
+    def forget(cls, feed_id):
+        """ For stories deleted in bulk, rebuilt from the remaining stories when next read. """
+        r = redis.Redis(connection_pool=settings.REDIS_STATISTICS_POOL)
+        r.delete(cls.key(feed_id))
+
+    @classmethod
+    def build(cls, feed_ids):
+        """ Backfills the histograms of many feeds with one aggregation over their stories. """
+        feed_ids = [int(feed_id) for feed_id in feed_ids]
+        histograms = dict((feed_id, {'built': 1}) for feed_id in feed_ids)
+        stats = MStory._get_collection().aggregate([{
+            "$match": {"story_feed_id": {"$in": feed_ids}, "story_date": {"$type": "date"}},
+        }, {
+            "$group": {
+                "_id": {
+                    "feed_id": "$story_feed_id",
+                    "year": {"$year": "$story_date"},
+                    "month": {"$month": "$story_date"},
+                    "hour": {"$hour": "$story_date"},
+                    "day": {"$dayOfWeek": "$story_date"},
+                },
+                "count": {"$sum": 1},
+            },
+        }])
+        for stat in stats:
+            bucket = stat['_id']
+            histogram = histograms[bucket['feed_id']]
+            for field in ("m:%s-%s" % (bucket['year'], bucket['month']),
+                          "h:%s" % bucket['hour'],
+                          "d:%s" % (bucket['day'] - 1)):
+                histogram[field] = histogram.get(field, 0) + stat['count']
+
+        r = redis.Redis(connection_pool=settings.REDIS_STATISTICS_POOL)
+        p = r.pipeline()
+        for feed_id, histogram in histograms.items():
+            p.delete(cls.key(feed_id))
+            p.hset(cls.key(feed_id), mapping=histogram)
+        p.execute()
+
+        return histograms
+
+    @classmethod
+    def histogram(cls, feed_id):
+        """ Returns dicts of story counts by month ('YYYY-M'), hour and day. """
+        r = redis.Redis(connection_pool=settings.REDIS_STATISTICS_POOL)
+        histogram = r.hgetall(cls.key(feed_id))
+        if not histogram.get('built'):
+            histogram = cls.build([feed_id])[int(feed_id)]
+
+        months = {}
+        hours = {}
+        days = {}
+        for field, count in histogram.items():
+            if field == 'built' or not int(count): continue
+            bucket, value = field.split(':', 1)
+            if bucket == 'm':
+                months[value] = int(count)
+            elif bucket == 'h':
+                hours[int(value)] = int(count)
+            elif bucket == 'd':
+                days[int(value)] = int(count)
+
+        return months, hours, days
+
+
 class MStarredStory(mongo.DynamicDocument):
     """Like MStory, but not inherited due to large overhead of _cls and _type in
        mongoengine's inheritance model on every single row."""
@@ -3450,6 +3822,7 @@ def merge_feeds(original_feed_id, duplicate_feed_id, force=False):
         duplicate_stories.delete()
         
     delete_story_feed(MStory, 'story_feed_id')
+    RStoryHistogram.forget(duplicate_feed.pk)
     delete_story_feed(MFeedPage, 'feed_id')
 
     try:
@@ -281,6 +281,13 @@ class PageImporter(object):
         if not html or len(html) < 100:
             return
         
+        # Only the digest is compared, so an unchanged page is neither decompressed nor uploaded
+        page_hash = MFeedPage.hash_page(html)
+        feed_page = MFeedPage.objects(feed_id=self.feed.pk).only('feed_id', 'page_hash').first()
+        if feed_page and feed_page.page_hash == page_hash:
+            logging.debug('   ---> [%-30s] ~FYNo change in page data: %s' % (self.feed.log_title[:30], self.feed.feed_link))
+            return feed_page
+        
         if settings.BACKED_BY_AWS.get('pages_on_node'):
             saved = self.save_page_node(html)
             if saved and self.feed.s3_page and settings.BACKED_BY_AWS.get('pages_on_s3'):
@@ -289,19 +296,17 @@ class PageImporter(object):
         if settings.BACKED_BY_AWS.get('pages_on_s3') and not saved:
             saved = self.save_page_s3(html)
             
-        if not saved:
+        if saved:
+            MFeedPage.objects(feed_id=self.feed.pk).update_one(set__page_hash=page_hash, upsert=True)
+        else:
+            if not feed_page:
+                feed_page = MFeedPage(feed_id=self.feed.pk)
+            feed_page.page_data = zlib.compress(smart_bytes(html))
+            feed_page.page_hash = page_hash
             try:
-                feed_page = MFeedPage.objects.get(feed_id=self.feed.pk)
-                # feed_page.page_data = html.encode('utf-8')
-                if feed_page.page() == html:
-                    logging.debug('   ---> [%-30s] ~FYNo change in page data: %s' % (self.feed.log_title[:30], self.feed.feed_link))
-                else:
-                    # logging.debug('   ---> [%-30s] ~FYChange in page data: %s (%s/%s %s/%s)' % (self.feed.log_title[:30], self.feed.feed_link, type(html), type(feed_page.page()), len(html), len(feed_page.page())))
-                    feed_page.page_data = zlib.compress(smart_bytes(html))
-                    feed_page.save()
-            except MFeedPage.DoesNotExist:
-                feed_page = MFeedPage.objects.create(feed_id=self.feed.pk, 
-                                                     page_data=zlib.compress(smart_bytes(html)))
+                feed_page.save()
+            except NotUniqueError:
+                pass
             return feed_page
     
     def save_page_node(self, html):
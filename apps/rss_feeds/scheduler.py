@@ -0,0 +1,201 @@
+import datetime
+import time
+import numpy
+import redis
+from django.conf import settings
+from utils import log as logging
+from utils.feed_functions import chunks
+
+MAX_ERROR_INTERVAL = 60*24*7
+
+
+def fetch_intervals(spd, subs, months_since_last_story, has_push_history, notification_counts,
+                    feed_addresses):
+    """
+    Minutes between fetches, over arrays with one entry per feed. Feed.fetch_interval()
+    calls this for a single feed.
+    """
+    spd = numpy.asarray(spd, dtype=float)
+    subs = numpy.asarray(subs, dtype=float)
+    months_since_last_story = numpy.asarray(months_since_last_story, dtype=float)
+    feed_addresses = numpy.asarray(feed_addresses, dtype=str)
+
+    # Calculate sub counts: 
+    #   SELECT COUNT(*) FROM feeds WHERE active_premium_subscribers > 10 AND stories_last_month >= 30;
+    #   SELECT COUNT(*) FROM feeds WHERE active_premium_subscribers > 1 AND active_premium_subscribers < 10 AND stories_last_month >= 30;
+    #   SELECT COUNT(*) FROM feeds WHERE active_premium_subscribers = 1 AND stories_last_month >= 30;
+    # SpD > 1  Subs > 10: t = 6         # 4267   * 1440/6  =      1024080
+    # SpD > 1  Subs > 1:  t = 15        # 18973  * 1440/15 =      1821408
+    # SpD > 1  Subs = 1:  t = 60        # 65503  * 1440/60 =      1572072
+    #   SELECT COUNT(*) FROM feeds WHERE active_premium_subscribers > 1 AND stories_last_month < 30 AND stories_last_month > 0;
+    #   SELECT COUNT(*) FROM feeds WHERE active_premium_subscribers = 1 AND stories_last_month < 30 AND stories_last_month > 0;
+    # SpD < 1  Subs > 1:  t = 60        # 77618  * 1440/60 =      1862832
+    # SpD < 1  Subs = 1:  t = 60 * 12   # 282186 * 1440/(60*12) = 564372
+    #   SELECT COUNT(*) FROM feeds WHERE active_premium_subscribers > 1 AND stories_last_month = 0;
+    #   SELECT COUNT(*) FROM feeds WHERE active_subscribers > 0 AND active_premium_subscribers <= 1 AND stories_last_month = 0;
+    # SpD = 0  Subs > 1:  t = 60 * 3    # 30158  * 1440/(60*3) =  241264
+    # SpD = 0  Subs = 1:  t = 60 * 24   # 514131 * 1440/(60*24) = 514131
+    total = numpy.where(spd >= 1,
+                        numpy.where(subs >= 10, 6, numpy.where(subs > 1, 15, 45)),
+                        numpy.where(subs > 1, 60 - (spd * 60), 60*6 - (spd * 60*6)))
+    quiet = numpy.where(subs > 1, 60 * 6, numpy.where(subs == 1, 60 * 12, 60 * 24))
+    quiet = quiet * numpy.maximum(1, months_since_last_story)
+    total = numpy.where(spd == 0, quiet, total).astype(float)
+
+    total = numpy.where(has_push_history, total * 12, total)
+
+    # Any notifications means a 30 min minumum
+    total = numpy.where(numpy.asarray(notification_counts) > 0, numpy.minimum(total, 30), total)
+
+    # 4 hour max for premiums, 48 hour max for free
+    total = numpy.where(subs >= 1, numpy.minimum(total, 60*4*1), numpy.minimum(total, 60*24*2))
+
+    # Craigslist feeds get 6 hours minimum
+    total = numpy.where(numpy.char.find(feed_addresses, 'craigslist') >= 0,
+                        numpy.maximum(total, 60*6), total)
+
+    # Twitter feeds get 2 hours minimum
+    total = numpy.where(numpy.char.find(feed_addresses, 'twitter') >= 0,
+                        numpy.maximum(total, 60*2), total)
+
+    return total
+
+
+def error_intervals(totals, error_counts):
+    """ Geometric backoff for erroring feeds, as in Feed.set_next_scheduled_update(). """
+    error_counts = numpy.asarray(error_counts)
+    return numpy.where(error_counts > 0,
+                       numpy.minimum(totals * error_counts, MAX_ERROR_INTERVAL),
+                       totals)
+
+
+def notification_counts(feed_ids):
+    from apps.notifications.models import MUserFeedNotification
+
+    stats = MUserFeedNotification._get_collection().aggregate([{
+        "$match": {"feed_id": {"$in": list(feed_ids)}},
+    }, {
+        "$group": {
+            "_id":           "$feed_id",
+            "notifications": {"$sum": 1},
+        },
+    }])
+    return dict((stat['_id'], stat['notifications']) for stat in stats)
+
+
+def push_history_feed_ids(feed_ids):
+    from apps.rss_feeds.models import MFetchHistory
+
+    if not feed_ids:
+        return set()
+    histories = MFetchHistory.objects(feed_id__in=list(feed_ids)).only('feed_id', 'push_history')
+    return set(history.feed_id for history in histories if history.push_history)
+
+
+def schedule_feeds(feeds=None, batch_size=1000, skip_scheduling=False, verbose=True):
+    """
+    Re-plans the next fetch of every active feed in bulk, with the same rules that
+    Feed.set_next_scheduled_update() applies to one feed after each fetch.
+
+    Subscriber counts, stories per month, error and notification counts and push history
+    are loaded for `batch_size` feeds at a time into arrays, the intervals are computed
+    together, then scheduled_updates is written with one ZADD and min_to_decay and
+    next_scheduled_update in one bulk update per batch. Feeds that are queued or tasked
+    right now are left alone, the fetch in progress will reschedule them.
+
+    With `skip_scheduling`, feeds are only moved if their new interval is sooner than
+    their next scheduled fetch.
+    """
+    from apps.rss_feeds.models import Feed
+
+    start = time.time()
+    r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
+    if feeds is None:
+        feeds = Feed.objects.filter(active=True)
+    feed_ids = list(feeds.order_by('pk').values_list('pk', flat=True))
+
+    error_counts = dict((int(feed_id), int(errors)) for feed_id, errors
+                        in r.zrange('error_feeds', 0, -1, withscores=True))
+    in_progress = set(int(feed_id) for feed_id in r.smembers('queued_feeds'))
+    in_progress.update(int(feed_id) for feed_id in r.zrange('tasked_feeds', 0, -1))
+
+    scheduled = 0
+    for feed_id_batch in chunks(feed_ids, batch_size):
+        feed_id_batch = [feed_id for feed_id in feed_id_batch if feed_id not in in_progress]
+        if not feed_id_batch:
+            continue
+        scheduled += _schedule_batch(r, feed_id_batch, error_counts, skip_scheduling)
+
+    if verbose:
+        logging.debug(" ---> ~SN~FBScheduled ~SB%s~SN of %s feeds in ~SB%.2f~SN seconds (%s in progress)" % (
+                      scheduled, len(feed_ids), time.time() - start, len(in_progress)))
+
+    return scheduled
+
+
+def _schedule_batch(r, feed_ids, error_counts, skip_scheduling):
+    from apps.rss_feeds.models import Feed
+
+    rows = list(Feed.objects.filter(pk__in=feed_ids).values_list(
+        'pk', 'stories_last_month', 'active_subscribers', 'active_premium_subscribers',
+        'last_story_date', 'is_push', 'feed_address', 'errors_since_good',
+        'next_scheduled_update'))
+    if not rows:
+        return 0
+    (pks, stories_last_month, active_subscribers, active_premium_subscribers,
+     last_story_dates, is_push, feed_addresses, errors_since_good,
+     next_scheduled_updates) = zip(*rows)
+
+    pks = numpy.array(pks)
+    active_subscribers = numpy.array(active_subscribers, dtype=float)
+    active_premium_subscribers = numpy.array(active_premium_subscribers, dtype=float)
+    now = datetime.datetime.utcnow()
+
+    spd = numpy.array(stories_last_month, dtype=float) / 30.0
+    subs = (active_premium_subscribers +
+            ((active_subscribers - active_premium_subscribers) / 10.0))
+    months_since_last_story = numpy.array([
+        (now - last_story_date).total_seconds() if last_story_date else 0
+        for last_story_date in last_story_dates
+    ]) / (60*60*24*30)
+    counts = notification_counts(pks.tolist())
+    notifications = numpy.array([counts.get(pk, 0) for pk in pks.tolist()])
+    push_feed_ids = push_history_feed_ids([pk for pk, push in zip(pks.tolist(), is_push) if push])
+    has_push_history = numpy.array([pk in push_feed_ids for pk in pks.tolist()], dtype=bool)
+    errors = numpy.array([error_counts.get(pk, 0) for pk in pks.tolist()])
+    errors = errors + numpy.array([e or 0 for e in errors_since_good])
+
+    totals = fetch_intervals(spd, subs, months_since_last_story, has_push_history,
+                             notifications, feed_addresses)
+    totals = error_intervals(totals, errors)
+    random_factors = numpy.random.randint(0, totals.astype(int) + 1) / 4
+    delays = totals + random_factors
+
+    if skip_scheduling:
+        minutes_to_next_fetch = numpy.array([
+            (next_update - now).total_seconds() / 60 if next_update else 0
+            for next_update in next_scheduled_updates
+        ])
+        reschedule = minutes_to_next_fetch > totals
+    else:
+        reschedule = numpy.ones(len(pks), dtype=bool)
+
+    updated_feeds = []
+    scheduled_updates = {}
+    for pk, total, delay, subscribers, move in zip(pks.tolist(), totals.tolist(), delays.tolist(),
+                                                   active_subscribers.tolist(), reschedule.tolist()):
+        feed = Feed(pk=pk, min_to_decay=int(total))
+        if move:
+            feed.next_scheduled_update = now + datetime.timedelta(minutes=delay)
+            if subscribers >= 1:
+                scheduled_updates[pk] = feed.next_scheduled_update.strftime('%s')
+        updated_feeds.append(feed)
+    if scheduled_updates:
+        r.zadd('scheduled_updates', scheduled_updates)
+
+    moved = [feed for feed in updated_feeds if feed.next_scheduled_update]
+    Feed.objects.bulk_update([feed for feed in updated_feeds if not feed.next_scheduled_update],
+                             ['min_to_decay'])
+    Feed.objects.bulk_update(moved, ['min_to_decay', 'next_scheduled_update'])
+
+    return len(moved)
@@ -121,6 +121,7 @@ def TaskBrokenFeeds():
 @app.task(name='update-feeds', time_limit=10*60, soft_time_limit=9*60, ignore_result=True)
 def UpdateFeeds(feed_pks):
     from apps.rss_feeds.models import Feed
+    from apps.search.models import SearchStory
     from apps.statistics.models import MStatistics
     r = redis.Redis(connection_pool=settings.REDIS_FEED_UPDATE_POOL)
 
@@ -158,6 +159,10 @@ def UpdateFeeds(feed_pks):
             feed.save_feed_history(505, 'Timeout', e)
             logging.info(" ---> [%-30s] ~BR~FWTime limit hit!~SB~FR Moving on to next feed..." % feed)
         if profiler_activated: profiler.process_celery_finished()
+    
+    # A timed out update leaves its stories queued for search, and worker processes
+    # exit without running atexit handlers
+    SearchStory.flush_buffer()
 
 @app.task(name='new-feeds', time_limit=10*60, soft_time_limit=9*60, ignore_result=True)
 def NewFeeds(feed_pks):
@@ -1,12 +1,28 @@
+import time
+import re
 import redis
+import datetime
+import threading
+import collections
+import feedparser
 from utils import json_functions as json
 from django.test.client import Client
 from django.test import TestCase
 from django.core import management
 from django.urls import reverse
 from django.conf import settings
-from apps.rss_feeds.models import Feed, MStory
+from apps.rss_feeds.models import Feed, MStory, MFeedPage, RStoryHistogram
+from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierTag, MClassifierFeed
+from apps.analyzer.models import RClassifierCount
 from mongoengine.connection import connect, disconnect
+from mongoengine.queryset import OperationError
+from django.db import IntegrityError
+from utils.async_fetcher import AsyncFetcher
+from apps.rss_feeds.scheduler import fetch_intervals
+from utils.feed_stream import StreamingFeedParser
+from utils.feed_functions import timelimit, TimeoutError, Deadline, check_deadline
+from utils.story_functions import extract_image_sources
+from bs4 import BeautifulSoup
 
 
 class Test_Feed(TestCase):
@@ -18,6 +34,7 @@ class Test_Feed(TestCase):
         settings.MONGODB = connect('test_newsblur')
         settings.REDIS_STORY_HASH_POOL = redis.ConnectionPool(host=settings.REDIS_STORY['host'], port=6379, db=10)
         settings.REDIS_FEED_READ_POOL = redis.ConnectionPool(host=settings.REDIS_SESSIONS['host'], port=6379, db=10)
+        settings.REDIS_STORY_CACHE_POOL = redis.ConnectionPool(host=settings.REDIS_USER['host'], port=6379, db=10)
 
         r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
         r.delete('RS:1')
@@ -58,6 +75,46 @@ class Test_Feed(TestCase):
         feed = json.decode(response.content)
         self.assertEqual(len(feed['stories']), 6)
 
+    def test_format_stories__cached(self):
+        management.call_command('loaddata', 'gawker1.json', verbosity=0, skip_checks=False)
+
+        feed = Feed.objects.get(pk=10)
+        feed.update(force=True)
+
+        stories = Feed.format_stories(MStory.objects(story_feed_id=feed.pk))
+        cached_stories = Feed.format_stories(MStory.objects(story_feed_id=feed.pk))
+        self.assertEqual(len(stories), 38)
+        self.assertEqual(stories, cached_stories)
+
+        story = MStory.objects(story_feed_id=feed.pk).first()
+        story.story_content = "<p>Updated content</p>"
+        story.story_latest_content_z = None
+        story.save()
+
+        story = Feed.format_story(MStory.objects.get(story_hash=story.story_hash))
+        self.assertEqual(story['story_content'], "<p>Updated content</p>")
+
+    def test_get_stories__headline(self):
+        management.call_command('loaddata', 'gawker1.json', verbosity=0, skip_checks=False)
+
+        feed = Feed.objects.get(pk=10)
+        feed.update(force=True)
+
+        stories = feed.get_stories(0, 10)
+        headlines = feed.get_stories(0, 10, headline=True)
+        self.assertEqual(len(headlines), 10)
+        for story, headline in zip(stories, headlines):
+            self.assertTrue('story_content' not in headline)
+            self.assertEqual(headline['story_title'], story['story_title'])
+            self.assertEqual(headline['secure_image_urls'], story['secure_image_urls'])
+            self.assertEqual(headline['story_snippet'], MStory.snippet_from_content(story['story_content']))
+
+        # Stories saved before snippets existed get theirs from their content, and keep it
+        MStory.objects(story_feed_id=feed.pk).update(unset__story_snippet=True)
+        self.assertEqual(feed.get_stories(0, 10, headline=True), headlines)
+        self.assertEqual(MStory.objects(story_feed_id=feed.pk, story_snippet=None).count(), 38 - 10)
+        self.assertEqual(feed.get_stories(0, 10, headline=True), headlines)
+
     def test_load_feeds__gothamist(self):
         self.client.login(username='conesus', password='test')
 
@@ -245,3 +302,398 @@ class Test_Feed(TestCase):
 
     def test_all_feeds(self):
         pass
+
+    def test_statistics_counts(self):
+        stats_pool = redis.ConnectionPool(host=settings.REDIS_USER['host'], port=6379, db=10, decode_responses=True)
+        r = redis.Redis(connection_pool=stats_pool)
+        r.delete(*[counter.key(feed_id) for counter in (RStoryHistogram, RClassifierCount) for feed_id in (1, 2)])
+        with self.settings(REDIS_STATISTICS_POOL=stats_pool):
+            def assertCountsBuilt(counter, feed_ids):
+                for feed_id in feed_ids:
+                    counts = dict((field, int(count)) for field, count in r.hgetall(counter.key(feed_id)).items()
+                                  if field != 'built' and int(count))
+                    built = counter.build([feed_id])[feed_id]
+                    built.pop('built')
+                    self.assertEqual(counts, built)
+
+            # Stories inserted, deleted and redated
+            stories = [MStory(story_feed_id=1, story_guid='guid:%s' % i, story_title='Story %s' % i,
+                              story_permalink='http://example.com/%s' % i,
+                              story_date=datetime.datetime(2021, 3, i + 1, i * 5)).save()
+                       for i in range(4)]
+            stories[0].delete()
+            stories[1].story_date = datetime.datetime(2020, 11, 7, 23)
+            stories[1].save()
+            assertCountsBuilt(RStoryHistogram, [1])
+
+            # Classifiers trained, retrained, removed and switched to another feed
+            classifiers = [MClassifierTitle(user_id=1, feed_id=1, title='pacific', score=1),
+                           MClassifierTitle(user_id=2, feed_id=1, title='pacific', score=1),
+                           MClassifierAuthor(user_id=1, feed_id=1, social_user_id=0, author='Sam', score=-1),
+                           MClassifierTag(user_id=1, feed_id=1, social_user_id=0, tag='housing', score=1),
+                           MClassifierTag(user_id=2, feed_id=1, social_user_id=0, tag='housing', score=1),
+                           MClassifierFeed(user_id=1, feed_id=1, social_user_id=0, score=1)]
+            for classifier in classifiers:
+                classifier.save()
+            MClassifierTag(user_id=2, feed_id=2, social_user_id=0, tag='housing', score=-1).save()
+            classifiers[1].score = -1
+            classifiers[1].save()
+            classifiers[2].delete()
+            assertCountsBuilt(RClassifierCount, [1, 2])
+
+            for classifier in (classifiers[0], classifiers[3], classifiers[4], classifiers[5]):
+                # As in UserSubscription.switch_feed
+                classifier.feed_id = 2
+                try:
+                    classifier.save()
+                except (IntegrityError, OperationError):
+                    classifier.delete()
+            self.assertEqual(MClassifierTag.objects(feed_id=2).count(), 2)
+            assertCountsBuilt(RClassifierCount, [1, 2])
+
+    def stored_stories(self, feed_id):
+        """ A feed's story documents, story hashes and histogram, without its feed id. """
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        stats = redis.Redis(connection_pool=settings.REDIS_STATISTICS_POOL)
+        stories = []
+        for story in MStory._get_collection().find({'story_feed_id': feed_id}).sort('story_guid'):
+            for field in ('_id', 'story_feed_id', 'story_hash'):
+                story.pop(field)
+            stories.append(story)
+        story_hashes = [(story_hash.split(b':')[1], score)
+                        for story_hash, score in r.zrange('zF:%s' % feed_id, 0, -1, withscores=True)]
+        return stories, story_hashes, r.scard('F:%s' % feed_id), stats.hgetall(RStoryHistogram.key(feed_id))
+
+    def test_bulk_insert(self):
+        stats_pool = redis.ConnectionPool(host=settings.REDIS_USER['host'], port=6379, db=10, decode_responses=True)
+        pubsub_pool = redis.ConnectionPool(host=settings.REDIS_USER['host'], port=6379, db=10, decode_responses=True)
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        r.delete('F:1', 'zF:1', 'F:2', 'zF:2')
+        stats = redis.Redis(connection_pool=stats_pool)
+        stats.delete(RStoryHistogram.key(1), RStoryHistogram.key(2))
+        with self.settings(REDIS_STATISTICS_POOL=stats_pool, REDIS_PUBSUB_POOL=pubsub_pool):
+            now = datetime.datetime.now().replace(microsecond=0)
+
+            def new_stories(feed_id):
+                stories = [MStory(story_feed_id=feed_id, story_guid='guid:%s' % i, story_title='Story %s' % i,
+                                  story_permalink='http://example.com/%s' % i,
+                                  story_content='<p>Story %s <img src="/%s.png"></p>' % (i, i),
+                                  story_date=now - datetime.timedelta(hours=i))
+                           for i in range(5)]
+                # Too old for the story hashes, and a story that's in the fetch twice
+                stories[4].story_date = now - datetime.timedelta(days=settings.DAYS_OF_STORY_HASHES + 1)
+                stories.append(MStory(story_feed_id=feed_id, story_guid='guid:0', story_title='Story 0 again',
+                                      story_permalink='http://example.com/0', story_date=now))
+                return stories
+
+            # The same stories saved one at a time into feed 1, as they were, and in bulk into feed 2
+            saved = []
+            for story in new_stories(1):
+                try:
+                    saved.append(story.save())
+                except (IntegrityError, OperationError):
+                    pass
+            inserted = MStory.bulk_insert(new_stories(2))
+            self.assertEqual([story.story_guid for story in inserted], [story.story_guid for story in saved])
+            self.assertTrue(all(story.id for story in inserted))
+
+            self.assertEqual(len(self.stored_stories(1)[0]), 5)
+            self.assertEqual(len(self.stored_stories(1)[1]), 4)
+            self.assertEqual(self.stored_stories(2), self.stored_stories(1))
+
+            # Real time subscribers hear about the same stories either way
+            pubsub = redis.Redis(connection_pool=pubsub_pool).pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe('1:story', '2:story')
+            for story in saved:
+                story.publish_to_subscribers()
+            MStory.publish_stories_to_subscribers(inserted)
+            published = collections.defaultdict(list)
+            deadline = time.time() + 5
+            while sum(len(messages) for messages in published.values()) < len(saved) * 2 and time.time() < deadline:
+                message = pubsub.get_message(timeout=1)
+                if message:
+                    published[message['channel']].append(message['data'].split(':', 1)[1])
+            pubsub.close()
+            self.assertEqual(len(published['1:story']), len(saved))
+            self.assertEqual(published['2:story'], published['1:story'])
+
+    def test_trim_feed(self):
+        stats_pool = redis.ConnectionPool(host=settings.REDIS_USER['host'], port=6379, db=10, decode_responses=True)
+        r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+        r.delete('F:1', 'zF:1', 'F:2', 'zF:2')
+        stats = redis.Redis(connection_pool=stats_pool)
+        stats.delete(RStoryHistogram.key(1), RStoryHistogram.key(2))
+        with self.settings(REDIS_STATISTICS_POOL=stats_pool):
+            now = datetime.datetime.now().replace(microsecond=0)
+            for feed_id in (1, 2):
+                for i in range(12):
+                    MStory(story_feed_id=feed_id, story_guid='guid:%s' % i, story_title='Story %s' % i,
+                           story_permalink='http://example.com/%s' % i, share_count=int(i in (7, 9)),
+                           story_date=now - datetime.timedelta(hours=i)).save()
+
+            # Feed 1 trimmed one story at a time, as it was, and feed 2 in bulk
+            trim_date = MStory.objects(story_feed_id=1).order_by('-story_date')[5].story_date
+            for story in MStory.objects(story_feed_id=1, story_date__lte=trim_date):
+                if not story.share_count:
+                    story.delete()
+            self.assertEqual(MStory.trim_feed(cutoff=5, feed_id=2, verbose=False), 5)
+
+            stories = self.stored_stories(2)[0]
+            self.assertEqual(sorted(story['story_guid'] for story in stories),
+                             sorted('guid:%s' % i for i in (0, 1, 2, 3, 4, 7, 9)))
+            self.assertEqual(self.stored_stories(2), self.stored_stories(1))
+
+    def test_fetch_intervals(self):
+        address = 'http://a.com/rss'
+        # (stories per day, subscribers, months since last story, push, notifications, address)
+        cases = [
+            ((2, 10, 0, False, 0, address), 6),
+            ((2, 2, 0, False, 0, address), 15),
+            ((2, 1, 0, False, 0, address), 45),
+            ((0.5, 2, 0, False, 0, address), 30),
+            ((0.5, 1, 0, False, 0, address), 180),
+            ((0, 2, 0, False, 0, address), 240),
+            ((0, 0.5, 0, False, 0, address), 60*24),
+            ((0, 0.5, 3, False, 0, address), 60*24*2),
+            ((2, 10, 0, True, 0, address), 72),
+            ((0, 0.5, 0, False, 1, address), 30),
+            ((2, 10, 0, False, 0, 'http://sf.craigslist.org/'), 60*6),
+            ((2, 10, 0, False, 0, 'https://twitter.com/x'), 60*2),
+        ]
+        for feed, interval in cases:
+            self.assertEqual(Feed.fetch_interval(*feed), interval)
+        self.assertEqual(list(fetch_intervals(*list(zip(*[feed for feed, _ in cases])))),
+                         [interval for _, interval in cases])
+
+
+class Test_FeedPage(TestCase):
+
+    def test_hash_page(self):
+        page = ('<html><head><meta name="csrf-token" content="%s">'
+                '<script nonce="%s">window.ads = {ts: %s};</script>'
+                '<link rel="stylesheet" href="/style.css?ver=%s&amp;t=%s">'
+                '<script src="/app.min.js?v=%s"></script></head>'
+                '<body data-render-time="%s"><h1>Feed</h1>'
+                '<article><a href="%s">Story</a><img src="/photo.jpg?_=%s"></article>'
+                '<iframe src="%s"></iframe><!-- %s queries -->'
+                '<footer>Generated %s</footer></body></html>')
+
+        def render(fetch, link="/story?id=1", embed="https://www.youtube.com/embed/abc"):
+            return page % (fetch * 7, fetch * 11, fetch, fetch, fetch, fetch, fetch * 0.5, link,
+                           fetch, embed, fetch * 13, '2021-03-0%sT09:%s:00Z' % (fetch, 10 + fetch))
+
+        page_hash = MFeedPage.hash_page(render(1))
+        self.assertEqual(MFeedPage.hash_page(render(2)), page_hash)
+        self.assertEqual(MFeedPage.hash_page(render(3).encode('utf-8')), page_hash)
+
+        self.assertNotEqual(MFeedPage.hash_page(render(1).replace('Story', 'Stories')), page_hash)
+        self.assertNotEqual(MFeedPage.hash_page(render(1, link="/story?id=2")), page_hash)
+        self.assertNotEqual(MFeedPage.hash_page(render(1, link="/watch?v=2")),
+                            MFeedPage.hash_page(render(1, link="/watch?v=3")))
+        self.assertNotEqual(MFeedPage.hash_page(render(1, embed="https://www.youtube.com/embed/xyz")),
+                            page_hash)
+        self.assertNotEqual(MFeedPage.hash_page(render(1, embed="https://www.youtube.com/watch?v=abc")),
+                            MFeedPage.hash_page(render(1, embed="https://www.youtube.com/watch?v=xyz")))
+
+
+class Test_AsyncFetcher(TestCase):
+
+    def test_fetch_limits(self):
+        lock = threading.Lock()
+        active = collections.Counter()
+        peaks = collections.Counter()
+
+        def fetch(address):
+            host = address.split('/')[2]
+            with lock:
+                active[host] += 1
+                active['all'] += 1
+                peaks[host] = max(peaks[host], active[host])
+                peaks['all'] = max(peaks['all'], active['all'])
+            time.sleep(0.01)
+            with lock:
+                active[host] -= 1
+                active['all'] -= 1
+            if address.endswith('/broken'):
+                raise ValueError(address)
+            return address.upper()
+
+        addresses = ['http://host%s.com/%s' % (i % 3, i) for i in range(30)]
+        addresses.append('http://host0.com/broken')
+        results = list(AsyncFetcher(fetch, max_in_flight=4, max_per_host=2).run(addresses))
+
+        self.assertEqual(sorted(r[0] for r in results), sorted(addresses))
+        self.assertEqual(len([r for r in results if r[2]]), 1)
+        self.assertTrue(all(r[1] == r[0].upper() for r in results if not r[2]))
+        self.assertTrue(peaks['all'] <= 4)
+        self.assertTrue(all(peaks['host%s.com' % i] <= 2 for i in range(3)))
+
+    def test_fetch_timeout(self):
+        hung = threading.Event()
+
+        def fetch(address):
+            if address.endswith('/hung'):
+                hung.wait(5)
+            return address.upper()
+
+        addresses = ['http://host.com/hung', 'http://host.com/1', 'http://other.com/2']
+        fetcher = AsyncFetcher(fetch, max_in_flight=2, timeout=0.2)
+        results = {}
+        for address, result, error, duration in fetcher.run(addresses):
+            results[address] = (result, type(error))
+            if len(results) == len(addresses):
+                hung.set()
+
+        self.assertEqual(results['http://host.com/hung'], (None, TimeoutError))
+        self.assertEqual(results['http://host.com/1'], ('HTTP://HOST.COM/1', type(None)))
+        self.assertEqual(results['http://other.com/2'], ('HTTP://OTHER.COM/2', type(None)))
+
+
+class Test_StreamingFeedParser(TestCase):
+
+    def test_streaming_feed_parser(self):
+        with open('apps/rss_feeds/fixtures/gawker1.xml', 'rb') as f:
+            raw_feed = f.read()
+        entries = feedparser.parse(raw_feed).entries
+        story_hash = lambda guid: MStory.feed_guid_hash_unsaved(1, guid)
+
+        fpf = StreamingFeedParser(raw_feed, max_entries=10).parse()
+        self.assertEqual([e.id for e in fpf.entries], [e.id for e in entries[:10]])
+        self.assertEqual(fpf.entries[3].summary, entries[3].summary)
+
+        known_story_hashes = [story_hash(e.id) for e in entries[5:]]
+        parser = StreamingFeedParser(raw_feed, story_hash=story_hash, known_run=3,
+                                     known_story_hashes=known_story_hashes)
+        self.assertEqual(len(parser.parse().entries), 8)
+
+        self.assertEqual(StreamingFeedParser(raw_feed, max_entries=1000).parse(), None)
+
+        # An oldest first feed has its new stories after the known ones
+        items = ''.join('<item><title>%s</title><guid>%s</guid>'
+                        '<pubDate>Mon, %02d Jul 2009 12:00:00 GMT</pubDate></item>' % (i, i, i + 1)
+                        for i in range(20))
+        raw_feed = ('<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+                    '<title>Oldest first</title>%s</channel></rss>' % items).encode('utf-8')
+        known_story_hashes = [story_hash(str(i)) for i in range(15)]
+        parser = StreamingFeedParser(raw_feed, story_hash=story_hash, known_run=3,
+                                     known_story_hashes=known_story_hashes)
+        self.assertEqual(parser.parse(), None)
+        self.assertEqual(parser.entry_count, 20)
+        self.assertEqual(StreamingFeedParser(raw_feed, story_hash=story_hash, known_run=3, max_entries=18,
+                                             known_story_hashes=known_story_hashes).parse().entries[-1].id, '17')
+
+        # Undated entries can't be shown to be newest first either
+        raw_feed = re.sub(rb'<pubDate>.*?</pubDate>', b'', raw_feed)
+        parser = StreamingFeedParser(raw_feed, story_hash=story_hash, known_run=3,
+                                     known_story_hashes=known_story_hashes)
+        self.assertEqual(parser.parse(), None)
+
+        # A latin-1 feed whose charset is also given by the HTTP headers, which feedparser prefers
+        items = ''.join('<item><title>Caf\xe9 %s</title><guid>%s</guid></item>' % (i, i) for i in range(20))
+        raw_feed = ('<?xml version="1.0" encoding="ISO-8859-1"?><rss version="2.0"><channel>'
+                    '<title>Caf\xe9s</title>%s</channel></rss>' % items).encode('iso-8859-1')
+        headers = {'content-type': 'application/rss+xml; charset=ISO-8859-1'}
+        parser = StreamingFeedParser(raw_feed, max_entries=5)
+        fpf = parser.parse(response_headers=headers)
+        self.assertTrue('<title>Caf\xe9 0</title>' in parser.truncated_feed().decode('iso-8859-1'))
+        self.assertEqual(fpf.feed.title, 'Caf\xe9s')
+        self.assertEqual([e.title for e in fpf.entries],
+                         [e.title for e in feedparser.parse(raw_feed, response_headers=headers).entries[:5]])
+        self.assertEqual(fpf.entries[0].title, 'Caf\xe9 0')
+
+
+class Test_StoryFunctions(TestCase):
+
+    def test_extract_image_sources(self):
+        for fixture in ('gawker1.xml', 'gothamist_aug_2009_1.xml', 'motherjones1.xml', 'slashdot1.xml', 'google1.xml'):
+            with open('apps/rss_feeds/fixtures/%s' % fixture, 'rb') as f:
+                entries = feedparser.parse(f.read()).entries
+            for entry in entries:
+                for content in entry.get('content', []) + [{'value': entry.get('summary')}]:
+                    soup = BeautifulSoup(content['value'] or '', features="lxml")
+                    image_sources = [img.get('src') for img in soup.findAll('img') if img.get('src') is not None]
+                    self.assertEqual(extract_image_sources(content['value']), image_sources)
+
+        content = ('<!-- <img src="comment.png"> --><script>var s = "<img src=script.png>";</script>'
+                   '<p><IMG alt="a > b" SRC=first.png><img src=\'a&amp;b.png\' src="dupe.png"><img/src="last.png"></p>')
+        self.assertEqual(extract_image_sources(content), ['first.png', 'a&b.png', 'last.png'])
+        self.assertEqual(extract_image_sources(content.encode('utf-8')), ['first.png', 'a&b.png', 'last.png'])
+
+        # Query strings keep legacy entity names that have no semicolon, as parsed attributes do
+        for image_source in ('p.jpg?id=1&section=2', 'p.jpg?id=1&region=us', 'p.jpg?id=1&notify=0',
+                             'p.jpg?id=1&times=3', 'p.jpg?id=1&amp=1', 'p.jpg?id=1&amp;s=2&#38;t=3&copy 2'):
+            content = '<img src="%s">' % image_source
+            soup = BeautifulSoup(content, features="lxml")
+            self.assertEqual(extract_image_sources(content), [soup.img.get('src')])
+        self.assertEqual(extract_image_sources('<img src="p.jpg?id=1&section=2">'), ['p.jpg?id=1&section=2'])
+
+
+class Test_Timelimit(TestCase):
+
+    def test_timelimit(self):
+        work = []
+
+        @timelimit(0.1)
+        def busy():
+            while True:
+                work.append(1)
+
+        @timelimit(0.1)
+        def blocked():
+            time.sleep(5)
+
+        @timelimit(0.1)
+        def swallowing():
+            # Like FetchFeed.fetch, which logs any failed request and carries on
+            try:
+                time.sleep(5)
+            except Exception:
+                pass
+            time.sleep(5)
+
+        @timelimit(0.1)
+        def swallowing_all():
+            try:
+                time.sleep(0.3)
+            except Exception:
+                pass
+            return True
+
+        threads = threading.active_count()
+        for function in (busy, blocked, swallowing, swallowing_all):
+            start = time.time()
+            self.assertRaises(TimeoutError, function)
+            self.assertTrue(time.time() - start < 1)
+        done = len(work)
+        time.sleep(0.2)
+        self.assertEqual(len(work), done)
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(timelimit(1)(lambda x: x * 2)(3), 6)
+
+        # Off the main thread, loops that check the deadline stop at it
+        stopped = []
+        def loop():
+            try:
+                with Deadline(0.1):
+                    while True:
+                        check_deadline()
+            except TimeoutError:
+                stopped.append(True)
+        thread = threading.Thread(target=loop)
+        thread.start()
+        thread.join(2)
+        self.assertEqual(stopped, [True])
+
+        # Off the main thread, calls that never check the deadline are still waited on no longer
+        outcomes = []
+        def call(function):
+            start = time.time()
+            try:
+                outcomes.append(function())
+            except TimeoutError:
+                outcomes.append(time.time() - start < 1)
+        for function in (blocked, swallowing, timelimit(1)(lambda: 6)):
+            thread = threading.Thread(target=call, args=(function,))
+            thread.start()
+            thread.join(2)
+        self.assertEqual(outcomes, [True, True, 6])
@@ -1,36 +1,39 @@
 import re
 from django.core.management.base import BaseCommand
 from django.contrib.auth.models import User
-from apps.rss_feeds.models import Feed, MStory
+from apps.rss_feeds.models import MStory
 from apps.reader.models import UserSubscription
+from apps.search.models import SearchStoryIndexer
 
 class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("-u", "--user", dest="user", nargs=1, help="Specify user id or username")
         parser.add_argument("-R", "--reindex", dest="reindex", action="store_true", help="Drop index and reindex all stories.")
+        parser.add_argument("-o", "--offset", dest="offset", type=int, default=0, help="Resume reindexing from this feed id.")
+        parser.add_argument("-b", "--batch-size", dest="batch_size", type=int, default=500, help="Stories per _bulk request.")
+        parser.add_argument("-w", "--workers", dest="workers", type=int, default=4, help="Processes preparing stories.")
 
 
     def handle(self, *args, **options):
         if options['reindex']:
-            MStory.index_all_for_search()
+            MStory.index_all_for_search(offset=options['offset'], batch_size=options['batch_size'],
+                                        workers=options['workers'])
             return
-        
+
         if not options['user']:
             print("Missing user. Did you want to reindex everything? Use -R.")
             return
-            
-        if re.match(r"([0-9]+)", options['user']):
-            user = User.objects.get(pk=int(options['user']))
+
+        if re.match(r"([0-9]+)", options['user'][0]):
+            user = User.objects.get(pk=int(options['user'][0]))
         else:
-            user = User.objects.get(username=options['user'])
-        
-        subscriptions = UserSubscription.objects.filter(user=user)
-        print(" ---> Indexing %s feeds..." % subscriptions.count())
-        
-        for sub in subscriptions:
-            try:
-                sub.feed.index_stories_for_search()
-            except Feed.DoesNotExist:
-                print(" ***> Couldn't find %s" % sub.feed_id)
-        
\ No newline at end of file
+            user = User.objects.get(username=options['user'][0])
+
+        feed_ids = list(UserSubscription.objects.filter(user=user).values_list('feed_id', flat=True))
+        print(" ---> Indexing %s feeds..." % len(feed_ids))
+
+        indexer = SearchStoryIndexer(batch_size=options['batch_size'], workers=options['workers'],
+                                     processes=True)
+        indexer.index_feeds(feed_ids, progress=lambda feed_id_group: print(
+            " ---> Indexed %s (%s stories so far)" % (feed_id_group, indexer.indexed)))
@@ -1,8 +1,15 @@
 import re
 import time
+import zlib
+import hashlib
+import itertools
+import threading
+import collections
+import concurrent.futures
 import datetime
 import pymongo
 import elasticsearch
+import elasticsearch.helpers
 import redis
 import urllib3
 import celery
@@ -10,12 +17,15 @@ import html
 import mongoengine as mongo
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils.encoding import smart_str
 from apps.search.tasks import IndexSubscriptionsForSearch
 from apps.search.tasks import FinishIndexSubscriptionsForSearch
 from apps.search.tasks import IndexSubscriptionsChunkForSearch
 from apps.search.tasks import IndexFeedsForSearch
 from utils import log as logging
 from utils.feed_functions import chunks
+from utils.story_functions import prep_for_search
 
 class MUserSearch(mongo.Document):
     '''Search index state of a user's subscriptions.'''
@@ -77,7 +87,7 @@ class MUserSearch(mongo.Document):
             except Feed.DoesNotExist:
                 continue
         
-        feed_id_chunks = [c for c in chunks(feed_ids, 6)]
+        feed_id_chunks = [c for c in chunks(feed_ids, 50)]
         logging.user(user, "~FCIndexing ~SB%s feeds~SN in %s chunks..." %
                      (total, len(feed_id_chunks)))
         
@@ -107,20 +117,16 @@ class MUserSearch(mongo.Document):
         self.save()
     
     def index_subscriptions_chunk_for_search(self, feed_ids):
-        from apps.rss_feeds.models import Feed
         r = redis.Redis(connection_pool=settings.REDIS_PUBSUB_POOL)
         user = User.objects.get(pk=self.user_id)
 
         logging.user(user, "~FCIndexing %s feeds..." % len(feed_ids))
 
-        for feed_id in feed_ids:
-            feed = Feed.get_by_id(feed_id)
-            if not feed: continue
-            
-            feed.index_stories_for_search()
-            
-        r.publish(user.username, 'search_index_complete:feeds:%s' % 
-                  ','.join([str(f) for f in feed_ids]))
+        def progress(feed_id_group):
+            r.publish(user.username, 'search_index_complete:feeds:%s' % 
+                      ','.join([str(f) for f in feed_id_group]))
+        
+        SearchStoryIndexer().index_feeds(feed_ids, progress=progress)
     
     @classmethod
     def schedule_index_feeds_for_search(cls, feed_ids, user_id):
@@ -138,16 +144,11 @@ class MUserSearch(mongo.Document):
     
     @classmethod
     def index_feeds_for_search(cls, feed_ids, user_id):
-        from apps.rss_feeds.models import Feed
         user = User.objects.get(pk=user_id)
 
         logging.user(user, "~SB~FCIndexing %s~FC by request..." % feed_ids)
 
-        for feed_id in feed_ids:
-            feed = Feed.get_by_id(feed_id)
-            if not feed: continue
-            
-            feed.index_stories_for_search()
+        SearchStoryIndexer().index_feeds(feed_ids)
         
     @classmethod
     def remove_all(cls, drop_index=False):
@@ -185,6 +186,8 @@ class MUserSearch(mongo.Document):
             feed.save()
             removed += 1
             
+        SearchStory.remove_feed_filter(self.user_id)
+
         logging.user(user, "~FCRemoved ~SB%s/%s feed's search indexes~SN for ~SB~FB%s~FC~SN." % 
                      (removed, total, user.username))
         self.delete()
@@ -194,6 +197,19 @@ class SearchStory:
     _es_client = None
     name = "stories"
     
+    # Stories from index() are sent in one bulk request once this many are waiting,
+    # or when the feed fetcher finishes its feeds and calls flush_buffer().
+    BUFFER_SIZE = 200
+    _buffer = []
+    _buffer_lock = threading.Lock()
+    # Held while a flush is sending, so remove() can't delete a story before it's created
+    _flush_lock = threading.RLock()
+    
+    # Searches across more feeds than this look their feed ids up from a document in the
+    # feed filter index, stored once per user and set of feeds, rather than sending them.
+    FEED_FILTER_LOOKUP_MIN = 100
+    FEED_FILTER_CACHE_TTL = 60*60
+    
     @classmethod
     def ES(cls):
         if cls._es_client is None:
@@ -211,6 +227,10 @@ class SearchStory:
             return None
         return "%s-type" % cls.name
         
+    @classmethod
+    def feed_filter_index_name(cls):
+        return "%s-feeds-index" % cls.name
+
     @classmethod
     def create_elasticsearch_mapping(cls, delete=False):
         if delete:
@@ -279,12 +299,101 @@ class SearchStory:
         }, index=cls.index_name())
         cls.ES().indices.flush(cls.index_name())
 
+    @classmethod
+    def create_feed_filter_mapping(cls):
+        if cls.ES().indices.exists(cls.feed_filter_index_name()):
+            return
+        
+        cls.ES().indices.create(cls.feed_filter_index_name(), body={
+            'mappings': {
+                'properties': {
+                    'user_id': {'type': 'integer'},
+                    'feed_ids': {'type': 'integer', 'index': False},
+                    'indexed_at': {'type': 'long'},
+                }
+            }
+        })
+        logging.debug(" ---> ~FCCreating search index for ~FM%s" % cls.feed_filter_index_name())
+
+    @classmethod
+    def feed_filter(cls, feed_ids, user_id=None):
+        """The query filter for stories in `feed_ids`. Long lists of feeds are stored in the
+        feed filter index under the user and a hash of the feeds, and looked up by id, so
+        the request stays the same size and the cluster can cache the filter. Storing a set
+        also drops the user's sets that haven't been stored again for a while."""
+        if not user_id or len(feed_ids) <= cls.FEED_FILTER_LOOKUP_MIN:
+            return {"terms": {"feed_id": feed_ids}}
+        
+        feed_ids = sorted(set(int(feed_id) for feed_id in feed_ids))
+        version = hashlib.sha1(','.join(str(feed_id) for feed_id in feed_ids).encode('utf-8')).hexdigest()[:12]
+        filter_id = "%s:%s" % (user_id, version)
+        # When each of the user's stored sets of feeds was indexed, by version
+        cache_key = "SFf:%s" % user_id
+        now = int(time.time())
+        indexed = cache.get(cache_key) or {}
+        if indexed.get(version, 0) < now - cls.FEED_FILTER_CACHE_TTL:
+            cls.create_feed_filter_mapping()
+            cls.ES().index(index=cls.feed_filter_index_name(), id=filter_id,
+                           body={'user_id': user_id, 'feed_ids': feed_ids, 'indexed_at': now},
+                           doc_type=cls.doc_type())
+            indexed = dict((v, indexed_at) for v, indexed_at in indexed.items()
+                           if indexed_at >= now - cls.FEED_FILTER_CACHE_TTL)
+            indexed[version] = now
+            cache.set(cache_key, indexed, cls.FEED_FILTER_CACHE_TTL)
+            # Only sets no search has used for twice as long as they are trusted for
+            cls.remove_feed_filter(user_id, indexed_before=now - 2 * cls.FEED_FILTER_CACHE_TTL)
+        
+        return {"terms": {"feed_id": {
+            "index": cls.feed_filter_index_name(),
+            "id": filter_id,
+            "path": "feed_ids",
+        }}}
+
+    @classmethod
+    def remove_feed_filter(cls, user_id, indexed_before=None):
+        """Deletes the user's stored feed filters, or only those stored before `indexed_before`."""
+        query = {"term": {"user_id": user_id}}
+        if not indexed_before:
+            cache.delete("SFf:%s" % user_id)
+        else:
+            query = {"bool": {"filter": [query, {"range": {"indexed_at": {"lt": indexed_before}}}]}}
+        try:
+            cls.ES().delete_by_query(index=cls.feed_filter_index_name(), body={"query": query},
+                                     conflicts="proceed")
+        except elasticsearch.exceptions.NotFoundError as e:
+            logging.debug(f" ***> ~FRNo feed filter to remove: {e}")
+
     @classmethod
     def index(cls, story_hash, story_title, story_content, story_tags, story_author, story_feed_id,
               story_date):
-        cls.create_elasticsearch_mapping()
+        """Queues the story for the next bulk_index(), which is sent once BUFFER_SIZE stories
+        are waiting. Call flush_buffer() to send it sooner, as the feed fetcher does once it
+        has processed its feeds."""
+        story = dict(story_hash=story_hash, story_title=story_title, story_content=story_content,
+                     story_tags=story_tags, story_author=story_author, story_feed_id=story_feed_id,
+                     story_date=story_date)
+        with cls._buffer_lock:
+            cls._buffer.append(story)
+            full = len(cls._buffer) >= cls.BUFFER_SIZE
+        if full:
+            cls.flush_buffer()
 
-        doc = {
+    @classmethod
+    def flush_buffer(cls, refresh=False):
+        """Bulk indexes the stories queued by index(). With `refresh`, waits until they
+        are searchable."""
+        with cls._flush_lock:
+            with cls._buffer_lock:
+                stories, cls._buffer = cls._buffer, []
+            if not stories:
+                return 0
+
+            return cls.bulk_index(stories, refresh=refresh)
+
+    @classmethod
+    def story_document(cls, story_title, story_content, story_tags, story_author, story_feed_id,
+                       story_date):
+        return {
             "content": story_content,
             "title": story_title,
             "tags": ', '.join(story_tags),
@@ -292,29 +401,88 @@ class SearchStory:
             "feed_id": story_feed_id,
             "date": story_date,
         }
+
+    @classmethod
+    def bulk_action(cls, story):
+        action = {
+            "_op_type": "create",
+            "_index": cls.index_name(),
+            "_id": story['story_hash'],
+            "_source": cls.story_document(story['story_title'], story['story_content'],
+                                          story['story_tags'], story['story_author'],
+                                          story['story_feed_id'], story['story_date']),
+        }
+        if cls.doc_type():
+            action["_type"] = cls.doc_type()
+        return action
+
+    @classmethod
+    def bulk_index(cls, stories, refresh=False):
+        """Indexes many stories in one _bulk request. Takes the same fields as index().
+        With `refresh`, returns once they are searchable."""
+        if not stories:
+            return
+        cls.create_elasticsearch_mapping()
+
+        actions = [cls.bulk_action(story) for story in stories]
         try:
-            cls.ES().create(index=cls.index_name(), id=story_hash,
-                            body=doc, doc_type=cls.doc_type())
+            indexed, errors = elasticsearch.helpers.bulk(cls.ES(), actions, raise_on_error=False,
+                                                         refresh='wait_for' if refresh else 'false')
         except (elasticsearch.exceptions.ConnectionError,
                 urllib3.exceptions.NewConnectionError) as e:
             logging.debug(
                 f" ***> ~FRNo search server available for story indexing: {e}")
-        except elasticsearch.exceptions.ConflictError as e:
-            logging.debug(f" ***> ~FBAlready indexed story: {e}")
-        # if settings.DEBUG:
-        #     logging.debug(f" ***> ~FBIndexed {story_hash}")
+            return
+        # Conflicts are stories that were already indexed
+        errors = [e for e in errors if e.get('create', {}).get('status') != 409]
+        if errors:
+            logging.debug(f" ***> ~FRFailed to index {len(errors)} stories: {errors[0]}")
+        
+        return indexed
 
     @classmethod
-    def remove(cls, story_hash):
-        if not cls.ES().exists(index=cls.index_name(), id=story_hash, doc_type=cls.doc_type()):
+    def bulk_remove(cls, story_hashes):
+        """Removes many stories in one _bulk request, ignoring those that weren't indexed."""
+        if not story_hashes:
             return
+        story_hashes = set(story_hashes)
+        with cls._flush_lock:
+            with cls._buffer_lock:
+                cls._buffer = [story for story in cls._buffer if story['story_hash'] not in story_hashes]
+
+            actions = []
+            for story_hash in story_hashes:
+                action = {"_op_type": "delete", "_index": cls.index_name(), "_id": story_hash}
+                if cls.doc_type():
+                    action["_type"] = cls.doc_type()
+                actions.append(action)
+            try:
+                removed, errors = elasticsearch.helpers.bulk(cls.ES(), actions, raise_on_error=False)
+            except (elasticsearch.exceptions.ConnectionError,
+                    urllib3.exceptions.NewConnectionError) as e:
+                logging.debug(f" ***> ~FRNo search server available for story deletion: {e}")
+                return
+            errors = [e for e in errors if e.get('delete', {}).get('status') != 404]
+            if errors:
+                logging.debug(f" ***> ~FRFailed to remove {len(errors)} stories: {errors[0]}")
 
-        try:
-            cls.ES().delete(index=cls.index_name(), id=story_hash, doc_type=cls.doc_type())
-        except elasticsearch.exceptions.NotFoundError:
-            cls.ES().delete(index=cls.index_name(), id=story_hash, doc_type='story-type')
-        except elasticsearch.exceptions.NotFoundError as e:
-            logging.debug(f" ***> ~FRNo search server available for story deletion: {e}")
+            return removed
+
+    @classmethod
+    def remove(cls, story_hash):
+        with cls._flush_lock:
+            with cls._buffer_lock:
+                cls._buffer = [story for story in cls._buffer if story['story_hash'] != story_hash]
+
+            if not cls.ES().exists(index=cls.index_name(), id=story_hash, doc_type=cls.doc_type()):
+                return
+
+            try:
+                cls.ES().delete(index=cls.index_name(), id=story_hash, doc_type=cls.doc_type())
+            except elasticsearch.exceptions.NotFoundError:
+                cls.ES().delete(index=cls.index_name(), id=story_hash, doc_type='story-type')
+            except elasticsearch.exceptions.NotFoundError as e:
+                logging.debug(f" ***> ~FRNo search server available for story deletion: {e}")
         
     @classmethod
     def drop(cls):
@@ -325,12 +493,19 @@ class SearchStory:
 
         
     @classmethod
-    def query(cls, feed_ids, query, order, offset, limit, strip=False):
+    def refresh(cls):
+        """Makes everything indexed so far searchable, for a query that has to read its
+        own writes. Searches otherwise see writes within the index's refresh interval."""
+        cls.flush_buffer()
         try:
-            cls.ES().indices.flush(cls.index_name())
+            cls.ES().indices.refresh(cls.index_name())
         except elasticsearch.exceptions.NotFoundError as e:
-            logging.debug(f" ***> ~FRNo search server available: {e}")
-            return []
+            logging.debug(f" ***> ~FRNo search index to refresh: {e}")
+
+    @classmethod
+    def query(cls, feed_ids, query, order, offset, limit, strip=False, refresh=False, user_id=None):
+        if refresh:
+            cls.refresh()
         
         if strip:
             query = re.sub(r'([^\s\w_\-])+', ' ', query) # Strip non-alphanumeric
@@ -341,7 +516,7 @@ class SearchStory:
                 "bool": {
                     "must": [
                         {"query_string": { "query": query, "default_operator": "AND" }},
-                        {"terms": { "feed_id": feed_ids[:2000] }},
+                        cls.feed_filter(feed_ids, user_id=user_id),
                     ]
                 }
             },
@@ -351,7 +526,8 @@ class SearchStory:
         }
         try:
             results  = cls.ES().search(body=body, index=cls.index_name(), doc_type=cls.doc_type())
-        except elasticsearch.exceptions.RequestError as e:
+        except (elasticsearch.exceptions.RequestError,
+                elasticsearch.exceptions.NotFoundError) as e:
             logging.debug(" ***> ~FRNo search server available for querying: %s" % e)
             return []
 
@@ -386,9 +562,6 @@ class SearchStory:
     
     @classmethod
     def global_query(cls, query, order, offset, limit, strip=False):
-        cls.create_elasticsearch_mapping()
-        cls.ES().indices.flush()
-        
         if strip:
             query = re.sub(r'([^\s\w_\-])+', ' ', query) # Strip non-alphanumeric
         query = html.unescape(query)
@@ -407,7 +580,8 @@ class SearchStory:
         }
         try:
             results  = cls.ES().search(body=body, index=cls.index_name(), doc_type=cls.doc_type())
-        except elasticsearch.exceptions.RequestError as e:
+        except (elasticsearch.exceptions.RequestError,
+                elasticsearch.exceptions.NotFoundError) as e:
             logging.debug(" ***> ~FRNo search server available for querying: %s" % e)
             return []
         
@@ -430,7 +604,132 @@ class SearchStory:
             return []
         
         return result_ids
-        
+
+
+def story_search_fields(story):
+    """SearchStory.index() fields for a story straight from Mongo. Runs in the workers of
+    SearchStoryIndexer, so it only takes the raw document."""
+    story_content = story.get('story_content') or ""
+    if story.get('story_content_z'):
+        story_content = smart_str(zlib.decompress(story['story_content_z']))
+
+    return dict(story_hash=story['story_hash'],
+                story_title=story.get('story_title'),
+                story_content=prep_for_search(story_content),
+                story_tags=story.get('story_tags') or [],
+                story_author=story.get('story_author_name'),
+                story_feed_id=story['story_feed_id'],
+                story_date=story.get('story_date'))
+
+
+def stories_search_fields(stories):
+    return [story_search_fields(story) for story in stories]
+
+
+class SearchStoryIndexer:
+    """Bulk indexes every story in a set of feeds.
+
+    Stories are read from Mongo with only the fields the index needs, a pool of workers
+    decompresses and strips their content, and they go to the index in _bulk requests of
+    `batch_size`. Batches are only prepared a few ahead of the _bulk requests, so a slow
+    cluster slows down the Mongo reads rather than filling memory, and stories the cluster
+    turns away as busy (429) are retried `max_retries` times with backoff.
+
+    Feeds are indexed `feeds_per_group` at a time. Each group is refreshed, marked
+    search_indexed if none of its stories failed, so a failed group is retried next time,
+    then handed to `progress`.
+    """
+
+    STORY_FIELDS = ['story_hash', 'story_title', 'story_content', 'story_content_z', 'story_tags',
+                    'story_author_name', 'story_feed_id', 'story_date']
+
+    def __init__(self, batch_size=500, workers=4, processes=False, max_retries=3,
+                 feeds_per_group=10):
+        self.batch_size = batch_size
+        self.workers = max(1, workers)
+        self.processes = processes
+        self.max_retries = max_retries
+        self.feeds_per_group = feeds_per_group
+        self.indexed = 0
+        self.failed = 0
+
+    def worker_pool(self):
+        # Processes when there are cores to spare, threads inside a celery worker
+        if self.processes and self.workers > 1:
+            return concurrent.futures.ProcessPoolExecutor(self.workers)
+        return concurrent.futures.ThreadPoolExecutor(self.workers)
+
+    def raw_stories(self, feed_ids):
+        from apps.rss_feeds.models import MStory
+        projection = dict((field, True) for field in self.STORY_FIELDS)
+        return MStory._get_collection().find({'story_feed_id': {'$in': feed_ids}},
+                                             projection=projection, batch_size=self.batch_size)
+
+    def prepared_stories(self, pool, raw_stories):
+        """Yields search fields in order, with no more than `workers` batches in flight."""
+        pending = collections.deque()
+        while True:
+            batch = list(itertools.islice(raw_stories, self.batch_size))
+            if batch:
+                pending.append(pool.submit(stories_search_fields, batch))
+            if pending and (len(pending) > self.workers or not batch):
+                yield from pending.popleft().result()
+            if not batch and not pending:
+                break
+
+    def index_group(self, pool, feed_ids):
+        """Returns the number of stories that failed to index."""
+        failed = 0
+        actions = (SearchStory.bulk_action(story) for story in
+                   self.prepared_stories(pool, self.raw_stories(feed_ids)))
+        results = elasticsearch.helpers.streaming_bulk(SearchStory.ES(), actions,
+                                                       chunk_size=self.batch_size,
+                                                       max_retries=self.max_retries,
+                                                       raise_on_error=False)
+        for ok, result in results:
+            # Conflicts are stories that were already indexed
+            if ok or result.get('create', {}).get('status') == 409:
+                self.indexed += 1
+            else:
+                if not self.failed:
+                    logging.debug(f" ***> ~FRFailed to index story: {result}")
+                self.failed += 1
+                failed += 1
+
+        return failed
+
+    def index_feeds(self, feed_ids, progress=None, force=False):
+        """Indexes the stories of the feeds that aren't already search indexed, or all of
+        them with `force`. Returns the number of stories indexed."""
+        from apps.rss_feeds.models import Feed
+
+        feeds = Feed.objects.filter(pk__in=feed_ids)
+        if not force:
+            feeds = feeds.exclude(search_indexed=True)
+        unindexed_feed_ids = set(feeds.values_list('pk', flat=True))
+        SearchStory.create_elasticsearch_mapping()
+
+        with self.worker_pool() as pool:
+            for feed_id_group in chunks(list(feed_ids), self.feeds_per_group):
+                group = [feed_id for feed_id in feed_id_group if feed_id in unindexed_feed_ids]
+                if group:
+                    try:
+                        failed = self.index_group(pool, group)
+                    except (elasticsearch.exceptions.ConnectionError,
+                            urllib3.exceptions.NewConnectionError) as e:
+                        logging.debug(f" ***> ~FRNo search server available for story indexing: {e}")
+                        return self.indexed
+                    # Searchable by the time the caller reports the feeds as indexed
+                    SearchStory.refresh()
+                    if failed:
+                        logging.debug(f" ***> ~FRNot marking feeds {group} search indexed, {failed} stories failed")
+                    else:
+                        Feed.objects.filter(pk__in=group).update(search_indexed=True)
+                if progress:
+                    progress(feed_id_group)
+
+        return self.indexed
+
 
 class SearchFeed:
     
@@ -5,7 +5,9 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import datetime
 from django.test import TestCase
+from apps.search.models import SearchStory
 
 
 class SimpleTest(TestCase):
@@ -14,3 +16,60 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class TestingSearchStory(SearchStory):
+    name = "test-stories"
+
+
+class Test_SearchStory(TestCase):
+
+    def setUp(self):
+        TestingSearchStory.drop()
+
+    def tearDown(self):
+        TestingSearchStory.remove_feed_filter(1)
+        TestingSearchStory.drop()
+
+    def test_bulk_index(self):
+        stories = [dict(story_hash='1:%06x' % i, story_title='Story %s' % i,
+                        story_content='<p>Pacific story %s</p>' % i, story_tags=['tag%s' % i, 'news'],
+                        story_author='Author %s' % i, story_feed_id=1,
+                        story_date=datetime.datetime(2021, 3, i + 1))
+                   for i in range(5)]
+        self.assertEqual(TestingSearchStory.bulk_index(stories[:3], refresh=True), 3)
+
+        # Stories that are already indexed are left as they are, as a create of each one was
+        retitled = dict(stories[0], story_title='Story 0 again')
+        self.assertEqual(TestingSearchStory.bulk_index([retitled] + stories, refresh=True), 2)
+
+        for story in stories:
+            document = TestingSearchStory.ES().get(index=TestingSearchStory.index_name(),
+                                                   id=story['story_hash'])['_source']
+            self.assertEqual(document['title'], story['story_title'])
+            self.assertEqual(document['tags'], ', '.join(story['story_tags']))
+            self.assertEqual(document['feed_id'], story['story_feed_id'])
+        self.assertEqual(TestingSearchStory.query([1], 'pacific', 'newest', 0, 10),
+                         [story['story_hash'] for story in reversed(stories)])
+
+    def test_feed_filter(self):
+        stories = [dict(story_hash='%s:%06x' % (feed_id, feed_id), story_title='Story %s' % feed_id,
+                        story_content='<p>Pacific story</p>', story_tags=[], story_author='Author',
+                        story_feed_id=feed_id, story_date=datetime.datetime(2021, 3, 1))
+                   for feed_id in (1, 200)]
+        TestingSearchStory.bulk_index(stories, refresh=True)
+        folders = ((list(range(1, 150)), stories[0]), (list(range(150, 300)), stories[1]))
+
+        # Searches of one user over different sets of feeds each look up their own feeds
+        for _ in range(2):
+            for feed_ids, story in folders:
+                self.assertEqual(TestingSearchStory.query(feed_ids, 'pacific', 'newest', 0, 10, user_id=1),
+                                 [story['story_hash']])
+        TestingSearchStory.ES().indices.refresh(TestingSearchStory.feed_filter_index_name())
+        self.assertEqual(TestingSearchStory.ES().count(index=TestingSearchStory.feed_filter_index_name(),
+                                                       body={"query": {"term": {"user_id": 1}}})['count'], 2)
+
+        TestingSearchStory.remove_feed_filter(1)
+        feed_ids, story = folders[0]
+        self.assertEqual(TestingSearchStory.query(feed_ids, 'pacific', 'newest', 0, 10, user_id=1),
+                         [story['story_hash']])
@@ -14,7 +14,6 @@ import html.parser as html_parser
 import tweepy
 import pynliner
 from collections import defaultdict
-from bs4 import BeautifulSoup
 from mongoengine.queryset import Q
 from django.conf import settings
 from django.contrib.auth.models import User
@@ -23,6 +22,7 @@ from django.urls import reverse
 from django.template.loader import render_to_string
 from django.template.defaultfilters import slugify
 from django.core.mail import EmailMultiAlternatives
+from django.core.cache import cache
 from django.utils.encoding import smart_bytes
 from apps.reader.models import UserSubscription, RUserStory
 from apps.analyzer.models import MClassifierFeed, MClassifierAuthor, MClassifierTag, MClassifierTitle
@@ -35,7 +35,7 @@ from vendor import facebook
 from utils import log as logging
 from utils import json_functions as json
 from utils.feed_functions import relative_timesince, chunks
-from utils.story_functions import truncate_chars, strip_tags, linkify
+from utils.story_functions import truncate_chars, strip_tags, linkify, extract_image_sources
 from utils.image_functions import ImageOps
 from utils.scrubber import SelectiveScriptScrubber
 from utils import s3_utils
@@ -47,6 +47,7 @@ except ImportError:
     pass
 
 RECOMMENDATIONS_LIMIT = 5
+COMPACT_PROFILE_CACHE_TTL = 60*5
 IGNORE_IMAGE_SOURCES = [
     "http://feeds.feedburner.com"
 ]
@@ -201,6 +202,7 @@ class MSocialProfile(mongo.Document):
             self.custom_css = strip_tags(self.custom_css)
             
         super(MSocialProfile, self).save(*args, **kwargs)
+        cache.delete(MSocialProfile.compact_profile_key(self.user_id))
         if self.user_id not in self.following_user_ids:
             self.follow_user(self.user_id, force=True)
             self.count_follows()
@@ -308,6 +310,37 @@ class MSocialProfile(mongo.Document):
         profiles = cls.objects.filter(user_id__in=user_ids)
         return profiles
 
+    @staticmethod
+    def compact_profile_key(user_id):
+        return "SPc:%s" % user_id
+    
+    @classmethod
+    def compact_profiles(cls, user_ids):
+        """ Returns {user_id: {'profile': canonical(compact=True), 'muted_by_user_ids': [...]}}
+        for the users that have profiles. Cached for a few minutes and dropped on save. """
+        user_ids = list(user_ids)
+        cached = cache.get_many([cls.compact_profile_key(user_id) for user_id in user_ids])
+        profiles = {}
+        for user_id in user_ids:
+            profile = cached.get(cls.compact_profile_key(user_id))
+            if profile:
+                profiles[user_id] = profile
+        
+        missing_user_ids = [user_id for user_id in user_ids if user_id not in profiles]
+        if missing_user_ids:
+            fresh_profiles = {}
+            for profile in cls.objects.filter(user_id__in=missing_user_ids):
+                fresh_profiles[profile.user_id] = {
+                    'profile': profile.canonical(compact=True),
+                    'muted_by_user_ids': list(profile.muted_by_user_ids),
+                }
+            cache.set_many(dict((cls.compact_profile_key(user_id), profile)
+                                for user_id, profile in fresh_profiles.items()),
+                           COMPACT_PROFILE_CACHE_TTL)
+            profiles.update(fresh_profiles)
+        
+        return profiles
+    
     @classmethod
     def profile_feeds(cls, user_ids):
         profiles = cls.objects.filter(user_id__in=user_ids)
@@ -1989,26 +2022,59 @@ class MSharedStory(mongo.DynamicDocument):
         r = redis.Redis(connection_pool=settings.REDIS_POOL)
         friend_key = "F:%s:F" % (user_id)
         profile_user_ids = set()
-        for story in stories: 
+        
+        # One pipeline for every story's comment and share sets
+        pipeline = r.pipeline()
+        for story in stories:
             story['friend_comments'] = []
             story['friend_shares'] = []
             story['public_comments'] = []
             story['reply_count'] = 0
             if check_all or story['comment_count']:
                 comment_key = "C:%s:%s" % (story['story_feed_id'], story['guid_hash'])
-                story['comment_count'] = r.scard(comment_key)
-                friends_with_comments = [int(f) for f in r.sinter(comment_key, friend_key)]
-                sharer_user_ids = [int(f) for f in r.smembers(comment_key)]
-                shared_stories = []
-                if sharer_user_ids:
-                    params = {
-                        'story_hash': story['story_hash'],
-                        'user_id__in': sharer_user_ids,
-                    }
-                    if 'story_db_id' in params:
-                        params.pop('story_db_id')
-                    shared_stories = cls.objects.filter(**params)\
-                                                .hint([('story_hash', 1)])
+                pipeline.scard(comment_key)
+                pipeline.sinter(comment_key, friend_key)
+                pipeline.smembers(comment_key)
+            if check_all or story['share_count']:
+                share_key = "S:%s:%s" % (story['story_feed_id'], story['guid_hash'])
+                pipeline.scard(share_key)
+                pipeline.sinter(share_key, friend_key)
+                pipeline.sdiff(share_key, friend_key)
+        results = iter(pipeline.execute())
+        
+        story_sets = []
+        shared_user_ids = set()
+        for story in stories:
+            comment_sets = share_sets = None
+            if check_all or story['comment_count']:
+                comment_count, friends_with_comments, sharer_user_ids = next(results), next(results), next(results)
+                comment_sets = (comment_count,
+                                [int(f) for f in friends_with_comments],
+                                [int(f) for f in sharer_user_ids])
+                shared_user_ids.update(comment_sets[2])
+            if check_all or story['share_count']:
+                share_count, friends_with_shares, nonfriend_user_ids = next(results), next(results), next(results)
+                share_sets = (share_count,
+                              [int(f) for f in friends_with_shares],
+                              [int(f) for f in nonfriend_user_ids])
+                shared_user_ids.update(share_sets[1])
+            story_sets.append((comment_sets, share_sets))
+        
+        # One query for every shared story on the page, in the order the per-story
+        # queries returned them.
+        story_shared_stories = defaultdict(list)
+        if shared_user_ids:
+            shared_stories = cls.objects.filter(story_hash__in=list(set(story['story_hash'] for story in stories)),
+                                                user_id__in=list(shared_user_ids))\
+                                        .hint([('story_hash', 1)])
+            for shared_story in shared_stories:
+                story_shared_stories[shared_story.story_hash].append(shared_story)
+        
+        for story, (comment_sets, share_sets) in zip(stories, story_sets):
+            if comment_sets:
+                story['comment_count'], friends_with_comments, sharer_user_ids = comment_sets
+                shared_stories = [s for s in story_shared_stories[story['story_hash']]
+                                  if s.user_id in sharer_user_ids]
                 for shared_story in shared_stories:
                     comments = shared_story.comments_with_author()
                     story['reply_count'] += len(comments['replies'])
@@ -2029,11 +2095,8 @@ class MSharedStory(mongo.DynamicDocument):
                 story['comment_count_friends'] = len(friends_with_comments)
                 story['comment_count_public'] = story['comment_count'] - len(friends_with_comments)
                 
-            if check_all or story['share_count']:
-                share_key = "S:%s:%s" % (story['story_feed_id'], story['guid_hash'])
-                story['share_count'] = r.scard(share_key)
-                friends_with_shares = [int(f) for f in r.sinter(share_key, friend_key)]
-                nonfriend_user_ids = [int(f) for f in r.sdiff(share_key, friend_key)]
+            if share_sets:
+                story['share_count'], friends_with_shares, nonfriend_user_ids = share_sets
                 profile_user_ids.update(nonfriend_user_ids)
                 profile_user_ids.update(friends_with_shares)
                 story['commented_by_public']  = [c['user_id'] for c in story['public_comments']]
@@ -2050,14 +2113,8 @@ class MSharedStory(mongo.DynamicDocument):
                     story['share_user_ids'] = story['friend_user_ids'] + story['public_user_ids']
                 if story.get('source_user_id'):
                     profile_user_ids.add(story['source_user_id'])
-                shared_stories = []
-                if story['shared_by_friends']:
-                    params = {
-                        'story_hash': story['story_hash'],
-                        'user_id__in': story['shared_by_friends'],
-                    }
-                    shared_stories = cls.objects.filter(**params)\
-                                                .hint([('story_hash', 1)])
+                shared_stories = [s for s in story_shared_stories[story['story_hash']]
+                                  if s.user_id in story['shared_by_friends']]
                 for shared_story in shared_stories:
                     comments = shared_story.comments_with_author()
                     story['reply_count'] += len(comments['replies'])
@@ -2069,20 +2126,19 @@ class MSharedStory(mongo.DynamicDocument):
                     if comments.get('liking_users'):
                         profile_user_ids = profile_user_ids.union(comments['liking_users'])
             
-        profiles = MSocialProfile.objects.filter(user_id__in=list(profile_user_ids))
+        profiles = MSocialProfile.compact_profiles(profile_user_ids)
         
         # Toss public comments by private profiles and muted users
-        profiles_dict = dict((profile['user_id'], profile) for profile in profiles)
         for story in stories:
             commented_by_public = story.get('commented_by_public') or [c['user_id'] for c in story['public_comments']]
             for comment_user_id in commented_by_public:
-                private = profiles_dict[comment_user_id].private
-                muted = user_id in profiles_dict[comment_user_id].muted_by_user_ids
+                private = profiles[comment_user_id]['profile']['private']
+                muted = user_id in profiles[comment_user_id]['muted_by_user_ids']
                 if private or muted:
                     story['public_comments'] = [c for c in story['public_comments'] if c['user_id'] != comment_user_id]
                     story['comment_count_public'] -= 1
 
-        profiles = [profile.canonical(compact=True) for profile in profiles]
+        profiles = [profile['profile'] for _, profile in sorted(profiles.items())]
             
         return stories, profiles
     
@@ -2358,17 +2414,16 @@ class MSharedStory(mongo.DynamicDocument):
         if self.image_urls and not force:
             return
             
-        soup = BeautifulSoup(zlib.decompress(self.story_content_z), features="lxml")
-        image_sources = [img.get('src') for img in soup.findAll('img') if img and img.get('src')]
+        image_sources = [src for src in extract_image_sources(zlib.decompress(self.story_content_z)) if src]
         if len(image_sources) > 0:
             self.image_urls = image_sources
             max_length = MSharedStory.image_urls.field.max_length
-            while len(''.join(self.image_urls)) > max_length:
-                if len(self.image_urls) <= 1:
-                    self.image_urls[0] = self.image_urls[0][:max_length-1]
+            length = 0
+            for i, image_url in enumerate(self.image_urls):
+                length += len(image_url)
+                if length > max_length:
+                    self.image_urls = self.image_urls[:i] or [image_url[:max_length-1]]
                     break
-                else:
-                    self.image_urls.pop()
             self.save()
             
     def calculate_image_sizes(self, force=False):
@@ -5,7 +5,14 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import datetime
+import redis
 from django.test import TestCase
+from django.conf import settings
+from django.contrib.auth.models import User
+from mongoengine.connection import connect, disconnect
+from apps.rss_feeds.models import MStory
+from apps.social.models import MSharedStory, MSocialProfile, MCommentReply
 
 
 class SimpleTest(TestCase):
@@ -14,3 +21,75 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class Test_SharedStories(TestCase):
+
+    def setUp(self):
+        disconnect()
+        settings.MONGODB = connect('test_newsblur')
+        pools = self.settings(
+            REDIS_POOL=redis.ConnectionPool(host=settings.REDIS_USER['host'], port=6379, db=10,
+                                            decode_responses=True),
+            REDIS_STORY_HASH_POOL=redis.ConnectionPool(host=settings.REDIS_STORY['host'], port=6379, db=10,
+                                                       decode_responses=True))
+        pools.enable()
+        self.addCleanup(pools.disable)
+        redis.Redis(connection_pool=settings.REDIS_POOL).flushdb()
+
+    def tearDown(self):
+        redis.Redis(connection_pool=settings.REDIS_POOL).flushdb()
+        settings.MONGODB.drop_database('test_newsblur')
+
+    def test_stories_with_comments_and_profiles(self):
+        user_ids = [User.objects.create_user('reader%s' % i, 'reader%s@example.com' % i, 'test').pk
+                    for i in range(5)]
+        reader, friend1, friend2, public, private = user_ids
+        redis.Redis(connection_pool=settings.REDIS_POOL).sadd("F:%s:F" % reader, friend1, friend2)
+        profile = MSocialProfile.get_user(private)
+        profile.private = True
+        profile.save()
+
+        now = datetime.datetime.now().replace(microsecond=0)
+        for i, user_id, comments, replies, liking_users, source_user_id in [
+                (0, friend1, 'First', [], [], None),
+                (0, public, 'Second', [MCommentReply(user_id=friend2, comments='Reply', publish_date=now)],
+                 [private], None),
+                (0, private, 'Hidden', [], [], None),
+                (1, friend2, '', [], [], friend1),
+                (1, public, '', [], [], None)]:
+            MSharedStory(user_id=user_id, story_feed_id=1, story_guid='guid:%s' % i, story_title='Story %s' % i,
+                         story_permalink='http://example.com/%s' % i, comments=comments,
+                         has_comments=bool(comments), replies=replies, liking_users=liking_users,
+                         source_user_id=source_user_id, shared_date=now - datetime.timedelta(minutes=i)).save()
+
+        def stories():
+            stories = []
+            for i in range(3):
+                guid_hash = MStory.guid_hash_unsaved('guid:%s' % i)
+                stories.append(dict(story_feed_id=1, guid_hash=guid_hash, story_hash='1:%s' % guid_hash,
+                                    comment_count=int(i == 0), share_count=int(i < 2), share_user_ids=[]))
+            return stories
+
+        # The stories on their own, as they were enriched one by one, then all of them together
+        for check_all in (False, True):
+            one_at_a_time = []
+            profiles = {}
+            for story in stories():
+                story_list, story_profiles = MSharedStory.stories_with_comments_and_profiles(
+                    [story], reader, check_all=check_all)
+                one_at_a_time.extend(story_list)
+                profiles.update((profile['user_id'], profile) for profile in story_profiles)
+            together, together_profiles = MSharedStory.stories_with_comments_and_profiles(
+                stories(), reader, check_all=check_all)
+            self.assertEqual(together, one_at_a_time)
+            self.assertEqual(together_profiles, [profile for _, profile in sorted(profiles.items())])
+
+        self.assertEqual([c['user_id'] for c in together[0]['friend_comments']], [friend1])
+        self.assertEqual([c['user_id'] for c in together[0]['public_comments']], [public])
+        self.assertEqual(together[0]['reply_count'], 1)
+        self.assertEqual([c['user_id'] for c in together[1]['friend_shares']], [friend2])
+        self.assertEqual(together[1]['shared_by_public'], [public])
+        self.assertEqual(together[2]['friend_comments'] + together[2]['public_comments'], [])
+        self.assertEqual(sorted(profile['user_id'] for profile in together_profiles),
+                         [friend1, friend2, public, private])
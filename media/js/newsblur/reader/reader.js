@@ -5254,12 +5254,14 @@
                     }
                 } else if (_.string.startsWith(message, 'story:read')) {
                     NEWSBLUR.log(['Real-time user update for read story', username, message]);
-                    var story_hash = message.replace('story:read:', '');
-                    NEWSBLUR.assets.stories.mark_read_pubsub(story_hash);
-                    if (NEWSBLUR.app.dashboard_rivers) {
-                        NEWSBLUR.app.dashboard_rivers['left'].mark_read_pubsub(story_hash);
-                        NEWSBLUR.app.dashboard_rivers['right'].mark_read_pubsub(story_hash);
-                    }
+                    var story_hashes = message.replace('story:read:', '').split(',');
+                    _.each(story_hashes, function(story_hash) {
+                        NEWSBLUR.assets.stories.mark_read_pubsub(story_hash);
+                        if (NEWSBLUR.app.dashboard_rivers) {
+                            NEWSBLUR.app.dashboard_rivers['left'].mark_read_pubsub(story_hash);
+                            NEWSBLUR.app.dashboard_rivers['right'].mark_read_pubsub(story_hash);
+                        }
+                    });
                 } else if (_.string.startsWith(message, 'story:unread')) {
                     NEWSBLUR.log(['Real-time user update for unread story', username, message]);
                     var story_hash = message.replace('story:unread:', '');
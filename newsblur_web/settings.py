@@ -262,6 +262,9 @@ DAYS_OF_UNREAD_FREE     = 14
 # DoSH can be more, since you can up this value by N, and after N days,
 # you can then up the DAYS_OF_UNREAD value with no impact.
 DAYS_OF_STORY_HASHES    = 30
+# How each user's read stories in a feed are kept: 'sets' of story hashes or 'bitmaps'
+# over the feed's story ordinals. Switch with ./manage.py migrate_read_stories.
+READ_STORIES_BACKEND    = 'sets'
 
 SUBSCRIBER_EXPIRE       = 7
 
@@ -763,6 +766,7 @@ REDIS_FEED_UPDATE_POOL     = redis.ConnectionPool(host=REDIS_USER['host'], port=
 # REDIS_STORY_HASH_POOL2   = redis.ConnectionPool(host=REDIS_USER['host'], port=REDIS_PORT, db=8) # Only used when changing DAYS_OF_UNREAD
 REDIS_STORY_HASH_TEMP_POOL = redis.ConnectionPool(host=REDIS_USER['host'], port=REDIS_PORT, db=10, decode_responses=True)
 # REDIS_CACHE_POOL         = redis.ConnectionPool(host=REDIS_USER['host'], port=REDIS_PORT, db=6) # Duped in CACHES
+REDIS_STORY_CACHE_POOL     = redis.ConnectionPool(host=REDIS_USER['host'], port=REDIS_PORT, db=6, decode_responses=False) # Shares CACHES db
 REDIS_STORY_HASH_POOL      = redis.ConnectionPool(host=REDIS_STORY['host'], port=REDIS_PORT, db=1, decode_responses=True)
 REDIS_STORY_HASH_POOL_ENCODED = redis.ConnectionPool(host=REDIS_STORY['host'], port=REDIS_PORT, db=1, decode_responses=False)
 REDIS_FEED_READ_POOL       = redis.ConnectionPool(host=REDIS_SESSIONS['host'], port=REDIS_PORT, db=1, decode_responses=True)
@@ -0,0 +1,89 @@
+""" Compares scoring stories with the apply_classifier_* functions against ClassifierMatcher.
+
+Builds 10/100/1000 title, author and tag classifiers spread over a river's worth of feeds,
+then scores the same stories both ways. The scores must be identical.
+
+    python perf/bench_classifier_matcher.py --stories 2000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'newsblur_web.settings')
+
+import django
+django.setup()
+
+from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
+from apps.analyzer.models import ClassifierMatcher
+from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds
+from apps.analyzer.models import apply_classifier_authors, apply_classifier_tags
+
+WORDS = ("apple google microsoft election climate review deal leak rumor update crypto "
+         "launch iphone android senate court recipe podcast video sponsored giveaway").split()
+
+
+def phrase(rng, words=2):
+    return " ".join(rng.choice(WORDS) + str(rng.randint(0, 50)) for _ in range(words))
+
+
+def build(rng, count, feed_ids):
+    score = lambda: rng.choice([1, -1])
+    titles = [MClassifierTitle(feed_id=rng.choice(feed_ids), title=phrase(rng, 1), score=score())
+              for _ in range(count)]
+    authors = [MClassifierAuthor(feed_id=rng.choice(feed_ids), author=phrase(rng), score=score())
+               for _ in range(count)]
+    tags = [MClassifierTag(feed_id=rng.choice(feed_ids), tag=phrase(rng, 1), score=score())
+            for _ in range(count)]
+    feeds = [MClassifierFeed(feed_id=feed_id, social_user_id=0, score=score())
+             for feed_id in rng.sample(feed_ids, min(len(feed_ids), count))]
+    return feeds, authors, titles, tags
+
+
+def linear_intelligence(classifiers, story):
+    feeds, authors, titles, tags = classifiers
+    return {
+        'feed':   apply_classifier_feeds(feeds, story['story_feed_id']),
+        'author': apply_classifier_authors(authors, story),
+        'tags':   apply_classifier_tags(tags, story),
+        'title':  apply_classifier_titles(titles, story),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stories', type=int, default=2000)
+    parser.add_argument('--feeds', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    feed_ids = list(range(1, args.feeds + 1))
+    stories = [dict(story_feed_id=rng.choice(feed_ids),
+                    story_title=phrase(rng, 8).title(),
+                    story_authors=phrase(rng),
+                    story_tags=[phrase(rng, 1) for _ in range(rng.randint(0, 5))])
+               for _ in range(args.stories)]
+
+    for count in (10, 100, 1000):
+        classifiers = build(rng, count, feed_ids)
+
+        start = time.time()
+        linear = [linear_intelligence(classifiers, story) for story in stories]
+        linear_time = time.time() - start
+
+        start = time.time()
+        matcher = ClassifierMatcher(*classifiers)
+        compile_time = time.time() - start
+        compiled = [matcher.intelligence(story) for story in stories]
+        compiled_time = time.time() - start
+
+        print("%5s classifiers x %s stories: linear %7.4fs  compiled %7.4fs (compile %.4fs)  %5.1fx  %s" % (
+              count, len(stories), linear_time, compiled_time, compile_time,
+              linear_time / max(compiled_time, 1e-6), "OK" if linear == compiled else "MISMATCH"))
+
+
+if __name__ == '__main__':
+    main()
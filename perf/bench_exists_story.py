@@ -0,0 +1,167 @@
+""" Benchmarks Feed._exists_story against the original linear scan on recorded feeds.
+
+Each fixture pair is an older and a newer copy of the same feed. Stories from the
+older copy become the existing stories (compressed like MStory.save() does), then
+every entry of the newer copy is checked both ways. The new/updated/same counts
+must be identical. Use --repeat to grow the existing stories to a busy feed's size.
+
+    python perf/bench_exists_story.py --repeat 4
+"""
+import os
+import sys
+import time
+import zlib
+import difflib
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'newsblur_web.settings')
+
+import django
+django.setup()
+
+import feedparser
+from django.utils.encoding import smart_str
+from apps.rss_feeds.models import Feed, MStory
+from utils.feed_functions import levenshtein_distance
+from utils.story_functions import pre_process_story, strip_comments, ExistingStoryIndex
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apps', 'rss_feeds', 'fixtures')
+FIXTURE_PAIRS = [
+    ('gawker1.xml', 'gawker2.xml'),
+    ('gothamist_aug_2009_1.xml', 'gothamist_aug_2009_2.xml'),
+    ('slashdot1.xml', 'slashdot2.xml'),
+    ('motherjones1.xml', 'motherjones2.xml'),
+    ('google1.xml', 'google2.xml'),
+]
+
+
+def legacy_exists_story(feed, story, story_content, existing_stories, new_story_hashes):
+    """ The original O(new x existing) scan, kept here for comparison. """
+    story_in_system = None
+    story_has_changed = False
+    story_link = feed.get_permalink(story)
+    existing_stories_hashes = list(existing_stories.keys())
+    story_pub_date = story.get('published')
+
+    for existing_story in list(existing_stories.values()):
+        content_ratio = 0
+        if story.get('story_hash') == existing_story.story_hash:
+            story_in_system = existing_story
+        elif story.get('story_hash') in existing_stories_hashes:
+            continue
+        elif existing_story.story_hash in new_story_hashes:
+            continue
+
+        if 'story_latest_content_z' in existing_story:
+            existing_story_content = smart_str(zlib.decompress(existing_story.story_latest_content_z))
+        elif 'story_content_z' in existing_story:
+            existing_story_content = smart_str(zlib.decompress(existing_story.story_content_z))
+        else:
+            existing_story_content = ''
+
+        story_title_difference = abs(levenshtein_distance(story.get('title'), existing_story.story_title))
+        title_ratio = difflib.SequenceMatcher(None, story.get('title', ""), existing_story.story_title).ratio()
+        if title_ratio < .75: continue
+        story_timedelta = existing_story.story_date - story_pub_date
+        if abs(story_timedelta.days) >= 2: continue
+        seq = difflib.SequenceMatcher(None, story_content, existing_story_content)
+        similiar_length_min = 1000
+        if (existing_story.story_permalink == story_link and
+            existing_story.story_title == story.get('title')):
+            similiar_length_min = 20
+        if (seq and story_content and len(story_content) > similiar_length_min and
+            existing_story_content and seq.real_quick_ratio() > .9 and seq.quick_ratio() > .95):
+            content_ratio = seq.ratio()
+        if story_title_difference > 0 and content_ratio > .98:
+            story_in_system = existing_story
+            story_has_changed = True
+            break
+        if not story_in_system and content_ratio > .98:
+            story_in_system = existing_story
+            story_has_changed = True
+            break
+        if story_in_system and not story_has_changed:
+            if story_content != existing_story_content:
+                story_has_changed = True
+            if story_link != existing_story.story_permalink:
+                story_has_changed = True
+            break
+
+    return story_in_system, story_has_changed
+
+
+def parse_stories(feed, filename, suffix=""):
+    fpf = feedparser.parse(os.path.join(FIXTURES_DIR, filename))
+    stories = []
+    for entry in fpf.entries:
+        story = pre_process_story(entry, fpf.encoding)
+        story['guid'] = "%s%s" % (story.get('guid'), suffix)
+        story['story_hash'] = MStory.feed_guid_hash_unsaved(feed.pk, story['guid'])
+        stories.append(story)
+    return stories
+
+
+def existing_story(feed, story):
+    story_content = strip_comments(story.get('story_content'))
+    existing = MStory(story_feed_id=feed.pk,
+                      story_date=story.get('published'),
+                      story_title=story.get('title'),
+                      story_permalink=feed.get_permalink(story),
+                      story_guid=story.get('guid'))
+    existing.story_hash = story['story_hash']
+    existing.story_content_z = zlib.compress(smart_str(story_content).encode('utf-8'))
+    return existing
+
+
+def classify(check, feed, stories, existing_stories, indexed=False):
+    new_story_hashes = [s.get('story_hash') for s in stories]
+    if indexed:
+        # Built once per fetch, as in Feed.add_update_stories
+        existing_stories = ExistingStoryIndex(existing_stories, new_story_hashes)
+    counts = dict(new=0, updated=0, same=0)
+    for story in stories:
+        story_content = strip_comments(story.get('story_content'))
+        found, changed = check(feed, story, story_content, existing_stories, new_story_hashes)
+        if found is None:
+            counts['new'] += 1
+        elif changed:
+            counts['updated'] += 1
+        else:
+            counts['same'] += 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=1, help="Copies of each fixture's stories")
+    args = parser.parse_args()
+
+    feed = Feed(pk=1, feed_address="http://example.com/feed", feed_title="Benchmark")
+    indexed_check = lambda feed, *a: feed._exists_story(*a)
+
+    for old_fixture, new_fixture in FIXTURE_PAIRS:
+        existing_stories = {}
+        stories = []
+        for copy in range(args.repeat):
+            suffix = "#%s" % copy if copy else ""
+            for story in parse_stories(feed, old_fixture, suffix):
+                existing_stories[story['story_hash']] = existing_story(feed, story)
+            stories.extend(parse_stories(feed, new_fixture, suffix))
+
+        start = time.time()
+        legacy_counts = classify(legacy_exists_story, feed, stories, existing_stories)
+        legacy_time = time.time() - start
+
+        start = time.time()
+        indexed_counts = classify(indexed_check, feed, stories, existing_stories, indexed=True)
+        indexed_time = time.time() - start
+
+        print("%-28s %4s new x %4s existing: legacy %7.3fs  indexed %7.3fs  (%5.1fx) %s %s" % (
+              new_fixture, len(stories), len(existing_stories), legacy_time, indexed_time,
+              legacy_time / max(indexed_time, 1e-6),
+              indexed_counts, "OK" if legacy_counts == indexed_counts else "MISMATCH %s" % legacy_counts))
+
+
+if __name__ == '__main__':
+    main()
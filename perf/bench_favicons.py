@@ -0,0 +1,146 @@
+""" Compares measuring a favicon's color with k-means, as IconImporter did, against the
+palette histogram in IconImporter.dominant_color().
+
+Icons come from a directory of image files, from icons stored in MFeedIcon, or by default
+are drawn here: flat logos, letters on backgrounds, gradients and transparent icons.
+Reports the time per icon and how far apart the two colors are (RGB distance).
+
+    python perf/bench_favicons.py --icons 2000
+    python perf/bench_favicons.py --stored 5000
+    python perf/bench_favicons.py --directory ~/favicons
+"""
+import os
+import sys
+import time
+import base64
+import random
+import argparse
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'newsblur_web.settings')
+
+import django
+django.setup()
+
+import numpy
+import scipy.cluster.vq
+from PIL import Image, ImageDraw
+from apps.rss_feeds.models import MFeedIcon
+from apps.rss_feeds.icon_importer import IconImporter
+
+
+def kmeans_color(image):
+    """ IconImporter.determine_dominant_color_in_image() before the palette histogram,
+        without adjust_color(). """
+    ar = numpy.array(image)
+    shape = ar.shape
+    if len(shape) > 2:
+        ar = ar.reshape(numpy.prod(shape[:2]), shape[2])
+    ar = ar.astype(float)
+    codes, _ = scipy.cluster.vq.kmeans(ar, 5)
+
+    original_codes = codes
+    for low, hi in [(60, 200), (35, 230), (10, 250)]:
+        codes = numpy.array([code for code in codes
+                             if not ((code[0] < low and code[1] < low and code[2] < low) or
+                                     (code[0] > hi and code[1] > hi and code[2] > hi))])
+        if not len(codes):
+            codes = original_codes
+        else:
+            break
+
+    vecs, _ = scipy.cluster.vq.vq(ar, codes)
+    counts, bins = numpy.histogram(vecs, len(codes))
+    peak = codes.astype(int)[numpy.argmax(counts)]
+    return "{:02x}{:02x}{:02x}".format(peak[0], peak[1], peak[2])
+
+
+def drawn_icons(rng, count):
+    icons = []
+    for i in range(count):
+        size = rng.choice((16, 32, 64))
+        color = tuple(rng.randint(0, 255) for _ in range(3))
+        kind = i % 4
+        if kind == 0:
+            # Logo on white
+            image = Image.new('RGBA', (size, size), (255, 255, 255, 255))
+            ImageDraw.Draw(image).ellipse((size // 8, size // 8, size * 7 // 8, size * 7 // 8), fill=color)
+        elif kind == 1:
+            # Light letter on a colored square
+            image = Image.new('RGBA', (size, size), color + (255,))
+            ImageDraw.Draw(image).rectangle((size // 3, size // 4, size // 2, size * 3 // 4),
+                                            fill=(250, 250, 250, 255))
+        elif kind == 2:
+            # Gradient
+            ramp = numpy.linspace(0.6, 1.0, size)[:, None, None] * numpy.array(color)[None, None, :]
+            pixels = numpy.broadcast_to(ramp, (size, size, 3)).astype(numpy.uint8)
+            image = Image.fromarray(pixels).convert('RGBA')
+        else:
+            # Shape on a transparent background
+            image = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+            ImageDraw.Draw(image).polygon([(0, size - 1), (size // 2, 0), (size - 1, size - 1)],
+                                          fill=color + (255,))
+        icons.append(image)
+    return icons
+
+
+def load_icons(args):
+    if args.directory:
+        icons = []
+        for filename in sorted(os.listdir(args.directory)):
+            try:
+                icons.append(Image.open(os.path.join(args.directory, filename)).convert('RGBA'))
+            except (IOError, ValueError):
+                pass
+        return icons
+    if args.stored:
+        icons = []
+        for feed_icon in MFeedIcon.objects(not_found__ne=True).only('data').limit(args.stored):
+            if not feed_icon.data:
+                continue
+            try:
+                image = Image.open(BytesIO(base64.b64decode(feed_icon.data)))
+                icons.append(image.convert('RGBA'))
+            except (IOError, ValueError):
+                pass
+        return icons
+    return drawn_icons(random.Random(1), args.icons)
+
+
+def distance(color1, color2):
+    rgb1 = numpy.array([int(color1[i:i+2], 16) for i in (0, 2, 4)])
+    rgb2 = numpy.array([int(color2[i:i+2], 16) for i in (0, 2, 4)])
+    return numpy.sqrt(((rgb1 - rgb2) ** 2).sum())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--icons', type=int, default=2000, help="Icons to draw")
+    parser.add_argument('--stored', type=int, default=0, help="Icons to load from MFeedIcon")
+    parser.add_argument('--directory', default=None, help="A directory of icon files")
+    parser.add_argument('--tolerance', type=float, default=48, help="RGB distance counted as the same color")
+    args = parser.parse_args()
+
+    icons = load_icons(args)
+    print("%s icons" % len(icons))
+
+    timings = {}
+    colors = {}
+    for name, measure in (('kmeans', kmeans_color), ('histogram', IconImporter.dominant_color)):
+        numpy.random.seed(1)
+        start = time.time()
+        colors[name] = [measure(icon) for icon in icons]
+        timings[name] = (time.time() - start) / max(len(icons), 1)
+        print("%-10s %8.3fms/icon" % (name, timings[name] * 1000))
+
+    distances = numpy.array([distance(a, b) for a, b in zip(colors['kmeans'], colors['histogram'])])
+    close = (distances <= args.tolerance).mean() if len(distances) else 1.0
+    print("%.1fx faster, median distance %.1f, 90th percentile %.1f, %.1f%% within %s" % (
+          timings['kmeans'] / max(timings['histogram'], 1e-9), numpy.median(distances),
+          numpy.percentile(distances, 90), close * 100, args.tolerance))
+    print("OK" if close >= 0.9 else "MISMATCH")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+""" Compares serial feed fetching against utils.async_fetcher.AsyncFetcher.
+
+Starts a handful of local stub HTTP servers (each port counts as its own host)
+serving a mix of fast and slow RSS feeds, then downloads and parses every feed
+both ways, with the same requests + feedparser calls FetchFeed uses.
+
+    python perf/bench_feed_fetch.py --feeds 200 --slow 0.2 --delay 1.0
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import requests
+import feedparser
+from utils.async_fetcher import AsyncFetcher
+
+FEED_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"><channel>
+<title>Stub feed %(feed)s</title><link>http://example.com/%(feed)s</link>
+%(items)s
+</channel></rss>"""
+ITEM_TEMPLATE = """<item><title>Story %(i)s</title><link>http://example.com/%(feed)s/%(i)s</link>
+<guid>http://example.com/%(feed)s/%(i)s</guid><description>%(body)s</description></item>"""
+
+
+class StubFeedHandler(BaseHTTPRequestHandler):
+    delay = 1.0
+    etag = '"stub-etag"'
+
+    def do_GET(self):
+        feed = self.path.strip('/').split('?')[0]
+        if feed.startswith('slow'):
+            time.sleep(self.delay)
+        else:
+            time.sleep(0.01)
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        items = "\n".join(ITEM_TEMPLATE % dict(i=i, feed=feed, body="Lorem ipsum " * 40) for i in range(25))
+        body = (FEED_TEMPLATE % dict(feed=feed, items=items)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_servers(count):
+    servers = []
+    for _ in range(count):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubFeedHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+
+def fetch(address):
+    headers = {'User-Agent': 'NewsBlur Feed Fetcher - benchmark', 'Accept-Encoding': 'gzip, deflate'}
+    raw_feed = requests.get(address, headers=headers, timeout=15)
+    if raw_feed.status_code >= 400:
+        raw_feed = requests.get(address, headers=dict(headers, **{'User-Agent': 'Mozilla/5.0'}), timeout=15)
+    return feedparser.parse(raw_feed.content, response_headers=raw_feed.headers)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--feeds', type=int, default=200)
+    parser.add_argument('--hosts', type=int, default=20)
+    parser.add_argument('--slow', type=float, default=0.2, help="Fraction of feeds that are slow")
+    parser.add_argument('--delay', type=float, default=1.0, help="Seconds a slow feed takes to respond")
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--per-host', type=int, default=2)
+    parser.add_argument('--skip-serial', action='store_true')
+    args = parser.parse_args()
+
+    StubFeedHandler.delay = args.delay
+    servers = start_servers(args.hosts)
+    random.seed(1)
+    addresses = []
+    for i in range(args.feeds):
+        server = servers[i % len(servers)]
+        kind = 'slow' if random.random() < args.slow else 'fast'
+        addresses.append('http://127.0.0.1:%s/%s%s' % (server.server_port, kind, i))
+
+    if not args.skip_serial:
+        start = time.time()
+        entries = sum(len(fetch(address).entries) for address in addresses)
+        serial = time.time() - start
+        print("Serial:     %6.2fs  %7.1f feeds/s  (%s entries)" % (serial, len(addresses) / serial, entries))
+
+    fetcher = AsyncFetcher(fetch, max_in_flight=args.concurrency, max_per_host=args.per_host)
+    start = time.time()
+    entries = 0
+    for address, fpf, error, duration in fetcher.run(addresses):
+        if error:
+            print(" ***> %s: %s" % (address, error))
+            continue
+        entries += len(fpf.entries)
+    concurrent = time.time() - start
+    print("Concurrent: %6.2fs  %7.1f feeds/s  (%s entries, %s in flight, %s per host)" % (
+          concurrent, len(addresses) / concurrent, entries, args.concurrency, args.per_host))
+
+    for server in servers:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+""" Compares parsing a large feed whole with feedparser against the streaming parser in
+utils.feed_stream, which stops after the entries that will be used.
+
+Each fixture's entries are repeated, with fresh guids, into feeds of 1,000 and 5,000
+entries. Every parse runs in its own forked process so its peak memory can be read
+from getrusage. The streaming entries must match the first entries of the full parse
+once they have been through pre_process_story.
+
+    python perf/bench_feed_parse.py --known 20
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'newsblur_web.settings')
+
+import django
+django.setup()
+
+import feedparser
+from apps.rss_feeds.models import MStory
+from utils.feed_stream import StreamingFeedParser
+from utils.story_functions import pre_process_story
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apps', 'rss_feeds', 'fixtures')
+FIXTURES = ['gawker1.xml', 'gothamist_aug_2009_1.xml', 'google1.xml', 'motherjones1.xml']
+FEED_ID = 1
+MAX_ENTRIES = 100
+ENTRY_RE = re.compile(br'<(item|entry)[\s>].*?</\1>', re.S)
+GUID_RE = re.compile(br'<(guid|id)([^>]*)>(.*?)</\1>', re.S)
+
+
+def grow_feed(raw_feed, entry_count):
+    """ Repeats the feed's entries until it has `entry_count`, each copy with its own guids. """
+    entries = [m.group(0) for m in ENTRY_RE.finditer(raw_feed)]
+    first = raw_feed.index(entries[0])
+    last = raw_feed.index(entries[-1]) + len(entries[-1])
+    grown = []
+    for i in range(entry_count):
+        suffix = ('#%s' % (i // len(entries))).encode('utf-8') if i >= len(entries) else b''
+        grown.append(GUID_RE.sub(lambda m: b'<%s%s>%s%s</%s>' % (m.group(1), m.group(2), m.group(3).strip(),
+                                                               suffix, m.group(1)),
+                                 entries[i % len(entries)]))
+    return raw_feed[:first] + b''.join(grown) + raw_feed[last:]
+
+
+def story_hash(guid):
+    return MStory.feed_guid_hash_unsaved(FEED_ID, guid)
+
+
+def summarize(fpf):
+    stories = [pre_process_story(entry, fpf.encoding) for entry in fpf.entries[:MAX_ENTRIES]]
+    return [(story['guid'], story['title'], story['story_content'], story.get('link')) for story in stories]
+
+
+def full_parse(raw_feed, known_story_hashes):
+    return summarize(feedparser.parse(raw_feed))
+
+
+def streaming_parse(raw_feed, known_story_hashes):
+    parser = StreamingFeedParser(raw_feed, story_hash=story_hash, max_entries=MAX_ENTRIES,
+                                 known_story_hashes=known_story_hashes)
+    fpf = parser.parse() or feedparser.parse(raw_feed)
+    return summarize(fpf)
+
+
+def measured(func, raw_feed, known_story_hashes, results):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    stories = func(raw_feed, known_story_hashes)
+    duration = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    results.put((stories, duration, peak))
+
+
+def measure(func, raw_feed, known_story_hashes):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measured, args=(func, raw_feed, known_story_hashes, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--known', type=int, default=0,
+                        help="Treat all but the newest N entries as already known")
+    args = parser.parse_args()
+    multiprocessing.set_start_method('fork')
+
+    for fixture in FIXTURES:
+        raw_feed = open(os.path.join(FIXTURES_DIR, fixture), 'rb').read()
+        for entry_count in (1000, 5000):
+            grown = grow_feed(raw_feed, entry_count)
+            known_story_hashes = None
+            if args.known:
+                known_story_hashes = [story_hash(guid) for guid, _, _, _ in
+                                      summarize(feedparser.parse(grown))[args.known:]]
+
+            full_stories, full_time, full_peak = measure(full_parse, grown, known_story_hashes)
+            stream_stories, stream_time, stream_peak = measure(streaming_parse, grown, known_story_hashes)
+            same = stream_stories == full_stories[:len(stream_stories)]
+
+            print("%-26s %5s entries %6sKB: full %7.3fs %7sKB  streaming %7.3fs %7sKB  (%5.1fx) %4s stories %s" % (
+                  fixture, entry_count, len(grown) // 1024, full_time, full_peak, stream_time, stream_peak,
+                  full_time / max(stream_time, 1e-6), len(stream_stories), "OK" if same else "MISMATCH"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+""" Compares finding a story's images with BeautifulSoup, as MStory.extract_image_urls
+did, against utils.story_functions.extract_image_sources(), which reads <img src> in a
+single pass over the markup.
+
+Story contents come from the feed fixtures, or from stored stories with --stories. The
+two must find the same image sources in the same order.
+
+    python perf/bench_image_urls.py --repeat 20
+    python perf/bench_image_urls.py --stories 5000
+"""
+import os
+import sys
+import glob
+import time
+import zlib
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'newsblur_web.settings')
+
+import django
+django.setup()
+
+import feedparser
+from bs4 import BeautifulSoup
+from apps.rss_feeds.models import MStory
+from utils.story_functions import extract_image_sources
+
+
+def soup_image_sources(content):
+    soup = BeautifulSoup(content, features="lxml")
+    return [img.get('src') for img in soup.findAll('img') if img.get('src') is not None]
+
+
+def fixture_contents():
+    contents = []
+    fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apps', 'rss_feeds', 'fixtures')
+    for filename in sorted(glob.glob(os.path.join(fixtures, '*.xml'))):
+        for entry in feedparser.parse(filename).entries:
+            contents.extend(content.value for content in entry.get('content', []))
+            if entry.get('summary'):
+                contents.append(entry.summary)
+    return contents
+
+
+def stored_contents(count):
+    contents = []
+    for story in MStory.objects.only('story_content_z').order_by('-story_date').limit(count):
+        if story.story_content_z:
+            contents.append(zlib.decompress(story.story_content_z))
+    return contents
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stories', type=int, default=0, help="Stored stories to use instead of the fixtures")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    contents = stored_contents(args.stories) if args.stories else fixture_contents()
+    print("%s story contents, %.1fKB on average" % (
+          len(contents), sum(len(c) for c in contents) / 1024.0 / max(len(contents), 1)))
+
+    found = {}
+    for name, extract in (('bs4', soup_image_sources), ('single pass', extract_image_sources)):
+        start = time.time()
+        for _ in range(args.repeat):
+            found[name] = [extract(content) for content in contents]
+        elapsed = (time.time() - start) / args.repeat / max(len(contents), 1)
+        print("%-12s %8.3fms/story, %s images" % (name, elapsed * 1000, sum(len(f) for f in found[name])))
+
+    print("OK" if found['bs4'] == found['single pass'] else "MISMATCH")
+
+
+if __name__ == '__main__':
+    main()
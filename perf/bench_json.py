@@ -0,0 +1,120 @@
+""" Compares encoding json_view responses with json_encode(), which walks every value in
+Python before json.dumps(), against json_encode_bytes(), which hands them to orjson.
+
+Pass recorded responses with --payload, saved from /reader/feeds and
+/reader/river_stories, or by default a load_feeds and a river_stories response are made
+up to look like a heavy user's. Both encoders must decode to the same values.
+
+    python perf/bench_json.py --feeds 2000 --stories 500
+    python perf/bench_json.py --payload load_feeds.json --payload river_stories.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'newsblur_web.settings')
+
+import django
+django.setup()
+
+from utils.json_functions import json_encode, json_encode_bytes, orjson
+
+WORDS = ("apple banana cherry delta echo foxtrot golf hotel india juliet kilo lima mike "
+         "november oscar papa quebec romeo sierra tango uniform victor whiskey xray").split()
+
+
+def load_feeds_response(rng, feed_count):
+    feeds = {}
+    for feed_id in range(1, feed_count + 1):
+        feeds[feed_id] = {
+            'id': feed_id, 'feed_title': ' '.join(rng.sample(WORDS, 3)),
+            'feed_address': 'http://%s.com/rss' % rng.choice(WORDS),
+            'feed_link': 'http://%s.com/' % rng.choice(WORDS),
+            'num_subscribers': rng.randint(0, 10000), 'updated': '%s minutes' % rng.randint(1, 60),
+            'updated_seconds_ago': rng.randint(60, 3600), 'last_story_date': datetime.datetime.now(),
+            'last_story_seconds_ago': rng.randint(60, 86400), 'stories_last_month': rng.randint(0, 900),
+            'average_stories_per_month': rng.randint(0, 900), 'min_to_decay': 60,
+            'subs': rng.randint(1, 10000), 'is_push': False, 'fetched_once': True,
+            'search_indexed': True, 'not_yet_fetched': False, 'favicon_color': '%06x' % rng.getrandbits(24),
+            'favicon_fade': '%06x' % rng.getrandbits(24), 'favicon_border': '%06x' % rng.getrandbits(24),
+            'favicon_text_color': 'white', 'favicon_fetching': False, 'favicon_url': None,
+            's3_page': False, 's3_icon': True, 'disabled_page': False,
+            'ps': rng.randint(0, 20), 'nt': rng.randint(0, 50), 'ng': 0, 'active': True,
+            'feed_opens': rng.randint(0, 100), 'subscribed': True,
+        }
+    folders = [{' '.join(rng.sample(WORDS, 2)): list(range(i, min(i + 50, feed_count + 1)))}
+               for i in range(1, feed_count + 1, 50)]
+    return {'feeds': feeds, 'social_feeds': [], 'social_profile': {}, 'social_services': {},
+            'user_profile': {'is_premium': True, 'preferences': '{}'}, 'folders': folders,
+            'starred_count': 12, 'starred_counts': [], 'saved_searches': [], 'dashboard_rivers': [],
+            'categories': None, 'share_ext_token': 'x' * 40, 'result': 'ok'}
+
+
+def river_stories_response(rng, story_count):
+    stories = []
+    for i in range(story_count):
+        feed_id = rng.randint(1, 2000)
+        stories.append({
+            'story_hash': '%s:%06x' % (feed_id, rng.getrandbits(24)), 'story_feed_id': feed_id,
+            'story_date': datetime.datetime.now(), 'story_timestamp': '1614556800',
+            'story_authors': ' '.join(rng.sample(WORDS, 2)), 'story_title': ' '.join(rng.sample(WORDS, 8)),
+            'story_content': '<p>%s</p>' % ' '.join(rng.choice(WORDS) for _ in range(400)),
+            'story_tags': rng.sample(WORDS, 3), 'story_permalink': 'http://%s.com/%s' % (rng.choice(WORDS), i),
+            'image_urls': [], 'secure_image_urls': {}, 'secure_image_thumbnails': {},
+            'id': 'http://%s.com/%s' % (rng.choice(WORDS), i), 'guid_hash': '%06x' % rng.getrandbits(24),
+            'short_parsed_date': '1 Mar 2021, 9:00am', 'long_parsed_date': 'Monday, March 1st 9:00am',
+            'read_status': 0, 'intelligence': {'feed': 0, 'author': 0, 'tags': 0, 'title': 0},
+            'score': 0, 'comment_count': 0, 'share_count': 0, 'shared_by_friends': [],
+            'commented_by_friends': [], 'starred': False,
+        })
+    return {'stories': stories, 'user_profiles': [], 'feeds': [], 'message': None,
+            'elapsed_time': 0.5, 'result': 'ok'}
+
+
+def timed(encode, payload, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        encoded = encode(payload)
+    return encoded, (time.time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--payload', action='append', default=[], help="A recorded JSON response")
+    parser.add_argument('--feeds', type=int, default=2000)
+    parser.add_argument('--stories', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.payload:
+        payloads = []
+        for filename in args.payload:
+            with open(filename) as f:
+                payloads.append((os.path.basename(filename), json.load(f)))
+    else:
+        rng = random.Random(1)
+        payloads = [('load_feeds', load_feeds_response(rng, args.feeds)),
+                    ('river', river_stories_response(rng, args.stories))]
+
+    if not orjson:
+        print("orjson isn't installed, json_encode_bytes() falls back to json_encode()")
+
+    same = True
+    for name, payload in payloads:
+        walked, walked_time = timed(json_encode, payload, args.repeat)
+        fast, fast_time = timed(json_encode_bytes, payload, args.repeat)
+        same = same and json.loads(walked) == json.loads(fast)
+        print("%-20s %8.1fKB  json_encode %8.2fms  json_encode_bytes %8.2fms  (%.1fx)" % (
+              name, len(fast) / 1024.0, walked_time * 1000, fast_time * 1000,
+              walked_time / max(fast_time, 1e-9)))
+
+    print("OK" if same else "MISMATCH")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+""" Compares marking 1,000 stories read the old way, a SINTER and a publish per story,
+against RUserStory.mark_story_hashes_read(), which pipelines the lot.
+
+Needs a local redis-server. Every redis pool in settings is pointed at one scratch
+database, which is filled with F:, zF:, S: and F:<user_id>:F keys so that some of the
+stories were shared by the user's friends. Both ways start from the same state, and the
+read story keys they leave behind must match. Round trips are counted at the connection.
+
+    redis-server --port 6390 --save '' &
+    python perf/bench_mark_read.py --port 6390
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'newsblur_web.settings')
+
+import django
+django.setup()
+
+import redis
+from django.conf import settings
+from apps.reader.models import RUserStory
+from apps.rss_feeds.models import MStory
+
+USER_ID = 1
+USERNAME = 'bench'
+POOLS = ['REDIS_POOL', 'REDIS_STORY_HASH_POOL', 'REDIS_PUBSUB_POOL', 'REDIS_FEED_READ_POOL']
+
+
+class CountingConnection(redis.Connection):
+    round_trips = 0
+
+    def send_packed_command(self, *args, **kwargs):
+        CountingConnection.round_trips += 1
+        return super().send_packed_command(*args, **kwargs)
+
+
+def populate(r, feed_ids, stories_per_feed, friend_ids, share_ratio):
+    r.flushdb()
+    rng = random.Random(len(feed_ids))
+    now = int(time.time())
+    story_hashes = []
+    pipeline = r.pipeline()
+    pipeline.sadd('F:%s:F' % USER_ID, *friend_ids)
+    for feed_id in feed_ids:
+        hashes = dict(('%s:%06x' % (feed_id, rng.getrandbits(24)), now - i * 600)
+                      for i in range(stories_per_feed))
+        pipeline.sadd('F:%s' % feed_id, *hashes.keys())
+        pipeline.zadd('zF:%s' % feed_id, hashes)
+        for story_hash in hashes:
+            if rng.random() < share_ratio:
+                pipeline.sadd('S:%s' % story_hash, *rng.sample(friend_ids + [999], 2))
+        story_hashes.extend(hashes)
+    pipeline.execute()
+    rng.shuffle(story_hashes)
+    return story_hashes
+
+
+def legacy_mark_read(user_id, story_hashes, username):
+    """ RUserStory.mark_story_hashes_read() before it was batched. """
+    r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
+    s = redis.Redis(connection_pool=settings.REDIS_POOL)
+    ps = redis.Redis(connection_pool=settings.REDIS_PUBSUB_POOL)
+    p = r.pipeline()
+    feed_ids = set()
+    friend_ids = set()
+    single_story = len(story_hashes) == 1
+
+    for story_hash in story_hashes:
+        feed_id, _ = MStory.split_story_hash(story_hash)
+        feed_ids.add(feed_id)
+        if single_story:
+            RUserStory.aggregate_mark_read(feed_id)
+
+        friend_key = "F:%s:F" % (user_id)
+        share_key = "S:%s" % (story_hash)
+        friends_with_shares = [int(f) for f in s.sinter(share_key, friend_key)]
+        friend_ids.update(friends_with_shares)
+        for key in ['RS:%s' % user_id, 'RS:%s:%s' % (user_id, feed_id)] + \
+                   ['RS:%s:B:%s' % (user_id, f) for f in friends_with_shares]:
+            p.sadd(key, story_hash)
+            p.expire(key, settings.DAYS_OF_STORY_HASHES*24*60*60)
+        ps.publish(username, 'story:read:%s' % story_hash)
+        key = 'lRS:%s' % user_id
+        p.lpush(key, story_hash)
+        p.ltrim(key, 0, 1000)
+        p.expire(key, settings.DAYS_OF_STORY_HASHES*24*60*60)
+
+    p.execute()
+    return list(feed_ids), list(friend_ids)
+
+
+def bulk_mark_read(user_id, story_hashes, username):
+    return RUserStory.mark_story_hashes_read(user_id, story_hashes, username=username)
+
+
+def read_state(r):
+    state = {}
+    for key in r.scan_iter(match='*RS:*', count=1000):
+        if key.startswith('lRS:'):
+            state[key] = sorted(r.lrange(key, 0, -1))
+        else:
+            state[key] = sorted(r.smembers(key))
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=14, help="Scratch database, flushed!")
+    parser.add_argument('--stories', type=int, default=1000)
+    parser.add_argument('--feeds', type=int, default=50)
+    parser.add_argument('--friends', type=int, default=20)
+    parser.add_argument('--shared', type=float, default=0.1, help="Fraction of stories shared by friends")
+    args = parser.parse_args()
+
+    pool = redis.ConnectionPool(host=args.host, port=args.port, db=args.db, decode_responses=True,
+                                connection_class=CountingConnection)
+    for name in POOLS:
+        setattr(settings, name, pool)
+    settings.READ_STORIES_BACKEND = 'sets'
+    r = redis.Redis(connection_pool=pool)
+    feed_ids = list(range(1, args.feeds + 1))
+    friend_ids = list(range(100, 100 + args.friends))
+
+    results = {}
+    for name, mark_read in (('legacy', legacy_mark_read), ('bulk', bulk_mark_read)):
+        story_hashes = populate(r, feed_ids, args.stories // args.feeds, friend_ids, args.shared)
+        CountingConnection.round_trips = 0
+        start = time.time()
+        feeds, friends = mark_read(USER_ID, story_hashes, USERNAME)
+        duration = time.time() - start
+        round_trips = CountingConnection.round_trips
+        results[name] = (sorted(map(int, feeds)), sorted(friends), read_state(r))
+        print("%-7s %5s stories in %3s feeds: %7.3fs %6s round trips" % (
+              name, len(story_hashes), len(feeds), duration, round_trips))
+
+    print("OK" if results['legacy'] == results['bulk'] else "MISMATCH")
+    r.flushdb()
+
+
+if __name__ == '__main__':
+    main()
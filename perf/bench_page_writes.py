@@ -0,0 +1,116 @@
+""" Replays a log of original page fetches through PageImporter.save_page() as it was,
+which rewrote (or re-uploaded) every fetched page, and as it is now, which skips pages
+whose MFeedPage.hash_page() digest hasn't changed. Reports bytes written per hour.
+
+The log is JSON lines of {"feed_id": 1, "fetched_at": 1614556800, "html": "..."}. Without
+one, pages are made up whose ads, nonces, timestamps and stylesheet cache busters change on
+every fetch and whose stories change now and then.
+
+    python perf/bench_page_writes.py --feeds 200 --hours 24
+    python perf/bench_page_writes.py --log page_fetches.jsonl
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'newsblur_web.settings')
+
+import django
+django.setup()
+
+from django.utils.encoding import smart_bytes
+from apps.rss_feeds.models import MFeedPage
+
+WORDS = ("apple banana cherry delta echo foxtrot golf hotel india juliet kilo lima mike "
+         "november oscar papa quebec romeo sierra tango uniform victor whiskey xray").split()
+
+
+def made_up_fetches(rng, feed_count, hours, change_rate):
+    """ Yields (feed_id, fetched_at, html, changed) with a fetch per feed every half hour. """
+    start = 1614556800
+    stories = dict((feed_id, [' '.join(rng.sample(WORDS, 6)) for _ in range(20)])
+                   for feed_id in range(1, feed_count + 1))
+    for fetched_at in range(start, start + hours * 3600, 1800):
+        for feed_id, titles in stories.items():
+            changed = fetched_at == start or rng.random() < change_rate
+            if changed and fetched_at != start:
+                titles.insert(0, ' '.join(rng.sample(WORDS, 6)))
+                titles.pop()
+            html = ('<html><head><meta name="csrf-token" content="%x">'
+                    '<script nonce="%x">window.ads = {slot: %s, ts: %s};</script>'
+                    '<link rel="stylesheet" href="/style.css?v=%s"></head>'
+                    '<body data-render-time="%s"><h1>Feed %s</h1>%s'
+                    '<iframe src="https://www.youtube.com/embed/%s"></iframe>'
+                    '<footer>Generated %s <!-- %s queries --></footer></body></html>') % (
+                    rng.getrandbits(64), rng.getrandbits(32), rng.randint(1, 9), fetched_at,
+                    rng.getrandbits(16), rng.random(), feed_id,
+                    ''.join('<article><h2><a href="/%s">%s</a></h2><p>%s</p></article>' % (
+                            i, title, (title + ' ') * 40) for i, title in enumerate(titles)),
+                    feed_id, time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(fetched_at)),
+                    rng.randint(10, 90))
+            yield feed_id, fetched_at, html, changed
+
+
+def logged_fetches(filename):
+    with open(filename) as f:
+        for line in f:
+            fetch = json.loads(line)
+            yield fetch['feed_id'], fetch['fetched_at'], fetch['html'], None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', default=None, help="JSON lines of page fetches")
+    parser.add_argument('--feeds', type=int, default=200)
+    parser.add_argument('--hours', type=int, default=24)
+    parser.add_argument('--change-rate', type=float, default=0.1, help="Chance a fetch has a new story")
+    args = parser.parse_args()
+
+    if args.log:
+        fetches = logged_fetches(args.log)
+    else:
+        fetches = made_up_fetches(random.Random(1), args.feeds, args.hours, args.change_rate)
+
+    page_hashes = {}
+    fetched = before_bytes = after_bytes = after_writes = changes = missed = 0
+    first = last = None
+    hashing = 0.0
+    for feed_id, fetched_at, html, changed in fetches:
+        first = fetched_at if first is None else min(first, fetched_at)
+        last = fetched_at if last is None else max(last, fetched_at)
+        fetched += 1
+        compressed = len(zlib.compress(smart_bytes(html)))
+        # Before, the stored page (bytes) never equaled the fetched one (str), so every
+        # fetch rewrote it, and every fetch was posted to the node page service.
+        before_bytes += compressed
+
+        start = time.time()
+        page_hash = MFeedPage.hash_page(html)
+        hashing += time.time() - start
+        written = page_hashes.get(feed_id) != page_hash
+        if written:
+            page_hashes[feed_id] = page_hash
+            after_bytes += compressed
+            after_writes += 1
+        if changed:
+            changes += 1
+            missed += not written
+
+    hours = max((last or 0) - (first or 0), 3600) / 3600.0
+    print("%s fetches over %.1f hours, %.2fms to hash a page" % (
+          fetched, hours, hashing / max(fetched, 1) * 1000))
+    print("before: %s writes, %8.1fKB/hour" % (fetched, before_bytes / 1024.0 / hours))
+    print("after:  %s writes, %8.1fKB/hour (%.1f%% of before)" % (
+          after_writes, after_bytes / 1024.0 / hours, after_bytes * 100.0 / max(before_bytes, 1)))
+    if not args.log:
+        print("%s of %s changed pages written" % (changes - missed, changes))
+    print("OK" if not missed else "MISMATCH")
+
+
+if __name__ == '__main__':
+    main()
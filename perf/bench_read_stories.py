@@ -0,0 +1,134 @@
+""" Compares the memory and latency of keeping read stories as RS: sets of story hashes
+against RB: bitmaps over each feed's story ordinals, see utils.read_stories.
+
+Needs a local redis-server. Fills a scratch database with F: and zF: keys, then has users
+read a share of every feed's stories through each backend in turn. Memory is summed with
+MEMORY USAGE over the read keys (and FO: ordinals for bitmaps), then marking read, finding
+the unread stories of every feed and trimming are timed, and the unread stories of both
+backends must match.
+
+    redis-server --port 6390 --save '' &
+    python perf/bench_read_stories.py --port 6390
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'newsblur_web.settings')
+
+import django
+django.setup()
+
+import redis
+from utils.feed_functions import chunks
+from utils.read_stories import ReadStorySets, ReadStoryBitmaps
+
+
+def populate(r, feed_ids, stories_per_feed, now):
+    r.flushdb()
+    rng = random.Random(len(feed_ids))
+    feed_stories = {}
+    for feed_group in chunks(feed_ids, 100):
+        pipeline = r.pipeline()
+        for feed_id in feed_group:
+            hashes = dict(('%s:%06x' % (feed_id, rng.getrandbits(24)), now - i * 600)
+                          for i in range(stories_per_feed))
+            pipeline.sadd('F:%s' % feed_id, *hashes.keys())
+            pipeline.zadd('zF:%s' % feed_id, hashes)
+            feed_stories[feed_id] = sorted(hashes, key=hashes.get)
+        pipeline.execute()
+    return feed_stories
+
+
+def memory_usage(r, patterns):
+    total = 0
+    for pattern in patterns:
+        keys = list(r.scan_iter(match=pattern, count=1000))
+        for key_group in chunks(keys, 1000):
+            pipeline = r.pipeline()
+            for key in key_group:
+                pipeline.memory_usage(key)
+            total += sum(usage or 0 for usage in pipeline.execute())
+    return total
+
+
+def mark_read(r, backend, user_ids, feed_stories, read_ratio):
+    rng = random.Random(7)
+    for user_id in user_ids:
+        pipeline = r.pipeline()
+        for feed_id, story_hashes in feed_stories.items():
+            # Readers read from newest to oldest and stop somewhere
+            read_count = min(len(story_hashes), int(len(story_hashes) * read_ratio * rng.random() * 2))
+            for story_hash in story_hashes[len(story_hashes) - read_count:]:
+                backend.mark_read(pipeline, user_id, feed_id, [story_hash])
+        pipeline.execute()
+
+
+def unread_story_hashes(r, backend, user_ids, feed_ids):
+    unread = {}
+    for user_id in user_ids:
+        pipeline = r.pipeline()
+        for feed_id in feed_ids:
+            backend.unread_story_hashes(pipeline, user_id, feed_id)
+        for feed_id, story_hashes in zip(feed_ids, pipeline.execute()):
+            unread[(user_id, feed_id)] = set(story_hashes)
+    return unread
+
+
+def trim(r, backend, user_ids, feed_stories, trimmed_per_feed):
+    pipeline = r.pipeline()
+    for feed_id, story_hashes in feed_stories.items():
+        old = story_hashes[:trimmed_per_feed]
+        pipeline.srem('F:%s' % feed_id, *old)
+        pipeline.zrem('zF:%s' % feed_id, *old)
+    pipeline.execute()
+    for feed_id in feed_stories:
+        backend.trim(r, feed_id, user_ids, forget_stale=True)
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=14, help="Scratch database, flushed!")
+    parser.add_argument('--feeds', type=int, default=200)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--stories', type=int, default=300, help="Stories per feed")
+    parser.add_argument('--read', type=float, default=0.4, help="Average fraction of stories read")
+    args = parser.parse_args()
+
+    r = redis.Redis(host=args.host, port=args.port, db=args.db, decode_responses=True)
+    now = int(time.time())
+    feed_ids = list(range(1, args.feeds + 1))
+    user_ids = list(range(1, args.users + 1))
+
+    results = {}
+    for name, backend, patterns in (('sets', ReadStorySets, ['RS:*']),
+                                    ('bitmaps', ReadStoryBitmaps, ['RB:*', 'FO:*'])):
+        feed_stories = populate(r, feed_ids, args.stories, now)
+        _, mark_time = timed(mark_read, r, backend, user_ids, feed_stories, args.read)
+        memory = memory_usage(r, patterns)
+        unread, unread_time = timed(unread_story_hashes, r, backend, user_ids, feed_ids)
+        _, trim_time = timed(trim, r, backend, user_ids, feed_stories, args.stories // 10)
+        trimmed_memory = memory_usage(r, patterns)
+        results[name] = unread
+        print("%-8s %5s users x %5s feeds: %9.1fKB read state (%9.1fKB trimmed)  "
+              "mark read %7.2fs  unread %7.2fs  trim %7.2fs" % (
+              name, args.users, args.feeds, memory / 1024.0, trimmed_memory / 1024.0,
+              mark_time, unread_time, trim_time))
+
+    print("OK" if results['sets'] == results['bitmaps'] else "MISMATCH")
+    r.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+""" Compares assembling a river's ranked story hashes the old way, per feed, against the
+server-side script in utils.redis_scripts.
+
+Needs a local redis-server. Fills a scratch database with F:, zF: and RS: keys for users
+subscribed to 100, 1,000 and 5,000 feeds, then builds the same ranked river both ways and
+checks they match. Round trips are counted at the connection, commands with INFO.
+
+    redis-server --port 6390 --save '' &
+    python perf/bench_river_assembly.py --port 6390
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import redis
+from utils.feed_functions import chunks
+from utils.redis_scripts import rank_river_stories
+
+USER_ID = 1
+
+
+class CountingConnection(redis.Connection):
+    round_trips = 0
+
+    def send_packed_command(self, *args, **kwargs):
+        CountingConnection.round_trips += 1
+        return super().send_packed_command(*args, **kwargs)
+
+
+def populate(r, feed_ids, stories_per_feed, read_ratio, now):
+    r.flushdb()
+    rng = random.Random(len(feed_ids))
+    for feed_group in chunks(feed_ids, 100):
+        pipeline = r.pipeline()
+        for feed_id in feed_group:
+            hashes = {}
+            for i in range(stories_per_feed):
+                story_hash = '%s:%06x' % (feed_id, rng.getrandbits(24))
+                hashes[story_hash] = now - rng.randint(0, 60*60*24*30)
+            pipeline.sadd('F:%s' % feed_id, *hashes.keys())
+            pipeline.zadd('zF:%s' % feed_id, hashes)
+            read = [h for h in hashes if rng.random() < read_ratio]
+            if read:
+                pipeline.sadd('RS:%s:%s' % (USER_ID, feed_id), *read)
+        pipeline.execute()
+
+
+def legacy_river(r, rt, ranked_key, feed_ids, read_dates, unread, current_time):
+    """ UserSubscription.story_hashes() + the ZADD loop in feed_stories(), before the script. """
+    story_hashes = []
+    for feed_id_group in chunks(feed_ids, 20):
+        pipeline = r.pipeline()
+        for feed_id in feed_id_group:
+            stories_key               = 'F:%s' % feed_id
+            sorted_stories_key        = 'zF:%s' % feed_id
+            read_stories_key          = 'RS:%s:%s' % (USER_ID, feed_id)
+            unread_stories_key        = 'U:%s:%s' % (USER_ID, feed_id)
+            unread_ranked_stories_key = 'zU:%s:%s' % (USER_ID, feed_id)
+            if unread:
+                min_score = read_dates[feed_id] + 1
+                pipeline.sdiffstore(unread_stories_key, stories_key, read_stories_key)
+            else:
+                min_score = 0
+                unread_stories_key = stories_key
+            pipeline.zinterstore(unread_ranked_stories_key, [sorted_stories_key, unread_stories_key])
+            pipeline.zrevrangebyscore(unread_ranked_stories_key, current_time, min_score, withscores=True)
+            pipeline.delete(unread_ranked_stories_key)
+            if unread:
+                pipeline.delete(unread_stories_key)
+        for hashes in pipeline.execute():
+            if isinstance(hashes, list):
+                story_hashes.extend(hashes)
+
+    rt.delete(ranked_key)
+    if story_hashes:
+        pipeline = rt.pipeline()
+        for story_hash_group in chunks(story_hashes, 100):
+            pipeline.zadd(ranked_key, dict(story_hash_group))
+        pipeline.execute()
+    return len(story_hashes)
+
+
+def scripted_river(r, rt, ranked_key, feed_ids, read_dates, unread, current_time):
+    """ UserSubscription.rank_story_hashes(). """
+    if unread:
+        feed_min_scores = [(feed_id, read_dates[feed_id] + 1) for feed_id in feed_ids]
+    else:
+        feed_min_scores = [(feed_id, 0) for feed_id in feed_ids]
+    ranked, dump = rank_river_stories(r, ranked_key, USER_ID, feed_min_scores,
+                                      max_score=current_time, unread_only=unread, dump=True)
+    if dump:
+        pipeline = rt.pipeline()
+        pipeline.delete(ranked_key)
+        pipeline.restore(ranked_key, 60*60*1000, dump)
+        pipeline.execute()
+    return ranked
+
+
+def measure(func, r, rt, *args):
+    commands = int(r.info('stats')['total_commands_processed'])
+    CountingConnection.round_trips = 0
+    start = time.time()
+    ranked = func(r, rt, *args)
+    duration = time.time() - start
+    round_trips = CountingConnection.round_trips
+    commands = int(r.info('stats')['total_commands_processed']) - commands - 1
+    return ranked, duration, round_trips, commands
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=14, help="Scratch database, flushed!")
+    parser.add_argument('--stories', type=int, default=30, help="Stories per feed")
+    parser.add_argument('--read', type=float, default=0.5, help="Fraction of stories read")
+    args = parser.parse_args()
+
+    def client(db):
+        pool = redis.ConnectionPool(host=args.host, port=args.port, db=db,
+                                    connection_class=CountingConnection)
+        return redis.Redis(connection_pool=pool)
+    r = client(args.db)
+    rt = client(args.db + 1)
+
+    now = int(time.time())
+    current_time = now + 60*60*24
+    for feed_count in (100, 1000, 5000):
+        feed_ids = list(range(1, feed_count + 1))
+        populate(r, feed_ids, args.stories, args.read, now)
+        rng = random.Random(feed_count)
+        read_dates = dict((feed_id, now - rng.randint(60*60*24, 60*60*24*14)) for feed_id in feed_ids)
+
+        for unread in (True, False):
+            legacy = measure(legacy_river, r, rt, 'zU:legacy', feed_ids, read_dates, unread, current_time)
+            scripted = measure(scripted_river, r, rt, 'zU:scripted', feed_ids, read_dates, unread, current_time)
+            same = (rt.zrevrange('zU:legacy', 0, -1, withscores=True) ==
+                    rt.zrevrange('zU:scripted', 0, -1, withscores=True))
+            for name, (ranked, duration, round_trips, commands) in (('legacy', legacy), ('script', scripted)):
+                print("%5s feeds %-6s %-6s %6s stories  %8.1fms  %5s round trips  %6s commands" % (
+                      feed_count, 'unread' if unread else 'all', name, ranked, duration * 1000,
+                      round_trips, commands))
+            print("%28s %s" % ('', "OK" if same else "MISMATCH"))
+
+    r.flushdb()
+    rt.flushdb()
+
+
+if __name__ == '__main__':
+    main()
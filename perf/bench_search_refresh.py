@@ -0,0 +1,216 @@
+""" Compares story search latency when every query flushes the index first, as
+SearchStory.query() used to, against relying on near-real-time refresh, while stories are
+being indexed through SearchStory.index()'s buffer in the background.
+
+Runs against a real single-node Elasticsearch or OpenSearch with --host, or by default
+against an in-process stand-in (FakeNode below) behind the real client. The stand-in
+makes a flush what it is on a real node, a commit that writes and fsyncs a segment of
+everything indexed since the last one, while a refresh only makes those documents
+searchable. It also checks that flush_buffer(refresh=True) and query(refresh=True) read
+their own writes.
+
+    python perf/bench_search_refresh.py --queries 500
+    python perf/bench_search_refresh.py --host http://localhost:9200
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'newsblur_web.settings')
+
+import django
+django.setup()
+
+import elasticsearch
+from apps.search.models import SearchStory
+
+WORDS = ("apple banana cherry delta echo foxtrot golf hotel india juliet kilo lima mike "
+         "november oscar papa quebec romeo sierra tango uniform victor whiskey xray").split()
+REFRESH_INTERVAL = 1.0
+
+
+class FakeNode:
+    """ One in-process index, enough of the REST API for SearchStory. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.docs = {}
+        self.searchable = set()
+        self.uncommitted = []
+        self.last_refresh = time.time()
+        self.segments = tempfile.mkdtemp(prefix='bench_search_')
+
+    def refresh(self):
+        self.searchable = set(self.docs)
+        self.last_refresh = time.time()
+
+    def flush(self):
+        # A commit writes out and fsyncs everything since the last one
+        with open(os.path.join(self.segments, 'segment_%s' % time.time()), 'w') as segment:
+            for doc_id in self.uncommitted:
+                segment.write(json.dumps(self.docs[doc_id], default=str))
+            segment.flush()
+            os.fsync(segment.fileno())
+        self.uncommitted = []
+        self.refresh()
+
+    def bulk(self, body, params):
+        lines = [json.loads(line) for line in body.strip().split('\n')]
+        items = []
+        for action, doc in zip(lines[::2], lines[1::2]):
+            doc_id = action['create']['_id']
+            if doc_id in self.docs:
+                items.append({'create': {'_id': doc_id, 'status': 409}})
+                continue
+            self.docs[doc_id] = doc
+            self.uncommitted.append(doc_id)
+            items.append({'create': {'_id': doc_id, 'status': 201}})
+        if params.get('refresh') in ('wait_for', b'wait_for'):
+            self.refresh()
+        return {'errors': False, 'items': items}
+
+    def search(self, body):
+        if time.time() - self.last_refresh > REFRESH_INTERVAL:
+            self.refresh()
+        must = body['query']['bool']['must']
+        terms = must[0]['query_string']['query'].lower().split()
+        feed_ids = set(must[1]['terms']['feed_id']) if len(must) > 1 else None
+        hits = []
+        for doc_id in self.searchable:
+            doc = self.docs[doc_id]
+            if feed_ids is not None and doc['feed_id'] not in feed_ids:
+                continue
+            text = ('%s %s' % (doc['title'], doc['content'])).lower().split()
+            if all(term in text for term in terms):
+                hits.append((doc['date'], doc_id))
+        hits.sort(reverse=body['sort'][0]['date']['order'] == 'desc')
+        hits = hits[body['from']:body['from'] + body['size']]
+        return {'hits': {'hits': [{'_id': doc_id} for _, doc_id in hits]}}
+
+    def perform_request(self, method, url, params, body):
+        path = [part for part in url.split('?')[0].split('/') if part]
+        with self.lock:
+            if method == 'HEAD':
+                return {}
+            if path[-1] == '_bulk':
+                return self.bulk(body.decode('utf-8') if isinstance(body, bytes) else body, params)
+            if path[-1] == '_flush':
+                self.flush()
+                return {}
+            if path[-1] == '_refresh':
+                self.refresh()
+                return {}
+            if path[-1] == '_search':
+                return self.search(json.loads(body))
+            return {'acknowledged': True}
+
+
+NODE = FakeNode()
+
+
+class FakeConnection(elasticsearch.Connection):
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        response = NODE.perform_request(method, url, params or {}, body)
+        return 200, {}, json.dumps(response)
+
+
+def story(rng, feed_ids, i, now):
+    feed_id = rng.choice(feed_ids)
+    return dict(story_hash='%s:%06x' % (feed_id, i), story_title=' '.join(rng.sample(WORDS, 4)),
+                story_content=' '.join(rng.choice(WORDS) for _ in range(60)), story_tags=[],
+                story_author='', story_feed_id=feed_id,
+                story_date=now - datetime.timedelta(minutes=i))
+
+
+def indexer(rng, feed_ids, rate, stop, counter):
+    now = datetime.datetime.utcnow()
+    i = counter[0]
+    while not stop.is_set():
+        SearchStory.index(**story(rng, feed_ids, i, now))
+        i += 1
+        counter[0] = i
+        time.sleep(1.0 / rate)
+
+
+def percentile(timings, pct):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * pct / 100.0))]
+
+
+def run_queries(rng, feed_ids, count, qps, flush_first):
+    timings = []
+    for _ in range(count):
+        time.sleep(1.0 / qps)
+        query = ' '.join(rng.sample(WORDS, 2))
+        start = time.time()
+        if flush_first:
+            SearchStory.ES().indices.flush(SearchStory.index_name())
+        SearchStory.query(feed_ids=rng.sample(feed_ids, 20), query=query, order="newest",
+                          offset=0, limit=12)
+        timings.append(time.time() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', help="A scratch Elasticsearch/OpenSearch node, its stories-index is dropped!")
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--feeds', type=int, default=100)
+    parser.add_argument('--qps', type=int, default=50, help="Queries per second")
+    parser.add_argument('--rate', type=int, default=500, help="Stories indexed per second while querying")
+    args = parser.parse_args()
+
+    if args.host:
+        SearchStory._es_client = elasticsearch.Elasticsearch(args.host)
+        SearchStory.create_elasticsearch_mapping(delete=True)
+    else:
+        SearchStory._es_client = elasticsearch.Elasticsearch('http://fake:9200', connection_class=FakeConnection)
+    feed_ids = list(range(1, args.feeds + 1))
+    rng = random.Random(1)
+
+    # Read your writes: freshly indexed stories are searchable once flushed with refresh
+    now = datetime.datetime.utcnow()
+    fresh = [story(rng, feed_ids, 10**6 + i, now) for i in range(50)]
+    for doc in fresh:
+        doc['story_title'] += ' zulu'
+        SearchStory.index(**doc)
+    SearchStory.flush_buffer(refresh=True)
+    found = SearchStory.query(feed_ids=feed_ids, query='zulu', order="newest", offset=0, limit=100)
+    SearchStory.index(**dict(fresh[0], story_hash='%s:ffffff' % fresh[0]['story_feed_id']))
+    found_after_refresh = SearchStory.query(feed_ids=feed_ids, query='zulu', order="newest",
+                                            offset=0, limit=100, refresh=True)
+    same = len(found) == len(fresh) and len(found_after_refresh) == len(fresh) + 1
+
+    for name, flush_first in (('flush', True), ('nrt', False)):
+        # Both start from an empty index
+        if args.host:
+            SearchStory.create_elasticsearch_mapping(delete=True)
+        else:
+            NODE.__init__()
+        counter = [0]
+        stop = threading.Event()
+        thread = threading.Thread(target=indexer, args=(random.Random(2), feed_ids, args.rate, stop, counter))
+        thread.start()
+        timings = run_queries(random.Random(3), feed_ids, args.queries, args.qps, flush_first)
+        stop.set()
+        thread.join()
+        SearchStory.flush_buffer()
+        print("%-6s %5s queries, %6s stories indexed: p50 %7.2fms  p95 %7.2fms  p99 %7.2fms" % (
+              name, len(timings), counter[0], percentile(timings, 50) * 1000,
+              percentile(timings, 95) * 1000, percentile(timings, 99) * 1000))
+
+    print("OK" if same else "MISMATCH")
+    if args.host:
+        SearchStory.drop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+""" Compares utils.feed_functions.timelimit as it was, a thread per call, against the
+Deadline it now runs calls under.
+
+Times many calls that finish well within their limit, then makes calls that overrun it
+and counts the threads left behind and the work they keep doing after TimeoutError.
+
+    python perf/bench_timelimit.py --calls 20000 --timeouts 50
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'newsblur_web.settings')
+
+import django
+django.setup()
+
+from utils.feed_functions import timelimit, TimeoutError
+
+
+def legacy_timelimit(timeout):
+    """ timelimit() before Deadline, without its error mail. """
+    def _1(function):
+        def _2(*args, **kw):
+            class Dispatch(threading.Thread):
+                def __init__(self):
+                    threading.Thread.__init__(self)
+                    self.result = None
+                    self.error = None
+                    self.daemon = True
+                    self.start()
+
+                def run(self):
+                    try:
+                        self.result = function(*args, **kw)
+                    except BaseException as e:
+                        self.error = e
+            c = Dispatch()
+            c.join(timeout)
+            if c.is_alive():
+                raise TimeoutError('took too long')
+            if c.error:
+                raise c.error
+            return c.result
+        return _2
+    return _1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=20000, help="Calls within their limit")
+    parser.add_argument('--timeouts', type=int, default=50, help="Calls that overrun their limit")
+    parser.add_argument('--limit', type=float, default=0.02, help="Seconds allowed per overrunning call")
+    args = parser.parse_args()
+
+    results = {}
+    for name, limit in (('threads', legacy_timelimit), ('deadline', timelimit)):
+        work = [0]
+
+        @limit(10)
+        def quick(x):
+            return x + 1
+
+        @limit(args.limit)
+        def overrun():
+            # Stands in for a story diff that takes too long
+            end = time.time() + args.limit * 5
+            while time.time() < end:
+                work[0] += 1
+                time.sleep(0.001)
+
+        start = time.time()
+        total = sum(quick(i) for i in range(args.calls))
+        overhead = (time.time() - start) / args.calls
+
+        threads = threading.active_count()
+        timed_out = 0
+        for _ in range(args.timeouts):
+            try:
+                overrun()
+            except TimeoutError:
+                timed_out += 1
+        leaked = threading.active_count() - threads
+        done = work[0]
+        time.sleep(args.limit * 5)
+        after_timeout = work[0] - done
+
+        results[name] = (total, timed_out)
+        print("%-9s %6.1fus/call  %3s/%s timed out, %3s threads left running, "
+              "%5s units of work done after timing out" % (
+              name, overhead * 1e6, timed_out, args.timeouts, leaked, after_timeout))
+
+    print("OK" if results['threads'] == results['deadline'] else "MISMATCH")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import time
+import queue
+import asyncio
+import threading
+import urllib.parse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from utils.feed_functions import TimeoutError
+
+
+class AsyncFetcher:
+    """ Overlaps slow network fetches with serial processing.
+
+    An asyncio loop running in a background thread schedules the blocking
+    `fetch` callable on a bounded pool, never running more than `max_in_flight`
+    fetches at once nor more than `max_per_host` against a single host. Results
+    are handed back to the calling thread in completion order, and at most
+    `max_buffered` results are held in memory waiting to be consumed. A fetch
+    still running after `timeout` seconds is handed back with a TimeoutError,
+    though its thread is only freed once `fetch` itself gives up, so `fetch`
+    should be bounded too.
+
+    The fetches themselves stay on requests/feedparser so that ETag,
+    If-Modified-Since and fake user agent fallbacks behave exactly as
+    they do when fetching serially.
+    """
+
+    def __init__(self, fetch, host_for=None, max_in_flight=10, max_per_host=2, max_buffered=None,
+                 timeout=None):
+        self.fetch = fetch
+        self.timeout = timeout
+        self.host_for = host_for or (lambda job: urllib.parse.urlparse(str(job)).netloc)
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.max_per_host = max(1, int(max_per_host))
+        self.max_buffered = max(self.max_in_flight, int(max_buffered or 2 * self.max_in_flight))
+        self.loop = None
+        self.buffered = None
+
+    def run(self, jobs):
+        """ Yields (job, result, error, duration) tuples as fetches complete.
+        The jobs are materialized up front so they are built in the calling thread.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return
+
+        self.results = queue.Queue()
+        self.started = threading.Event()
+        thread = threading.Thread(target=self._run_loop, args=(jobs,), daemon=True)
+        thread.start()
+        self.started.wait()
+
+        for _ in range(len(jobs)):
+            job, result, error, duration = self.results.get()
+            try:
+                self.loop.call_soon_threadsafe(self.buffered.release)
+            except RuntimeError:
+                # Loop has already finished scheduling and closed
+                pass
+            yield job, result, error, duration
+
+        thread.join()
+
+    def _run_loop(self, jobs):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self._schedule(jobs))
+        finally:
+            self.loop.close()
+
+    async def _schedule(self, jobs):
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        host_limits = defaultdict(lambda: asyncio.Semaphore(self.max_per_host))
+        self.buffered = asyncio.Semaphore(self.max_buffered)
+        self.started.set()
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            async def fetch_job(job):
+                result = error = None
+                async with host_limits[self.host_for(job)]:
+                    async with in_flight:
+                        start = time.time()
+                        try:
+                            result = await asyncio.wait_for(
+                                self.loop.run_in_executor(executor, self.fetch, job), self.timeout)
+                        except asyncio.TimeoutError:
+                            error = TimeoutError('took too long')
+                        except Exception as e:
+                            error = e
+                        duration = time.time() - start
+                self.results.put((job, result, error, duration))
+
+            tasks = []
+            for job in jobs:
+                await self.buffered.acquire()
+                tasks.append(asyncio.ensure_future(fetch_job(job)))
+            await asyncio.gather(*tasks)
@@ -2,6 +2,7 @@ import time
 import datetime
 import traceback
 import multiprocessing
+import socket
 
 import django
 django.setup()
@@ -28,6 +29,7 @@ from apps.rss_feeds.icon_importer import IconImporter
 from apps.notifications.tasks import QueueNotifications
 from apps.notifications.models import MUserFeedNotification
 from apps.push.models import PushSubscription
+from apps.search.models import SearchStory
 from apps.statistics.models import MAnalyticsFetcher, MStatistics
 
 import feedparser
@@ -48,6 +50,8 @@ from celery.exceptions import SoftTimeLimitExceeded
 from utils.twitter_fetcher import TwitterFetcher
 from utils.facebook_fetcher import FacebookFetcher
 from utils.json_fetcher import JSONFetcher
+from utils.async_fetcher import AsyncFetcher
+from utils.feed_stream import StreamingFeedParser
 # from utils.feed_functions import mail_feed_error_to_admin
 
 
@@ -55,6 +59,8 @@ from utils.json_fetcher import JSONFetcher
 # http://feedjack.googlecode.com
 
 FEED_OK, FEED_SAME, FEED_ERRPARSE, FEED_ERRHTTP, FEED_ERREXC = list(range(5))
+MAX_ENTRIES = 100
+FETCH_TIMEOUT = 30
     
     
 class FetchFeed:
@@ -64,7 +70,7 @@ class FetchFeed:
         self.fpf = None
         self.raw_feed = None
     
-    @timelimit(30)
+    @timelimit(FETCH_TIMEOUT)
     def fetch(self):
         """ 
         Uses requests to download the feed, parsing it in feedparser. Will be storified later.
@@ -162,8 +168,10 @@ class FetchFeed:
                     response_headers = raw_feed.headers
                     response_headers['Content-Location'] = raw_feed.url
                     self.raw_feed = smart_str(raw_feed.content)
-                    self.fpf = feedparser.parse(self.raw_feed,
-                                                response_headers=response_headers)
+                    self.fpf = self.stream_feed(raw_feed.content, response_headers)
+                    if not self.fpf:
+                        self.fpf = feedparser.parse(self.raw_feed,
+                                                    response_headers=response_headers)
                     if self.options['verbose']:
                         logging.debug(" ---> [%-30s] ~FBFeed fetch status %s: %s length / %s" % (self.feed.log_title[:30], 
                                                                                                  raw_feed.status_code, 
@@ -205,6 +213,27 @@ class FetchFeed:
 
         return FEED_OK, self.fpf
         
+    def stream_feed(self, content, response_headers):
+        """
+        Parses only the first entries of a feed, up to the ones already known, and
+        returns None when the whole feed has to go through feedparser.
+        """
+        if not self.options.get('stream_parse', True):
+            return
+        known_story_hashes = None
+        if not self.options.get('force'):
+            known_story_hashes = self.feed.story_hashes_in_unread_cutoff
+        parser = StreamingFeedParser(content,
+                                     story_hash=lambda guid: MStory.feed_guid_hash_unsaved(self.feed.pk, guid),
+                                     max_entries=MAX_ENTRIES,
+                                     known_story_hashes=known_story_hashes)
+        fpf = parser.parse(response_headers=response_headers)
+        if fpf and self.options['verbose']:
+            logging.debug('   ---> [%-30s] ~FBStreamed ~SB%s~SN entries (%s known) of %s bytes' % (
+                          self.feed.log_title[:30], parser.entry_count, parser.known_count,
+                          len(content)))
+        return fpf
+    
     def get_identity(self):
         identity = "X"
 
@@ -261,9 +290,9 @@ class FetchFeed:
                 return            
         
         if channel_id:
-            video_ids_xml = requests.get("https://www.youtube.com/feeds/videos.xml?channel_id=%s" % channel_id)
+            video_ids_xml = requests.get("https://www.youtube.com/feeds/videos.xml?channel_id=%s" % channel_id, timeout=15)
             channel_json = requests.get("https://www.googleapis.com/youtube/v3/channels?part=snippet&id=%s&key=%s" %
-                                       (channel_id, settings.YOUTUBE_API_KEY))
+                                       (channel_id, settings.YOUTUBE_API_KEY), timeout=15)
             channel = json.decode(channel_json.content)
             try:
                 username = channel['items'][0]['snippet']['title']
@@ -272,7 +301,7 @@ class FetchFeed:
                 return
         elif list_id:
             playlist_json = requests.get("https://www.googleapis.com/youtube/v3/playlists?part=snippet&id=%s&key=%s" %
-                                       (list_id, settings.YOUTUBE_API_KEY))
+                                       (list_id, settings.YOUTUBE_API_KEY), timeout=15)
             playlist = json.decode(playlist_json.content)
             try:
                 username = playlist['items'][0]['snippet']['title']
@@ -281,14 +310,14 @@ class FetchFeed:
                 return
             channel_url = "https://www.youtube.com/playlist?list=%s" % list_id
         elif username:
-            video_ids_xml = requests.get("https://www.youtube.com/feeds/videos.xml?user=%s" % username)
+            video_ids_xml = requests.get("https://www.youtube.com/feeds/videos.xml?user=%s" % username, timeout=15)
             description = "YouTube videos uploaded by %s" % username
         else:
             return
                     
         if list_id:
             playlist_json = requests.get("https://www.googleapis.com/youtube/v3/playlistItems?part=snippet&playlistId=%s&key=%s" %
-                                       (list_id, settings.YOUTUBE_API_KEY))
+                                       (list_id, settings.YOUTUBE_API_KEY), timeout=15)
             playlist = json.decode(playlist_json.content)
             try:
                 video_ids = [video['snippet']['resourceId']['videoId'] for video in playlist['items']]
@@ -485,7 +514,7 @@ class ProcessFeed:
         if self.feed.last_modified != original_last_modified:
             self.feed.save(update_fields=['last_modified'])
         
-        self.fpf.entries = self.fpf.entries[:100]
+        self.fpf.entries = self.fpf.entries[:MAX_ENTRIES]
         
         original_title = self.feed.feed_title
         if self.fpf.feed.get('title'):
@@ -684,7 +713,13 @@ class FeedFetcherWorker:
         if current_process._identity:
             identity = current_process._identity[0]
 
-        for feed_id in feed_queue:
+        fetch_concurrency = self.options.get('fetch_concurrency') or 1
+        if fetch_concurrency > 1 and len(feed_queue) > 1:
+            feed_jobs = self.prefetch_feeds(feed_queue, fetch_concurrency)
+        else:
+            feed_jobs = ((feed_id, None) for feed_id in feed_queue)
+
+        for feed_id, prefetched in feed_jobs:
             start_duration = time.time()
             feed_fetch_duration = None
             feed_process_duration = None
@@ -700,37 +735,19 @@ class FeedFetcherWorker:
                 feed = self.refresh_feed(feed_id)
                 set_user({"id": feed_id, "username": feed.feed_title})
                 
-                skip = False
-                if self.options.get('fake'):
-                    skip = True
-                    weight = "-"
-                    quick = "-"
-                    rand = "-"
-                elif (self.options.get('quick') and not self.options['force'] and 
-                      feed.known_good and feed.fetched_once and not feed.is_push):
-                    weight = feed.stories_last_month * feed.num_subscribers
-                    random_weight = random.randint(1, max(weight, 1))
-                    quick = float(self.options.get('quick', 0))
-                    rand = random.random()
-                    if random_weight < 1000 and rand < quick:
-                        skip = True
-                elif False and feed.feed_address.startswith("http://news.google.com/news"):
-                    skip = True
-                    weight = "-"
-                    quick = "-"
-                    rand = "-"
-                if skip:
-                    logging.debug('   ---> [%-30s] ~BGFaking fetch, skipping (%s/month, %s subs, %s < %s)...' % (
-                        feed.log_title[:30],
-                        weight,
-                        feed.num_subscribers,
-                        rand, quick))
-                    continue
+                if prefetched:
+                    ffeed, fetch_result, fetch_error, feed_fetch_duration = prefetched
+                    if fetch_error:
+                        raise fetch_error
+                    ret_feed, fetched_feed = fetch_result
+                else:
+                    if self.skip_feed(feed):
+                        continue
                     
-                ffeed = FetchFeed(feed_id, self.options)
-                ret_feed, fetched_feed = ffeed.fetch()
+                    ffeed = FetchFeed(feed_id, self.options)
+                    ret_feed, fetched_feed = ffeed.fetch()
 
-                feed_fetch_duration = time.time() - start_duration
+                    feed_fetch_duration = time.time() - start_duration
                 raw_feed = ffeed.raw_feed
                 
                 if ((fetched_feed and ret_feed == FEED_OK) or self.options['force']):
@@ -898,12 +915,79 @@ class FeedFetcherWorker:
                                   total=total_duration, feed_code=feed_code)
             
             self.feed_stats[ret_feed] += 1
+        
+        # Updated stories wait in a per-process buffer to be indexed for search
+        SearchStory.flush_buffer()
             
         if len(feed_queue) == 1:
             return feed
         
         # time_taken = datetime.datetime.utcnow() - self.time_start
     
+    def skip_feed(self, feed):
+        skip = False
+        if self.options.get('fake'):
+            skip = True
+            weight = "-"
+            quick = "-"
+            rand = "-"
+        elif (self.options.get('quick') and not self.options['force'] and 
+              feed.known_good and feed.fetched_once and not feed.is_push):
+            weight = feed.stories_last_month * feed.num_subscribers
+            random_weight = random.randint(1, max(weight, 1))
+            quick = float(self.options.get('quick', 0))
+            rand = random.random()
+            if random_weight < 1000 and rand < quick:
+                skip = True
+        elif False and feed.feed_address.startswith("http://news.google.com/news"):
+            skip = True
+            weight = "-"
+            quick = "-"
+            rand = "-"
+        if skip:
+            logging.debug('   ---> [%-30s] ~BGFaking fetch, skipping (%s/month, %s subs, %s < %s)...' % (
+                feed.log_title[:30],
+                weight,
+                feed.num_subscribers,
+                rand, quick))
+        
+        return skip
+    
+    def prefetch_feeds(self, feed_queue, fetch_concurrency):
+        """ Fetches feeds concurrently, yielding (feed_id, prefetched) as each
+        download finishes so parsing and storing can proceed serially. Feeds that
+        can't be loaded are yielded with nothing prefetched, which leaves them to
+        the serial path and its error handling.
+        """
+        fetch_jobs = []
+        for feed_id in feed_queue:
+            ffeed = FetchFeed(feed_id, self.options)
+            if not ffeed.feed:
+                yield feed_id, None
+                continue
+            if self.skip_feed(ffeed.feed):
+                continue
+            fetch_jobs.append(ffeed)
+        
+        def fetch(ffeed):
+            try:
+                return ffeed.fetch()
+            finally:
+                # Fetches run in pooled threads, which must not hold onto db connections
+                django.db.connection.close()
+        
+        if socket.getdefaulttimeout() is None:
+            # feedparser's own fetches take no timeout, only the socket's
+            socket.setdefaulttimeout(self.options.get('timeout') or 15)
+        fetcher = AsyncFetcher(fetch,
+                               host_for=lambda ffeed: urllib.parse.urlparse(ffeed.feed.feed_address).netloc,
+                               max_in_flight=fetch_concurrency,
+                               max_per_host=self.options.get('fetch_concurrency_per_host') or 2,
+                               timeout=FETCH_TIMEOUT)
+        logging.debug('   ---> Fetching ~SB%s~SN feeds, ~SB%s~SN at a time...' % (len(fetch_jobs), fetch_concurrency))
+        for ffeed, fetch_result, fetch_error, fetch_duration in fetcher.run(fetch_jobs):
+            yield ffeed.feed.pk, (ffeed, fetch_result, fetch_error, fetch_duration)
+        
     def publish_to_subscribers(self, feed, new_count):
         try:
             r = redis.Redis(connection_pool=settings.REDIS_PUBSUB_POOL)
@@ -922,10 +1006,7 @@ class FeedFetcherWorker:
         if not user_subs.count():
             return
             
-        for sub in user_subs:
-            if not sub.needs_unread_recalc:
-                sub.needs_unread_recalc = True
-                sub.save()
+        user_subs.filter(needs_unread_recalc=False).update(needs_unread_recalc=True)
 
         if self.options['compute_scores']:
             r = redis.Redis(connection_pool=settings.REDIS_STORY_HASH_POOL)
@@ -946,16 +1027,16 @@ class FeedFetcherWorker:
             logging.debug('   ---> [%-30s] ~FYComputing scores: ~SB%s stories~SN with ~SB%s subscribers ~SN(%s/%s/%s)' % (
                           feed.log_title[:30], len(stories), user_subs.count(),
                           feed.num_subscribers, feed.active_subscribers, feed.premium_subscribers))        
-            self.calculate_feed_scores_with_stories(user_subs, stories)
+            self.calculate_feed_scores_with_stories(feed, user_subs, stories)
         elif self.options.get('mongodb_replication_lag'):
             logging.debug('   ---> [%-30s] ~BR~FYSkipping computing scores: ~SB%s seconds~SN of mongodb lag' % (
               feed.log_title[:30], self.options.get('mongodb_replication_lag')))
     
     @timelimit(10)
-    def calculate_feed_scores_with_stories(self, user_subs, stories):
-        for sub in user_subs:
-            silent = False if getattr(self.options, 'verbose', 0) >= 2 else True
-            sub.calculate_feed_scores(silent=silent, stories=stories)
+    def calculate_feed_scores_with_stories(self, feed, user_subs, stories):
+        silent = False if getattr(self.options, 'verbose', 0) >= 2 else True
+        UserSubscription.calculate_feed_scores_for_subscribers(feed, user_subs, stories=stories,
+                                                               silent=silent)
 
 class Dispatcher:
     def __init__(self, options, num_threads):
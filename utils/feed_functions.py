@@ -1,4 +1,7 @@
 import datetime
+import time
+import signal
+import functools
 import threading
 import sys
 import traceback
@@ -14,40 +17,169 @@ from utils import log as logging
 
 
 class TimeoutError(Exception): pass
+
+
+class Deadline:
+    """
+    A time budget for a block of work, without a thread per call. Long loops check it
+    cooperatively with check_deadline(), and on the main thread a SIGALRM timer also
+    interrupts blocking calls, so nothing is left running once TimeoutError is raised.
+    Off the main thread only the cooperative checks apply. Deadlines nest, the first one
+    to expire raises.
+
+        with Deadline(10):
+            for story in stories:
+                check_deadline()
+                ...
+    """
+    _local = threading.local()
+    # Once expired, the alarm keeps going off this often, so a handler that swallows one
+    # TimeoutError doesn't leave the call running without a limit.
+    REPEAT = 0.05
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = None
+        self.alarm = False
+
+    @classmethod
+    def active(cls):
+        if not hasattr(cls._local, 'deadlines'):
+            cls._local.deadlines = []
+        return cls._local.deadlines
+
+    @classmethod
+    def current(cls):
+        """The active deadline of this thread that expires first."""
+        deadlines = cls.active()
+        return deadlines and min(deadlines, key=lambda deadline: deadline.expires_at) or None
+
+    def remaining(self):
+        return max(0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def check(self):
+        if self.expired():
+            raise TimeoutError('took too long')
+
+    @classmethod
+    def _can_alarm(cls):
+        if not hasattr(signal, 'setitimer'):
+            return False
+        if threading.current_thread() is not threading.main_thread():
+            return False
+        # Don't take SIGALRM away from whoever else is using it
+        return signal.getsignal(signal.SIGALRM) in (signal.SIG_DFL, None, _raise_on_alarm)
+
+    @classmethod
+    def _set_alarm(cls):
+        deadline = cls.current()
+        if deadline:
+            signal.setitimer(signal.ITIMER_REAL, max(deadline.remaining(), 0.001), cls.REPEAT)
+        else:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    def __enter__(self):
+        self.expires_at = time.monotonic() + self.seconds
+        self.alarm = self._can_alarm()
+        if self.alarm:
+            self.previous_handler = signal.signal(signal.SIGALRM, _raise_on_alarm)
+        self.active().append(self)
+        if self.alarm:
+            self._set_alarm()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        self.active().remove(self)
+        if self.alarm:
+            signal.signal(signal.SIGALRM, self.previous_handler)
+            if self.active():
+                self._set_alarm()
+        return False
+
+
+def _raise_on_alarm(signum, frame):
+    deadline = Deadline.current()
+    if not deadline:
+        return
+    if deadline.expired():
+        raise TimeoutError('took too long')
+    # Woke up early, wait out the rest
+    Deadline._set_alarm()
+
+
+def check_deadline():
+    """Raises TimeoutError if this thread's current deadline has passed."""
+    deadline = Deadline.current()
+    if deadline:
+        deadline.check()
+
+
 def timelimit(timeout):
-    """borrowed from web.py"""
+    """Raises TimeoutError when the decorated call takes longer than `timeout` seconds.
+    On the main thread the call runs in this thread under a Deadline. Elsewhere a
+    SIGALRM can't interrupt it, so it runs in a thread of its own that the caller
+    stops waiting on once the time is up."""
     def _1(function):
+        @functools.wraps(function)
         def _2(*args, **kw):
-            class Dispatch(threading.Thread):
-                def __init__(self):
-                    threading.Thread.__init__(self)
-                    self.result = None
-                    self.error = None
-                    self.exc_info = None
-                    
-                    self.setDaemon(True)
-                    self.start()
-
-                def run(self):
-                    try:
-                        self.result = function(*args, **kw)
-                    except BaseException as e:
-                        self.error = e
-                        self.exc_info = sys.exc_info()
-            c = Dispatch()
-            dispatch = c
-            c.join(timeout)
-            if c.is_alive():
-                raise TimeoutError('took too long')
-            if c.error:
-                tb = ''.join(traceback.format_exception(c.exc_info[0], c.exc_info[1], c.exc_info[2]))
-                logging.debug(tb)
-                mail_admins('Error in timeout: %s' % c.exc_info[0], tb)
-                raise c.error
-            return c.result
+            if not Deadline._can_alarm():
+                return _join_within(timeout, function, *args, **kw)
+            with Deadline(timeout) as deadline:
+                try:
+                    result = function(*args, **kw)
+                except TimeoutError:
+                    raise
+                except Exception as e:
+                    if deadline.expired():
+                        raise TimeoutError('took too long') from e
+                    _mail_timeout_error()
+                    raise
+                # The call may have caught the TimeoutError itself and carried on
+                deadline.check()
+                return result
         return _2
     return _1
 
+
+def _mail_timeout_error():
+    tb = traceback.format_exc()
+    logging.debug(tb)
+    mail_admins('Error in timeout: %s' % sys.exc_info()[0], tb)
+
+
+def _join_within(timeout, function, *args, **kw):
+    class Dispatch(threading.Thread):
+        def __init__(self):
+            threading.Thread.__init__(self, daemon=True)
+            self.result = None
+            self.error = None
+            self.start()
+
+        def run(self):
+            # Lets loops in the call stop themselves with check_deadline()
+            with Deadline(timeout) as deadline:
+                try:
+                    self.result = function(*args, **kw)
+                except TimeoutError as e:
+                    self.error = e
+                except Exception as e:
+                    self.error = e
+                    if not deadline.expired():
+                        _mail_timeout_error()
+
+    dispatch = Dispatch()
+    dispatch.join(timeout)
+    if dispatch.is_alive():
+        raise TimeoutError('took too long')
+    if dispatch.error:
+        raise dispatch.error
+    return dispatch.result
+
          
 def utf8encode(tstr):
     """ Encodes a unicode string in utf-8
@@ -0,0 +1,135 @@
+import io
+import re
+import lxml.etree
+import feedparser
+from feedparser.datetimes import _parse_date
+
+FEED_ROOTS = ('rss', 'RDF', 'feed')
+ENTRY_TAGS = ('item', 'entry')
+GUID_TAGS = ('guid', 'id')
+DATE_TAGS = ('pubDate', 'published', 'updated', 'date', 'issued', 'modified')
+XML_ENCODING_RE = re.compile(br'\s*<\?xml[^>]*?\sencoding\s*=\s*["\']([A-Za-z][A-Za-z0-9._-]*)["\']')
+
+
+def local_name(tag):
+    if not isinstance(tag, str):
+        # Comments and processing instructions
+        return None
+    return tag.rsplit('}', 1)[-1]
+
+
+class StreamingFeedParser:
+    """ Parses only as much of a large feed as will be used.
+
+    The raw feed is walked with lxml's iterparse, stopping after `max_entries`
+    entries or once `known_run` entries in a row have story hashes that are
+    already in `known_story_hashes`, i.e. in the feed's unread cutoff. That
+    cutoff only applies while every entry so far is dated and the dates run
+    newest first, since a feed listing its oldest stories first puts its new
+    ones after the known ones. Only the
+    entries read up to there are handed to feedparser, so the entry dicts are
+    the ones pre_process_story() has always seen, dates, sanitizing and
+    relative links included.
+
+    Feeds that aren't well-formed RSS/Atom, or that end before the cutoff,
+    return None from parse() and are left to feedparser as a whole.
+    """
+
+    def __init__(self, raw_feed, story_hash=None, max_entries=100, known_story_hashes=None,
+                 known_run=10):
+        self.raw_feed = raw_feed
+        self.story_hash = story_hash
+        self.max_entries = max_entries
+        self.known_story_hashes = set(known_story_hashes or []) if story_hash else set()
+        self.known_run = known_run
+        self.root = None
+        self.entry_count = 0
+        self.known_count = 0
+        self.stopped_early = False
+        self.newest_first = True
+
+    def iter_entries(self):
+        """ Yields each top-level entry element as soon as it has been parsed. """
+        last_entry = None
+        last_date = None
+        known_in_a_row = 0
+        events = lxml.etree.iterparse(io.BytesIO(self.raw_feed), events=('start', 'end'),
+                                      resolve_entities=False, no_network=True)
+        for event, element in events:
+            if self.root is None:
+                self.root = element
+                if local_name(element.tag) not in FEED_ROOTS:
+                    return
+            if event != 'end' or local_name(element.tag) not in ENTRY_TAGS:
+                continue
+            if any(local_name(ancestor.tag) in ENTRY_TAGS for ancestor in element.iterancestors()):
+                continue
+
+            last_entry = element
+            self.entry_count += 1
+            yield element
+
+            if self.newest_first:
+                entry_date = self.entry_date(element)
+                if not entry_date or (last_date and entry_date > last_date):
+                    self.newest_first = False
+                last_date = entry_date
+            if self.known_story_hashes and self.is_known(element):
+                self.known_count += 1
+                known_in_a_row += 1
+            else:
+                known_in_a_row = 0
+            if not self.newest_first:
+                known_in_a_row = 0
+            if self.entry_count >= self.max_entries or known_in_a_row >= self.known_run:
+                self.stopped_early = True
+                break
+
+        if self.stopped_early:
+            # iterparse reads ahead, so drop whatever it has built past the last entry.
+            while last_entry.getnext() is not None:
+                last_entry.getparent().remove(last_entry.getnext())
+
+    def entry_date(self, element):
+        for child in element:
+            if local_name(child.tag) in DATE_TAGS and child.text and child.text.strip():
+                return _parse_date(child.text.strip())
+
+    def is_known(self, element):
+        guid = None
+        link = None
+        for child in element:
+            name = local_name(child.tag)
+            if name in GUID_TAGS and child.text and child.text.strip():
+                guid = child.text.strip()
+                break
+            if name == 'link' and not link:
+                link = (child.get('href') or child.text or '').strip()
+        guid = guid or link
+        return bool(guid) and self.story_hash(guid) in self.known_story_hashes
+
+    def truncated_feed(self):
+        # Kept in the feed's own encoding, since feedparser may be told the charset by
+        # the HTTP headers, which take precedence over the XML declaration.
+        # docinfo only learns the encoding once the whole document has been read.
+        encoding = self.root.getroottree().docinfo.encoding
+        if not encoding:
+            declaration = XML_ENCODING_RE.match(self.raw_feed)
+            encoding = declaration.group(1).decode('ascii') if declaration else 'utf-8'
+        try:
+            return lxml.etree.tostring(self.root, encoding=encoding, xml_declaration=True)
+        except LookupError:
+            return lxml.etree.tostring(self.root, encoding='utf-8', xml_declaration=True)
+
+    def parse(self, **kwargs):
+        """ Returns feedparser's result for the entries up to the cutoff, or None
+        if the whole feed should be parsed instead. `kwargs` go to feedparser. """
+        try:
+            for _ in self.iter_entries():
+                pass
+        except (lxml.etree.XMLSyntaxError, ValueError):
+            return None
+        if not self.stopped_early:
+            return None
+
+        return feedparser.parse(self.truncated_feed(), **kwargs)
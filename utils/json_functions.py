@@ -15,6 +15,11 @@ from bson.objectid import ObjectId
 import sys
 import datetime
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def decode(data):
     if not data:
@@ -42,7 +47,10 @@ def json_encode(data, *args, **kwargs):
         # Opps, we used to check if it is of type list, but that fails
         # i.e. in the case of django.newforms.utils.ErrorList, which extends
         # the type "list". Oh man, that was a dumb mistake!
-        if hasattr(data, 'canonical'):
+        if isinstance(data, (Decimal, ObjectId)):
+            # json.dumps() cant handle Decimal, and Decimal.canonical() is itself
+            ret = str(data)
+        elif hasattr(data, 'canonical'):
             ret = _any(data.canonical())
         elif isinstance(data, list):
             ret = _list(data)
@@ -53,9 +61,6 @@ def json_encode(data, *args, **kwargs):
             ret = _dict(data)
         # elif isinstance(data, CallableBool):
         #     ret = bool(data)
-        elif isinstance(data, (Decimal, ObjectId)):
-            # json.dumps() cant handle Decimal
-            ret = str(data)
         elif isinstance(data, models.query.QuerySet):
             # Actually its the same as a list ...
             ret = _list(data)
@@ -83,16 +88,7 @@ def json_encode(data, *args, **kwargs):
         return ret
 
     def _model(data):
-        ret = {}
-        # If we only have a model, we only want to encode the fields.
-        for f in data._meta.fields:
-            ret[f.attname] = _any(getattr(data, f.attname))
-        # And additionally encode arbitrary properties that had been added.
-        fields = dir(data.__class__) + list(ret.keys())
-        add_ons = [k for k in dir(data) if k not in fields]
-        for k in add_ons:
-            ret[k] = _any(getattr(data, k))
-        return ret
+        return _dict(_model_fields(data))
 
     def _list(data):
         ret = []
@@ -112,6 +108,82 @@ def json_encode(data, *args, **kwargs):
     return json.dumps(ret)
 
 
+def _model_fields(data):
+    ret = {}
+    # If we only have a model, we only want to encode the fields.
+    for f in data._meta.fields:
+        ret[f.attname] = getattr(data, f.attname)
+    # And additionally encode arbitrary properties that had been added.
+    fields = dir(data.__class__) + list(ret.keys())
+    add_ons = [k for k in dir(data) if k not in fields]
+    for k in add_ons:
+        ret[k] = getattr(data, k)
+    return ret
+
+
+def _orjson_default(data):
+    """
+    What json_encode() makes of the types orjson can't serialize itself, in the same order.
+    Datetimes are passed through to here so they keep str()'s format.
+    """
+    if isinstance(data, (Decimal, ObjectId)):
+        return str(data)
+    elif hasattr(data, 'canonical'):
+        return data.canonical()
+    elif isinstance(data, set):
+        return list(data)
+    elif isinstance(data, (models.query.QuerySet, MongoQuerySet)):
+        return list(data)
+    elif isinstance(data, models.Model):
+        return _model_fields(data)
+    elif isinstance(data, bytes):
+        return data.decode('utf-8', 'ignore')
+    elif isinstance(data, Exception):
+        return str(data)
+    elif isinstance(data, Promise):
+        return force_text(data)
+    elif isinstance(data, (datetime.datetime, datetime.date)):
+        return str(data)
+    elif hasattr(data, 'to_json'):
+        return data.to_json()
+    raise TypeError
+
+
+def _str_keys(data):
+    """
+    Dicts and lists with every dict key passed through str(), as json_encode() does.
+    orjson's own OPT_NON_STR_KEYS writes True, None and datetime keys differently.
+    """
+    if isinstance(data, dict):
+        return dict((str(k), _str_keys(v)) for k, v in data.items())
+    elif isinstance(data, (list, tuple)):
+        return [_str_keys(v) for v in data]
+    return data
+
+
+def json_encode_bytes(data):
+    """
+    json_encode() for responses, as utf-8 bytes. Uses orjson when it's installed, which
+    serializes plain dicts, lists and strings natively instead of walking them in Python.
+    The output is compact and keeps non-ascii characters as they are. Dicts with keys
+    that aren't strings, like feed ids, have their keys converted with str() first.
+    Anything orjson still rejects, like integers over 64 bits, goes through json_encode().
+    """
+    if hasattr(data, 'to_json'):
+        data = data.to_json()
+    if orjson:
+        try:
+            return orjson.dumps(data, default=_orjson_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except TypeError:
+            pass
+        try:
+            return orjson.dumps(_str_keys(data), default=_orjson_default,
+                                option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except TypeError:
+            pass
+    return json_encode(data).encode('utf-8')
+
+
 def json_view(func):
     def wrap(request, *a, **kw):
         response = func(request, *a, **kw)
@@ -165,7 +237,7 @@ def json_response(request, response=None):
         else:
             print('\n'.join(traceback.format_exception(*exc_info)))
 
-    json = json_encode(response)
+    json = json_encode_bytes(response)
     return HttpResponse(json, content_type='application/json; charset=utf-8', status=code)
 
 
@@ -0,0 +1,226 @@
+from django.conf import settings
+from utils.feed_functions import chunks
+from utils.redis_scripts import RANK_RIVER_STORIES, RANK_RIVER_STORIES_BITS
+from utils.redis_scripts import MARK_READ_BITS, UNREAD_BITS, READ_BITS_MEMBERS, IS_READ_BITS
+from utils.redis_scripts import READ_BITS_FEED_BASE, TRIM_READ_BITS
+
+# Where a user's read stories in each feed are kept. Everything else, the all-feeds RS:<user_id>
+# set, the RS:<user_id>:B:<social_user_id> sets and the lRS: list, is the same for both.
+#
+# Every method takes the story hash redis connection, or a pipeline on it, and returns what
+# the equivalent redis command would, so calls can be queued on a pipeline.
+
+
+def read_stories_backend():
+    return READ_STORIES_BACKENDS[getattr(settings, 'READ_STORIES_BACKEND', 'sets')]
+
+
+def read_stories_expire():
+    return settings.DAYS_OF_STORY_HASHES*24*60*60
+
+
+class ReadStorySets:
+    """ Read stories as RS:<user_id>:<feed_id> sets of story hashes. """
+
+    RANK_RIVER_SCRIPT = RANK_RIVER_STORIES
+
+    @staticmethod
+    def read_key(user_id, feed_id):
+        return 'RS:%s:%s' % (user_id, feed_id)
+
+    @classmethod
+    def read_keys(cls, user_id, feed_id):
+        """ The keys after F: and zF: in RANK_RIVER_SCRIPT, per feed. """
+        return [cls.read_key(user_id, feed_id)]
+
+    @classmethod
+    def mark_read(cls, r, user_id, feed_id, story_hashes):
+        if not story_hashes: return
+        read_key = cls.read_key(user_id, feed_id)
+        r.sadd(read_key, *story_hashes)
+        r.expire(read_key, read_stories_expire())
+
+    @classmethod
+    def mark_unread(cls, r, user_id, feed_id, story_hashes):
+        if not story_hashes: return
+        read_key = cls.read_key(user_id, feed_id)
+        r.srem(read_key, *story_hashes)
+        r.expire(read_key, read_stories_expire())
+
+    @classmethod
+    def has_read_stories(cls, r, user_id, feed_id):
+        return r.exists(cls.read_key(user_id, feed_id))
+
+    @classmethod
+    def is_read(cls, r, user_id, feed_id, story_hash):
+        return r.sismember(cls.read_key(user_id, feed_id), story_hash)
+
+    @classmethod
+    def read_story_hashes(cls, r, user_id, feed_id):
+        return r.smembers(cls.read_key(user_id, feed_id))
+
+    @classmethod
+    def read_story_count(cls, r, user_id, feed_id):
+        return r.scard(cls.read_key(user_id, feed_id))
+
+    @classmethod
+    def unread_story_hashes(cls, r, user_id, feed_id):
+        return r.sdiff('F:%s' % feed_id, cls.read_key(user_id, feed_id))
+
+    @classmethod
+    def store_unread_story_hashes(cls, r, user_id, feed_id, unread_stories_key):
+        return r.sdiffstore(unread_stories_key, 'F:%s' % feed_id, cls.read_key(user_id, feed_id))
+
+    @classmethod
+    def trim(cls, r, feed_id, user_ids, forget_stale=False):
+        """ Forgets read stories that are no longer in the feed. Returns how many were dropped. """
+        trimmed = 0
+        for user_id_group in chunks(user_ids, 500):
+            pipeline = r.pipeline()
+            for user_id in user_id_group:
+                pipeline.sdiff(cls.read_key(user_id, feed_id), "F:%s" % feed_id)
+            stale_story_hashes = pipeline.execute()
+
+            pipeline = r.pipeline()
+            for user_id, stale_hashes in zip(user_id_group, stale_story_hashes):
+                if not stale_hashes: continue
+                pipeline.srem(cls.read_key(user_id, feed_id), *stale_hashes)
+                pipeline.srem("RS:%s" % feed_id, *stale_hashes)
+                trimmed += len(stale_hashes)
+            pipeline.execute()
+        return trimmed
+
+    @classmethod
+    def scan_read_keys(cls, r):
+        """ Yields (user_id, feed_id) for every user and feed with read stories. """
+        for key in r.scan_iter(match='RS:*:*', count=1000):
+            parts = key.split(':')
+            if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+                yield int(parts[1]), int(parts[2])
+
+
+class ReadStoryBitmaps(ReadStorySets):
+    """ Read stories as RB:<user_id>:<feed_id> bitmaps over the feed's story ordinals.
+
+    A feed's stories are numbered in FO:<feed_id> as they are first read, and each bitmap
+    starts at the lowest ordinal still in the feed, so a read story costs a bit instead of
+    a full story hash, and the unread stories of a feed come from GETBITs instead of a set
+    difference. See the scripts in utils.redis_scripts.
+    """
+
+    RANK_RIVER_SCRIPT = RANK_RIVER_STORIES_BITS
+
+    @staticmethod
+    def read_key(user_id, feed_id):
+        return 'RB:%s:%s' % (user_id, feed_id)
+
+    @staticmethod
+    def ordinals_key(feed_id):
+        return 'FO:%s' % feed_id
+
+    @classmethod
+    def read_keys(cls, user_id, feed_id):
+        return [cls.ordinals_key(feed_id), cls.read_key(user_id, feed_id)]
+
+    @classmethod
+    def mark_read(cls, r, user_id, feed_id, story_hashes):
+        if not story_hashes: return
+        script = r.register_script(MARK_READ_BITS)
+        return script(keys=cls.read_keys(user_id, feed_id),
+                      args=[1, read_stories_expire()] + list(story_hashes))
+
+    @classmethod
+    def mark_unread(cls, r, user_id, feed_id, story_hashes):
+        if not story_hashes: return
+        script = r.register_script(MARK_READ_BITS)
+        return script(keys=cls.read_keys(user_id, feed_id),
+                      args=[0, read_stories_expire()] + list(story_hashes))
+
+    @classmethod
+    def is_read(cls, r, user_id, feed_id, story_hash):
+        script = r.register_script(IS_READ_BITS)
+        return script(keys=cls.read_keys(user_id, feed_id), args=[story_hash])
+
+    @classmethod
+    def read_story_hashes(cls, r, user_id, feed_id):
+        script = r.register_script(READ_BITS_MEMBERS)
+        return script(keys=cls.read_keys(user_id, feed_id))
+
+    @classmethod
+    def read_story_count(cls, r, user_id, feed_id):
+        # Skips the 4 byte header
+        return r.bitcount(cls.read_key(user_id, feed_id), 4, -1)
+
+    @classmethod
+    def unread_story_hashes(cls, r, user_id, feed_id):
+        script = r.register_script(UNREAD_BITS)
+        return script(keys=['F:%s' % feed_id] + cls.read_keys(user_id, feed_id))
+
+    @classmethod
+    def store_unread_story_hashes(cls, r, user_id, feed_id, unread_stories_key):
+        script = r.register_script(UNREAD_BITS)
+        return script(keys=['F:%s' % feed_id] + cls.read_keys(user_id, feed_id) + [unread_stories_key])
+
+    @classmethod
+    def trim(cls, r, feed_id, user_ids, forget_stale=False):
+        """ Clears the bits of stories that are no longer in the feed, dropping them from
+        the front of each bitmap where they can. Returns how many bitmaps changed.
+
+        With `forget_stale`, the feed also forgets the ordinals of those stories. Bitmaps that
+        weren't trimmed along with it keep their bits, which only read_story_count() sees,
+        until their start moves past them.
+        """
+        feed_base = r.register_script(READ_BITS_FEED_BASE)
+        trim = r.register_script(TRIM_READ_BITS)
+        base_and_stale_ordinals = feed_base(keys=['F:%s' % feed_id, cls.ordinals_key(feed_id)],
+                                            args=[1 if forget_stale else 0])
+        trimmed = 0
+        for user_id_group in chunks(user_ids, 500):
+            trimmed += trim(keys=[cls.read_key(user_id, feed_id) for user_id in user_id_group],
+                            args=base_and_stale_ordinals)
+        return trimmed
+
+    @classmethod
+    def scan_read_keys(cls, r):
+        for key in r.scan_iter(match='RB:*:*', count=1000):
+            _, user_id, feed_id = key.split(':')
+            yield int(user_id), int(feed_id)
+
+
+def copy_read_stories(r, source, target, delete=False):
+    """ Copies every user's read stories from one backend to the other, keeping their
+    expiry, and with `delete`, removes them from the source. Copying again later only adds
+    what was read in between, so it can be run before and after switching backends.
+
+    Stories are copied oldest first, so that the bitmaps number them in order. Returns the
+    number of users' feeds copied.
+    """
+    copied = 0
+    for user_id, feed_id in source.scan_read_keys(r):
+        source_key = source.read_key(user_id, feed_id)
+        story_hashes = list(source.read_story_hashes(r, user_id, feed_id))
+        pipeline = r.pipeline()
+        for story_hash in story_hashes:
+            pipeline.zscore('zF:%s' % feed_id, story_hash)
+        pipeline.ttl(source_key)
+        results = pipeline.execute()
+        story_scores, ttl = results[:-1], results[-1]
+        story_hashes = [story_hash for _, story_hash in
+                        sorted(zip(story_scores, story_hashes), key=lambda s: (s[0] or 0, s[1]))]
+
+        pipeline = r.pipeline()
+        target.mark_read(pipeline, user_id, feed_id, story_hashes)
+        if ttl and ttl > 0:
+            pipeline.expire(target.read_key(user_id, feed_id), ttl)
+        if delete:
+            pipeline.delete(source_key)
+        pipeline.execute()
+        copied += 1
+
+    return copied
+
+
+READ_STORIES_BACKENDS = {
+    'sets': ReadStorySets,
+    'bitmaps': ReadStoryBitmaps,
+}
@@ -0,0 +1,345 @@
+from utils.feed_functions import chunks
+
+# Ranks the stories of many feeds into one sorted set, server-side. Matches what
+# UserSubscription.story_hashes() computes with SDIFFSTORE + ZINTERSTORE + ZRANGEBYSCORE
+# per feed, without the temporary U: and zU: keys or sending every hash back and forth.
+#
+# KEYS: the ranked key, then F:<feed_id>, zF:<feed_id>, RS:<user_id>:<feed_id> per feed
+# ARGV: 1 to skip read stories, the max score, then the min score per feed
+#
+# Scores are the zF: score + 1, the implicit score of F: in the ZINTERSTORE, and the min
+# and max scores are compared against that, as they are by story_hashes().
+RANK_RIVER_STORIES = """
+local ranked_key = KEYS[1]
+local unread_only = ARGV[1] == '1'
+local max_score = tonumber(ARGV[2])
+local ranked = 0
+local batch = {}
+
+local function flush()
+    if #batch > 0 then
+        redis.call('ZADD', ranked_key, unpack(batch))
+        batch = {}
+    end
+end
+
+for feed = 0, (#KEYS - 1) / 3 - 1 do
+    local stories_key = KEYS[2 + feed * 3]
+    local sorted_stories_key = KEYS[3 + feed * 3]
+    local read_stories_key = KEYS[4 + feed * 3]
+    local min_score = tonumber(ARGV[3 + feed])
+    local stories = redis.call('ZRANGEBYSCORE', sorted_stories_key,
+                               min_score - 1, max_score - 1, 'WITHSCORES')
+    for i = 1, #stories, 2 do
+        local story_hash = stories[i]
+        if redis.call('SISMEMBER', stories_key, story_hash) == 1 and
+           (not unread_only or redis.call('SISMEMBER', read_stories_key, story_hash) == 0) then
+            batch[#batch + 1] = tonumber(stories[i + 1]) + 1
+            batch[#batch + 1] = story_hash
+            ranked = ranked + 1
+            if #batch >= 1000 then
+                flush()
+            end
+        end
+    end
+end
+flush()
+
+return ranked
+"""
+
+
+# Read stories as bitmaps, see utils.read_stories.ReadStoryBitmaps.
+#
+# Each feed numbers its stories the first time one is read, in the FO:<feed_id> hash of
+# story hash -> ordinal, with the next ordinal under '#'. A user's RB:<user_id>:<feed_id>
+# bitmap starts with a 32 bit header holding the ordinal of its first bit, so that the
+# bits of stories that have left the feed can be dropped from the front of each bitmap
+# on its own, without renumbering the feed.
+READ_BITS_HELPERS = """
+local HEADER_BITS = 32
+
+local function bitmap_base(read_key)
+    return redis.call('BITFIELD', read_key, 'GET', 'u32', 0)[1]
+end
+
+local function is_read(ordinals_key, read_key, base, story_hash)
+    local ordinal = redis.call('HGET', ordinals_key, story_hash)
+    if not ordinal then
+        return false
+    end
+    ordinal = tonumber(ordinal)
+    if ordinal < base then
+        return false
+    end
+    return redis.call('GETBIT', read_key, HEADER_BITS + ordinal - base) == 1
+end
+
+local function rebase(read_key, base, new_base)
+    local ttl = redis.call('PTTL', read_key)
+    local bits
+    if new_base > base then
+        bits = redis.call('GETRANGE', read_key, 4 + (new_base - base) / 8, -1)
+    else
+        bits = string.rep('\\0', (base - new_base) / 8) .. redis.call('GETRANGE', read_key, 4, -1)
+    end
+    redis.call('SET', read_key, '\\0\\0\\0\\0' .. bits)
+    redis.call('BITFIELD', read_key, 'SET', 'u32', 0, new_base)
+    if ttl > 0 then
+        redis.call('PEXPIRE', read_key, ttl)
+    end
+end
+"""
+
+# KEYS: FO:<feed_id>, RB:<user_id>:<feed_id>
+# ARGV: 1 to mark read or 0 to mark unread, the expiry in seconds, then the story hashes
+MARK_READ_BITS = READ_BITS_HELPERS + """
+local ordinals_key = KEYS[1]
+local read_key = KEYS[2]
+local read = ARGV[1] == '1'
+local expire = tonumber(ARGV[2])
+
+-- Without the feed's ordinals the bits no longer say which stories they are
+if redis.call('EXISTS', ordinals_key) == 0 then
+    redis.call('DEL', read_key)
+end
+
+for i = 3, #ARGV do
+    local story_hash = ARGV[i]
+    local ordinal = redis.call('HGET', ordinals_key, story_hash)
+    if not ordinal and read then
+        ordinal = redis.call('HINCRBY', ordinals_key, '#', 1) - 1
+        redis.call('HSET', ordinals_key, story_hash, ordinal)
+    end
+    if ordinal then
+        ordinal = tonumber(ordinal)
+        local exists = redis.call('EXISTS', read_key) == 1
+        local base = bitmap_base(read_key)
+        if read and not exists then
+            base = ordinal - ordinal % 8
+            redis.call('BITFIELD', read_key, 'SET', 'u32', 0, base)
+            exists = true
+        elseif read and ordinal < base then
+            rebase(read_key, base, ordinal - ordinal % 8)
+            base = ordinal - ordinal % 8
+        end
+        if exists and ordinal >= base then
+            redis.call('SETBIT', read_key, HEADER_BITS + ordinal - base, read and 1 or 0)
+        end
+    end
+end
+
+-- The ordinals must outlive every bitmap numbered by them
+redis.call('EXPIRE', read_key, expire)
+redis.call('EXPIRE', ordinals_key, expire)
+"""
+
+# KEYS: FO:<feed_id>, RB:<user_id>:<feed_id>
+# ARGV: the story hash
+# Returns 1 if the story is marked read, else 0.
+IS_READ_BITS = READ_BITS_HELPERS + """
+local ordinals_key = KEYS[1]
+local read_key = KEYS[2]
+if is_read(ordinals_key, read_key, bitmap_base(read_key), ARGV[1]) then
+    return 1
+end
+return 0
+"""
+
+# KEYS: F:<feed_id>, FO:<feed_id>, RB:<user_id>:<feed_id>, and optionally a set to store into
+# Returns the unread story hashes of F:, or with a key to store them in, how many there are.
+UNREAD_BITS = READ_BITS_HELPERS + """
+local ordinals_key = KEYS[2]
+local read_key = KEYS[3]
+local base = bitmap_base(read_key)
+local unread = {}
+
+for _, story_hash in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    if not is_read(ordinals_key, read_key, base, story_hash) then
+        unread[#unread + 1] = story_hash
+    end
+end
+
+if not KEYS[4] then
+    return unread
+end
+redis.call('DEL', KEYS[4])
+for i = 1, #unread, 1000 do
+    redis.call('SADD', KEYS[4], unpack(unread, i, math.min(i + 999, #unread)))
+end
+return #unread
+"""
+
+# KEYS: FO:<feed_id>, RB:<user_id>:<feed_id>
+# Returns the story hashes marked read, oldest first.
+READ_BITS_MEMBERS = READ_BITS_HELPERS + """
+local ordinals_key = KEYS[1]
+local read_key = KEYS[2]
+if redis.call('EXISTS', read_key) == 0 then
+    return {}
+end
+local base = bitmap_base(read_key)
+local ordinals = redis.call('HGETALL', ordinals_key)
+local read = {}
+
+for i = 1, #ordinals, 2 do
+    local story_hash = ordinals[i]
+    local ordinal = tonumber(ordinals[i + 1])
+    if story_hash ~= '#' and ordinal >= base and
+       redis.call('GETBIT', read_key, HEADER_BITS + ordinal - base) == 1 then
+        read[#read + 1] = {ordinal, story_hash}
+    end
+end
+table.sort(read, function(a, b) return a[1] < b[1] end)
+for i = 1, #read do
+    read[i] = read[i][2]
+end
+return read
+"""
+
+# KEYS: F:<feed_id>, FO:<feed_id>
+# ARGV: 1 to also forget the ordinals of stories no longer in F:
+# Returns the lowest ordinal still in use, rounded down to a whole byte, which is where
+# every bitmap of the feed can start, then the ordinals of the stories no longer in F:.
+READ_BITS_FEED_BASE = """
+local ordinals = redis.call('HGETALL', KEYS[2])
+local next_ordinal = 0
+local base = nil
+local stale = {}
+local stale_ordinals = {}
+
+for i = 1, #ordinals, 2 do
+    local story_hash = ordinals[i]
+    local ordinal = tonumber(ordinals[i + 1])
+    if story_hash == '#' then
+        next_ordinal = ordinal
+    elseif redis.call('SISMEMBER', KEYS[1], story_hash) == 0 then
+        stale[#stale + 1] = story_hash
+        stale_ordinals[#stale_ordinals + 1] = ordinal
+    elseif not base or ordinal < base then
+        base = ordinal
+    end
+end
+if ARGV[1] == '1' then
+    for i = 1, #stale, 1000 do
+        redis.call('HDEL', KEYS[2], unpack(stale, i, math.min(i + 999, #stale)))
+    end
+end
+
+base = base or next_ordinal
+return {base - base % 8, unpack(stale_ordinals)}
+"""
+
+# KEYS: RB:<user_id>:<feed_id> for each user
+# ARGV: the feed's base then the forgotten ordinals, from READ_BITS_FEED_BASE
+# Drops the bits before the base from each bitmap and clears the forgotten ones after it,
+# returning how many bitmaps changed.
+TRIM_READ_BITS = READ_BITS_HELPERS + """
+local new_base = tonumber(ARGV[1])
+local trimmed = 0
+
+for _, read_key in ipairs(KEYS) do
+    if redis.call('EXISTS', read_key) == 1 then
+        local base = bitmap_base(read_key)
+        local changed = 0
+        if new_base > base then
+            rebase(read_key, base, new_base)
+            base = new_base
+            changed = 1
+        end
+        for i = 2, #ARGV do
+            local ordinal = tonumber(ARGV[i])
+            if ordinal >= base then
+                changed = math.max(changed, redis.call('SETBIT', read_key, HEADER_BITS + ordinal - base, 0))
+            end
+        end
+        trimmed = trimmed + changed
+    end
+end
+
+return trimmed
+"""
+
+# RANK_RIVER_STORIES for read stories kept as bitmaps.
+#
+# KEYS: the ranked key, then F:<feed_id>, zF:<feed_id>, FO:<feed_id>, RB:<user_id>:<feed_id> per feed
+# ARGV: 1 to skip read stories, the max score, then the min score per feed
+RANK_RIVER_STORIES_BITS = READ_BITS_HELPERS + """
+local ranked_key = KEYS[1]
+local unread_only = ARGV[1] == '1'
+local max_score = tonumber(ARGV[2])
+local ranked = 0
+local batch = {}
+
+local function flush()
+    if #batch > 0 then
+        redis.call('ZADD', ranked_key, unpack(batch))
+        batch = {}
+    end
+end
+
+for feed = 0, (#KEYS - 1) / 4 - 1 do
+    local stories_key = KEYS[2 + feed * 4]
+    local sorted_stories_key = KEYS[3 + feed * 4]
+    local ordinals_key = KEYS[4 + feed * 4]
+    local read_key = KEYS[5 + feed * 4]
+    local min_score = tonumber(ARGV[3 + feed])
+    local base = bitmap_base(read_key)
+    local stories = redis.call('ZRANGEBYSCORE', sorted_stories_key,
+                               min_score - 1, max_score - 1, 'WITHSCORES')
+    for i = 1, #stories, 2 do
+        local story_hash = stories[i]
+        if redis.call('SISMEMBER', stories_key, story_hash) == 1 and
+           (not unread_only or not is_read(ordinals_key, read_key, base, story_hash)) then
+            batch[#batch + 1] = tonumber(stories[i + 1]) + 1
+            batch[#batch + 1] = story_hash
+            ranked = ranked + 1
+            if #batch >= 1000 then
+                flush()
+            end
+        end
+    end
+end
+flush()
+
+return ranked
+"""
+
+
+def rank_river_stories(r, ranked_key, user_id, feed_min_scores, max_score, unread_only,
+                       feeds_per_call=500, dump=False, read_stories=None):
+    """
+    Replaces `ranked_key` with the stories of every (feed_id, min_score) in `feed_min_scores`,
+    in a single pipelined round trip. Feeds are split across several script calls so that
+    one huge river doesn't hold up the server for its whole length.
+
+    `read_stories` is the read stories backend from utils.read_stories, sets by default.
+
+    Returns the number of ranked stories and, with `dump`, the DUMP of the ranked key, which
+    is then deleted so it can be restored on another server.
+    """
+    if not read_stories:
+        from utils.read_stories import ReadStorySets
+        read_stories = ReadStorySets
+    script = r.register_script(read_stories.RANK_RIVER_SCRIPT)
+    pipeline = r.pipeline(transaction=False)
+    pipeline.delete(ranked_key)
+    calls = 0
+    for feed_group in chunks(feed_min_scores, feeds_per_call):
+        keys = [ranked_key]
+        args = [1 if unread_only else 0, max_score]
+        for feed_id, min_score in feed_group:
+            keys.extend(['F:%s' % feed_id, 'zF:%s' % feed_id])
+            keys.extend(read_stories.read_keys(user_id, feed_id))
+            args.append(min_score)
+        script(keys=keys, args=args, client=pipeline)
+        calls += 1
+    if dump:
+        pipeline.dump(ranked_key)
+        pipeline.delete(ranked_key)
+    results = pipeline.execute()
+
+    ranked = sum(results[1:1+calls])
+    if dump:
+        return ranked, results[1+calls]
+    return ranked
@@ -0,0 +1,124 @@
+import zlib
+import threading
+import msgpack
+import redis
+from collections import OrderedDict
+from django.conf import settings
+from django.utils.encoding import smart_bytes
+from utils import log as logging
+
+
+class FormattedStoryCache:
+    """
+    Caches the expensive part of Feed.format_story(): the decompressed story content, the
+    derived title and the signed image proxy urls. Entries are msgpack'd and kept in a
+    small in-process LRU in front of redis, keyed by story hash.
+
+    Every entry carries the content version of the story it was built from, so a story
+    whose content, title or images have changed since is treated as a miss, even in
+    processes that never saw the invalidation from MStory.save().
+    """
+
+    CACHE_KEY = "FS:%s"
+    CACHE_EXPIRE = 60*60*6
+    LOCAL_MAX_BYTES = 32 * 1024 * 1024
+
+    _local = OrderedDict()
+    _local_bytes = 0
+    _local_lock = threading.Lock()
+
+    @staticmethod
+    def content_version(story_db):
+        version = zlib.adler32(story_db.story_content_z or b'')
+        latest_story_content_z = getattr(story_db, 'story_latest_content_z', None)
+        if latest_story_content_z:
+            version = zlib.adler32(latest_story_content_z, version)
+        fields = [story_db.story_title or "", story_db.story_permalink or ""] + list(story_db.image_urls or [])
+        return zlib.adler32(smart_bytes("\n".join(fields)), version)
+
+    @classmethod
+    def get_many(cls, stories_db):
+        """
+        Returns {story_hash: content} for the stories cached at their current version,
+        with a single redis round trip for everything missing from the local cache.
+        """
+        versions = {}
+        for story_db in stories_db:
+            story_hash = getattr(story_db, 'story_hash', None)
+            if story_hash:
+                versions[story_hash] = cls.content_version(story_db)
+        if not versions:
+            return {}
+
+        packed = {}
+        with cls._local_lock:
+            for story_hash in versions:
+                if story_hash in cls._local:
+                    cls._local.move_to_end(story_hash)
+                    packed[story_hash] = cls._local[story_hash]
+
+        missing = [story_hash for story_hash in versions if story_hash not in packed]
+        if missing:
+            try:
+                r = redis.Redis(connection_pool=settings.REDIS_STORY_CACHE_POOL)
+                cached = r.mget([cls.CACHE_KEY % story_hash for story_hash in missing])
+            except redis.RedisError as e:
+                logging.debug(" ***> ~FRFormatted story cache unavailable: %s" % e)
+                cached = []
+            for story_hash, value in zip(missing, cached):
+                if value:
+                    packed[story_hash] = value
+                    cls._set_local(story_hash, value)
+
+        contents = {}
+        for story_hash, value in packed.items():
+            version, content = msgpack.unpackb(value, raw=False)
+            if version == versions[story_hash]:
+                contents[story_hash] = content
+        return contents
+
+    @classmethod
+    def set_many(cls, stories):
+        """ Caches [(story_db, content), ...] in one pipelined round trip. """
+        stories = [(story_db, content) for story_db, content in stories
+                   if getattr(story_db, 'story_hash', None)]
+        if not stories:
+            return
+
+        try:
+            r = redis.Redis(connection_pool=settings.REDIS_STORY_CACHE_POOL)
+            pipeline = r.pipeline(transaction=False)
+            for story_db, content in stories:
+                value = msgpack.packb([cls.content_version(story_db), content], use_bin_type=True)
+                cls._set_local(story_db.story_hash, value)
+                pipeline.set(cls.CACHE_KEY % story_db.story_hash, value, ex=cls.CACHE_EXPIRE)
+            pipeline.execute()
+        except redis.RedisError as e:
+            logging.debug(" ***> ~FRFormatted story cache unavailable: %s" % e)
+
+    @classmethod
+    def invalidate(cls, story_hash, r=None):
+        if not story_hash:
+            return
+        with cls._local_lock:
+            value = cls._local.pop(story_hash, None)
+            if value is not None:
+                cls._local_bytes -= len(value)
+        try:
+            if not r:
+                r = redis.Redis(connection_pool=settings.REDIS_STORY_CACHE_POOL)
+            r.delete(cls.CACHE_KEY % story_hash)
+        except redis.RedisError as e:
+            logging.debug(" ***> ~FRFormatted story cache unavailable: %s" % e)
+
+    @classmethod
+    def _set_local(cls, story_hash, value):
+        with cls._local_lock:
+            previous = cls._local.pop(story_hash, None)
+            if previous is not None:
+                cls._local_bytes -= len(previous)
+            cls._local[story_hash] = value
+            cls._local_bytes += len(value)
+            while cls._local_bytes > cls.LOCAL_MAX_BYTES and cls._local:
+                _, evicted = cls._local.popitem(last=False)
+                cls._local_bytes -= len(evicted)
@@ -1,10 +1,13 @@
 import re
+import zlib
+import bisect
 import datetime
 import struct
 import dateutil
 import hashlib
 import base64
 import html
+import html.entities
 import sys
 from random import randint
 from lxml.html.diff import tokenize, fixup_ins_del_tags, htmldiff_tokens
@@ -12,8 +15,10 @@ from lxml.etree import ParserError, XMLSyntaxError, SerialisationError
 import lxml.html, lxml.etree
 from lxml.html.clean import Cleaner
 from itertools import chain
+from collections import Counter
 from django.utils.dateformat import DateFormat
 from django.utils.html import strip_tags as strip_tags_django
+from django.utils.encoding import smart_str
 from utils.tornado_escape import linkify as linkify_tornado
 from utils.tornado_escape import xhtml_unescape as xhtml_unescape_tornado
 import feedparser
@@ -24,6 +29,12 @@ from hashlib import sha1
 
 # COMMENTS_RE = re.compile('\<![ \r\n\t]*(--([^\-]|[\r\n]|-[^\-])*--[ \r\n\t]*)\>')
 COMMENTS_RE = re.compile('\<!--.*?--\>')
+# An <img> tag's attributes, skipping comments, scripts and styles, whose <img>s aren't markup
+IMG_TAG_RE = re.compile(r'<!--.*?-->|<(script|style)\b.*?</\1\s*>|<img(?=[\s/>])((?:"[^"]*"|\'[^\']*\'|[^\'">])*)>', re.I | re.S)
+TAG_ATTRS_RE = re.compile(r'([^\s"\'>/=]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]*)))?')
+# Character references as an attribute value decodes them: a legacy reference without its
+# semicolon, like "&sect" in "?id=1&section=2", is left alone when a letter, digit or = follows
+CHAR_REF_RE = re.compile(r'&(?:#[0-9]+;?|#[xX][0-9a-fA-F]+;?|[A-Za-z][A-Za-z0-9]*;|([A-Za-z][A-Za-z0-9]*)(?![=A-Za-z0-9]))')
 
 def midnight_today(now=None):
     if not now:
@@ -213,6 +224,33 @@ def strip_tags(html):
         return ''
     return strip_tags_django(html)
 
+def unescape_char_ref(ref):
+    legacy_name = ref.group(1)
+    if legacy_name and legacy_name not in html.entities.html5:
+        return ref.group(0)
+    return html.unescape(ref.group(0))
+
+def extract_image_sources(html_string):
+    """ The src of every <img> in the content, in order, found in a single pass over the
+        markup instead of through a parsed tree. """
+    if not html_string:
+        return []
+    if isinstance(html_string, bytes):
+        html_string = html_string.decode('utf-8', 'replace')
+
+    image_sources = []
+    for img in IMG_TAG_RE.finditer(html_string):
+        attrs = img.group(2)
+        if attrs is None:
+            continue
+        for name, double_quoted, single_quoted, unquoted in TAG_ATTRS_RE.findall(attrs):
+            if name.lower() == 'src':
+                image_source = double_quoted or single_quoted or unquoted
+                image_sources.append(CHAR_REF_RE.sub(unescape_char_ref, image_source))
+                break
+
+    return image_sources
+
 def strip_comments(html_string):
     return COMMENTS_RE.sub('', html_string)
 
@@ -296,6 +334,97 @@ def htmldiff(old_html, new_html):
     return fixup_ins_del_tags(result)
 
 
+class ExistingStoryIndex:
+    """ Per-fetch index over a feed's existing stories, used by Feed._exists_story.
+
+    Exact story hashes are a dict lookup. Fuzzy title matching only considers
+    stories that could possibly clear the title ratio threshold, found by bisecting
+    on title length and then bounding the ratio with character counts, which is
+    the same upper bound difflib's quick_ratio() uses. Stories come back in their
+    original order, so matches are the same as checking every story. Content is
+    decompressed lazily, at most once per story.
+    """
+
+    def __init__(self, existing_stories, new_story_hashes, min_title_ratio=.75):
+        self.stories = existing_stories
+        self.new_story_hashes = set(new_story_hashes)
+        self.min_title_ratio = min_title_ratio
+        self.contents = {}
+        self.title_lengths = []
+        self.title_counts = {}
+
+        for position, existing_story in enumerate(existing_stories.values()):
+            if isinstance(existing_story.id, str):
+                # Correcting a MongoDB bug
+                existing_story.story_guid = existing_story.id
+            if existing_story.story_hash in self.new_story_hashes:
+                # Story coming up later, so it's only ever an exact match
+                continue
+            title = existing_story.story_title or ""
+            self.title_lengths.append((len(title), position, existing_story))
+            self.title_counts[position] = Counter(title)
+        self.title_lengths.sort(key=lambda t: t[:2])
+        self.lengths = [t[0] for t in self.title_lengths]
+
+    def __len__(self):
+        return len(self.stories)
+
+    def get(self, story_hash):
+        return self.stories.get(story_hash)
+
+    def _below_ratio(self, matches, length):
+        if not length:
+            return False
+        return 2.0 * matches / length < self.min_title_ratio
+
+    def title_candidates(self, title, story_date):
+        title = title or ""
+        title_length = len(title)
+        # ratio <= 2*min(a, b)/(a + b), so much longer and shorter titles can be skipped
+        low = int(title_length * self.min_title_ratio / (2 - self.min_title_ratio))
+        high = int(title_length * (2 - self.min_title_ratio) / self.min_title_ratio) + 1
+        start = bisect.bisect_left(self.lengths, low)
+        title_counts = None
+        candidates = []
+        for existing_length, position, existing_story in self.title_lengths[start:]:
+            if existing_length > high:
+                break
+            total_length = title_length + existing_length
+            if self._below_ratio(min(title_length, existing_length), total_length):
+                continue
+            story_timedelta = existing_story.story_date - story_date
+            if abs(story_timedelta.days) >= 2:
+                continue
+            if title_counts is None:
+                title_counts = Counter(title)
+            matches = sum((title_counts & self.title_counts[position]).values())
+            if self._below_ratio(matches, total_length):
+                continue
+            candidates.append((position, existing_story))
+
+        return [existing_story for _, existing_story in sorted(candidates, key=lambda c: c[0])]
+
+    def content(self, existing_story):
+        """ Latest content of an existing story, decompressed once per fetch. """
+        content = self.contents.get(existing_story.story_hash)
+        if content is not None:
+            return content
+
+        if 'story_latest_content_z' in existing_story:
+            content = smart_str(zlib.decompress(existing_story.story_latest_content_z))
+        elif 'story_latest_content' in existing_story:
+            content = existing_story.story_latest_content
+        elif 'story_content_z' in existing_story:
+            content = smart_str(zlib.decompress(existing_story.story_content_z))
+        elif 'story_content' in existing_story:
+            content = existing_story.story_content
+        else:
+            content = ''
+        self.contents[existing_story.story_hash] = content
+
+        return content
+
+
 def create_camo_signed_url(base_url, hmac_key, url):
     """Create a camo signed URL for the specified image URL
     Args: